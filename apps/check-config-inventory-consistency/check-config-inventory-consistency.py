@@ -19,8 +19,9 @@ import sys
 import seiscomp.client
 import seiscomp.core
 import seiscomp.datamodel
-from scstuff.inventory import InventoryIterator
+from scstuff.inventory import InventoryIterator, selectStreams
 from scstuff.util import configuredStreams
+import scstuff.inventorysnapshot
 
 
 class App(seiscomp.client.Application):
@@ -36,6 +37,11 @@ class App(seiscomp.client.Application):
         self.commandline().addGroup("Mode")
         self.commandline().addOption("Mode", "inventory,I", "Find items in inventory missing in config")
         self.commandline().addOption("Mode", "config,C",    "Find items in config missing in inventory")
+        self.commandline().addGroup("Inventory")
+        self.commandline().addOption("Inventory", "preferred-only,P", "Only consider the preferred stream group per station in inventory")
+        self.commandline().addStringOption("Inventory", "band-priority", "Band codes in order of priority (default: BHSM)")
+        self.commandline().addStringOption("Inventory", "location-priority", "Location codes in order of priority, '*' for any (default: '*')")
+        self.commandline().addStringOption("Inventory", "inventory-snapshot", "use a cached inventory snapshot in the specified directory")
         return True
 
     def validateParameters(self):
@@ -45,16 +51,42 @@ class App(seiscomp.client.Application):
         self.inventoryMode = self.commandline().hasOption("inventory")
         if not self.configMode and not self.inventoryMode:
             self.configMode = self.inventoryMode = True
+        self.preferredOnly = self.commandline().hasOption("preferred-only")
+        try:
+            self.bandPriority = self.commandline().optionString("band-priority")
+        except:
+            self.bandPriority = "BHSM"
+        try:
+            self.locationPriority = self.commandline().optionString("location-priority").split()
+        except:
+            self.locationPriority = ["*"]
+        try:
+            self.snapshotDir = self.commandline().optionString("inventory-snapshot")
+        except:
+            self.snapshotDir = None
+        if self.snapshotDir:
+            self.setLoadInventoryEnabled(False)
         return True
 
+    def inventoryStreams(self, time):
+        """
+        (net, sta, loc, cha) of all streams operational at the given time
+        """
+        if self.snapshotDir:
+            with scstuff.inventorysnapshot.openInventorySnapshot(self.query(), self.snapshotDir) as snapshot:
+                for epoch in snapshot.streams(time):
+                    yield epoch.network, epoch.station, epoch.location, epoch.stream
+        else:
+            inv = seiscomp.client.Inventory.Instance().inventory()
+            for network, station, location, stream in InventoryIterator(inv, time):
+                yield network.code(), station.code(), location.code(), stream.code()
+
     def run(self):
         # perhaps make this configurable
         now = seiscomp.core.Time.GMT()
 
-        inv = seiscomp.client.Inventory.Instance().inventory()
-        inv_streams = []
-        for network, station, location, stream in InventoryIterator(inv, now):
-            n, s, l, c = network.code(), station.code(), location.code(), stream.code()
+        inv_streams = set()
+        for n, s, l, c in self.inventoryStreams(now):
             if l=="":
                 l = "--"
             c = c[:2]
@@ -65,17 +97,21 @@ class App(seiscomp.client.Application):
             if c[0] not in "BMSH" or c[-1] != "H":
                 continue
 
-            if nslc not in inv_streams:
-                inv_streams.append(nslc)
+            inv_streams.add(nslc)
 
-        cfg_streams = configuredStreams(self.configModule(), self.name())
+        cfg_streams = set(configuredStreams(self.configModule(), self.name()))
 
-        # FIXME:
         # It is usually fine if there are more streams in the inventory than are configured for processing.
         # But we may only want to warn about streams in the inventory that are NOT configured for processing
         # IF there is no other stream for the same NS or NSL configured.
         # In other words: If AB.CDEF.00.BH is configured for processing then it usually doesn't matter that
-        # AB.CDEF.00.HH is not configured for processing.
+        # AB.CDEF.00.HH is not configured for processing. With --preferred-only we therefore only check
+        # the preferred stream group of each station.
+        if self.preferredOnly:
+            preferred_streams = set(selectStreams(
+                inv_streams, self.bandPriority, "H", self.locationPriority))
+        else:
+            preferred_streams = inv_streams
 
         lines = []
         if self.configMode:
@@ -84,7 +120,7 @@ class App(seiscomp.client.Application):
                     line = "%-2s %-5s %-2s %-2s configured but not found in inventory" % nslc
                     lines.append(line)
         if self.inventoryMode:
-            for nslc in inv_streams:
+            for nslc in preferred_streams:
                 if nslc not in cfg_streams:
                     line = "%-2s %-5s %-2s %-2s not configured but found in inventory" % nslc
                     lines.append(line)
@@ -22,6 +22,8 @@ import seiscomp.datamodel
 import seiscomp.logging
 from scstuff.inventory import InventoryIterator
 import scstuff.util
+import scstuff.inventory
+import scstuff.inventorysnapshot
 
 class App(seiscomp.client.Application):
 
@@ -36,6 +38,7 @@ class App(seiscomp.client.Application):
     def createCommandLineDescription(self):
         self.commandline().addGroup("Input")
         self.commandline().addStringOption("Input", "xml", "specify xml file")
+        self.commandline().addStringOption("Input", "inventory-snapshot", "use a cached inventory snapshot in the specified directory")
 
         self.commandline().addGroup("Filter")
         self.commandline().addOption(
@@ -75,6 +78,13 @@ class App(seiscomp.client.Application):
             self.setDatabaseEnabled(True, True)
             self.setLoadInventoryEnabled(True)
 
+        try:
+            self._snapshotDir = self.commandline().optionString("inventory-snapshot")
+        except:
+            self._snapshotDir = None
+        if self._snapshotDir and not self._xmlFile:
+            self.setLoadInventoryEnabled(False)
+
         try:
             self._time = self.commandline().optionString("time")
         except:
@@ -97,16 +107,7 @@ class App(seiscomp.client.Application):
         return True
 
     def readInventoryFromXML(self):
-        ar = seiscomp.io.XMLArchive()
-        if ar.open(self._xmlFile) == False:
-            raise IOError(self._xmlFile + ": unable to open")
-        obj = ar.readObject()
-        if obj is None:
-            raise TypeError(self._xmlFile + ": invalid format")
-        inv  = seiscomp.datamodel.Inventory.Cast(obj)
-        if inv is None:
-            raise TypeError(self._xmlFile + ": no inventory found")
-        return inv
+        return scstuff.inventory.readInventoryFromXML(self._xmlFile)
 
     def getConfiguredStreams(self):
         """
@@ -158,9 +159,15 @@ class App(seiscomp.client.Application):
         if self._xmlFile:
             inv = self.readInventoryFromXML()
         else:
-            # Access the global inventory instance which is
-            # automatically loaded.
-            inv = seiscomp.client.Inventory.Instance().inventory()
+            if self._snapshotDir:
+                # The inventory read from the snapshot remains valid
+                # after closing it.
+                with scstuff.inventorysnapshot.openInventorySnapshot(self.query(), self._snapshotDir) as snapshot:
+                    inv = snapshot.inventory()
+            else:
+                # Access the global inventory instance which is
+                # automatically loaded.
+                inv = seiscomp.client.Inventory.Instance().inventory()
 
             if self._configured_only:
                 configured = self.getConfiguredStreams()
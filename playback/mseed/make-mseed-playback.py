@@ -1,35 +1,59 @@
 #!/usr/bin/env seiscomp-python
 
-import sys, time
-import seiscomp.client, seiscomp.datamodel
+import sys, os, time, collections, hashlib, heapq, json, struct, tempfile, threading
+import concurrent.futures
+import seiscomp.client, seiscomp.datamodel, seiscomp.math, seiscomp.seismology
+import scstuff.inventory
 
 stream_whitelist = ["BH", "SH","HH"]
 component_whitelist = [] # set to ["Z"] for vertical component only
 network_blacklist = ["TE"]
 network_whitelist = [] # all except blacklist
 
+# Only one stream group is used per station. NOTE that the criteria
+# here are quite application dependent: If we have HH and BH streams
+# use only BH etc., but in other contexts HH would have priority over
+# BH. See scstuff.inventory.selectStreams()
+band_priority = "BHS"
+instrument_priority = "H"
+location_priority = ["*"]
+
 # seconds before and after origin time
 before, after = 1800, 1*3600+1800
 
-sort = True   # will produce sorted files with ".sorted-mseed" extension
-
-
-def filterStreams(streams):
-    # NOTE that the criteria here are quite application dependent:
-    # If we have HH and BH streams use only BH etc., but in other
-    # contexts HH would have priority over BH
-
-    filtered = []
-
-    for net, sta, loc, cha in streams:
-        if cha[:2] in [ "HH", "SH" ] and (net, sta, loc, "BH"+cha[-1]) in streams:
-            continue
-        filtered.append( (net, sta, loc, cha) )
-
-    return filtered
+# With event-adaptive time windows (--adaptive), the time window for
+# each station starts this many seconds before the theoretical P
+# arrival and ends this many seconds after the theoretical S arrival.
+# It never exceeds the above fixed time window.
+before_p, after_s = 300, 600
 
+sort = True   # will produce sorted files with ".sorted-mseed" extension
 
-def getCurrentStreams(dbr):
+# Maximum size of the raw records kept in memory while sorting. If
+# exceeded, the records are written to a sorted spill file.
+buffer_size = 512*1024*1024
+
+# Maximum number of spill files merged at the same time. If there are
+# more, they are merged in several passes via intermediate files to
+# stay well below the limit of open files.
+max_merge_files = 64
+
+# Events with overlapping time windows are fetched together as one
+# cluster. To bound the number of sorters sharing the buffer, a
+# cluster is closed once it has this many events or spans more than
+# this many seconds. The data of overlapping windows of two such
+# clusters are then fetched twice.
+max_cluster_events = 10
+max_cluster_span = 6*3600
+
+
+def getCurrentStreams(dbr, coordinates=None):
+    """
+    Returns the (net, sta, loc, cha) tuples of the currently
+    operational streams. If the dict 'coordinates' is specified, the
+    (lat, lon) tuples of the stations are stored in it with (net, sta)
+    as key.
+    """
     now = seiscomp.core.Time.GMT()
     inv = seiscomp.datamodel.Inventory()
     dbr.loadNetworks(inv)
@@ -58,6 +82,8 @@ def getCurrentStreams(dbr):
                 pass
 
             # now we know that this is an operational station
+            if coordinates is not None:
+                coordinates[network.code(), station.code()] = (station.latitude(), station.longitude())
 
             for iloc in range(station.sensorLocationCount()):
                 loc = station.sensorLocation(iloc)
@@ -69,7 +95,420 @@ def getCurrentStreams(dbr):
 
                     result.append( (network.code(), station.code(), loc.code(), stream.code()) )
 
-    return filterStreams(result)
+    return scstuff.inventory.selectStreams(
+        result, band_priority, instrument_priority, location_priority)
+
+
+def maximumDistance(magnitude):
+    """
+    Epicentral distance in degrees up to which stations are
+    considered for an event of the given magnitude, e.g. about
+    3 degrees for M3, 10 degrees for M4, 100 degrees for M6 and
+    all stations from M6.6.
+    """
+    return min(180., 10**(0.5*magnitude - 1))
+
+
+def stationTimeWindows(origin, magnitude, coordinates, maxDistance=None):
+    """
+    Compute the time window for each station based on the
+    theoretical P and S arrival times. Stations beyond the maximum
+    distance are omitted.
+
+    Returns a dict with (net, sta) as key and (t1, t2) as value.
+    """
+    ttt = seiscomp.seismology.TravelTimeTable()
+    ttt.setModel("iasp91")
+
+    if maxDistance is None:
+        maxDistance = maximumDistance(magnitude)
+    lat0 = origin.latitude().value()
+    lon0 = origin.longitude().value()
+    try:
+        depth = origin.depth().value()
+    except ValueError:
+        depth = 10.
+    t0 = origin.time().value()
+
+    windows = {}
+    for (net, sta), (lat, lon) in coordinates.items():
+        delta, az, baz = seiscomp.math.delazi(lat0, lon0, lat, lon)
+        if delta > maxDistance:
+            continue
+
+        # as in scstuff.ttt.py
+        arrivals = ttt.compute(0, 0, depth, 0, delta, 0, 0)
+        if not arrivals:
+            continue
+        tp = ts = None
+        for arr in arrivals:
+            if tp is None:
+                tp = arr.time
+            if arr.phase.startswith("S"):
+                ts = arr.time
+                break
+        if ts is None:
+            # no S phase e.g. in the core shadow
+            ts = tp
+
+        t1 = max(tp - before_p, -before)
+        t2 = min(ts + after_s, after)
+        windows[net, sta] = (t0 + seiscomp.core.TimeSpan(t1), t0 + seiscomp.core.TimeSpan(t2))
+    return windows
+
+
+def timeToFloat(t):
+    return t.seconds() + 1.e-6*t.microseconds()
+
+
+class RecordSorter:
+    """
+    External sort of raw MiniSEED records by record end time.
+
+    Records are collected in memory until either spill() is called
+    or the buffer size is exceeded. Then they are sorted and written
+    to a spill file. Finally write() performs a k-way merge of all
+    spill files, so that the memory consumption is bounded by the
+    buffer size, no matter how much data are sorted. At most
+    maxFiles spill files are opened at the same time; if there are
+    more, groups of them are first merged into intermediate files.
+
+    Records may be added from several threads, each of which has a
+    buffer of its own. The buffer size is shared among the threads.
+
+    The spill files are removed by write() or close(), whichever
+    comes first, and at the latest when the sorter is garbage
+    collected.
+    """
+
+    # end time, start time, sample count, stream ID length, record length
+    _header = struct.Struct("<ddIHI")
+
+    def __init__(self, tmpDir=None, bufferSize=buffer_size, threads=1, maxFiles=max_merge_files):
+        self._tmp = tempfile.TemporaryDirectory(prefix="make-mseed-playback-", dir=tmpDir)
+        self._dir = self._tmp.name
+        self._bufferSize = max(bufferSize // threads, 1)
+        self._maxFiles = max(maxFiles, 2)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._buffers = []
+        self._spillCount = 0
+        self._spillFiles = []
+
+    def _buffer(self):
+        local = self._local
+        if not hasattr(local, "records"):
+            local.records = []
+            local.bytes = 0
+            with self._lock:
+                self._buffers.append(local)
+        return local
+
+    def add(self, endTime, startTime, streamID, sampleCount, raw):
+        buf = self._buffer()
+        buf.records.append( (endTime, startTime, streamID, sampleCount, raw) )
+        buf.bytes += len(raw)
+        if buf.bytes >= self._bufferSize:
+            self.spill()
+
+    def spill(self):
+        """
+        Write the records buffered by the calling thread to a
+        sorted spill file.
+        """
+        buf = self._buffer()
+        if not buf.records:
+            return
+        buf.records.sort()
+        filename = self._writeSpill(buf.records)
+        with self._lock:
+            self._spillFiles.append(filename)
+        buf.records = []
+        buf.bytes = 0
+
+    def _writeSpill(self, records):
+        # write the sorted records to a new spill file
+        with self._lock:
+            filename = os.path.join(self._dir, "%06d.spill" % self._spillCount)
+            self._spillCount += 1
+        with open(filename, "wb") as f:
+            for endTime, startTime, streamID, sampleCount, raw in records:
+                streamID = streamID.encode()
+                f.write(self._header.pack(endTime, startTime, sampleCount, len(streamID), len(raw)))
+                f.write(streamID)
+                f.write(raw)
+        return filename
+
+    def _read(self, filename):
+        size = self._header.size
+        with open(filename, "rb") as f:
+            while True:
+                header = f.read(size)
+                if len(header) < size:
+                    break
+                endTime, startTime, sampleCount, idLength, length = self._header.unpack(header)
+                streamID = f.read(idLength).decode()
+                yield endTime, startTime, streamID, sampleCount, f.read(length)
+
+    def _reduceSpills(self):
+        # Merge groups of spill files into intermediate files until
+        # at most maxFiles are left.
+        files = self._spillFiles
+        while len(files) > self._maxFiles:
+            merged = []
+            for i in range(0, len(files), self._maxFiles):
+                group = files[i:i+self._maxFiles]
+                if len(group) == 1:
+                    merged.append(group[0])
+                    continue
+                merged.append(self._writeSpill(heapq.merge(*[ self._read(filename) for filename in group ])))
+                for filename in group:
+                    os.unlink(filename)
+            files = self._spillFiles = merged
+        return files
+
+    def write(self, out, dedup=None):
+        """
+        Merge all records into 'out' and remove the spill files.
+        Records rejected by the RecordDeduplicator 'dedup' are
+        skipped. Returns the number of records written.
+        """
+        count = 0
+        try:
+            self.spill()
+            spills = [ self._read(filename) for filename in self._reduceSpills() ]
+            for record in heapq.merge(*spills):
+                if dedup is not None and not dedup.accept(*record):
+                    continue
+                out.write(record[-1])
+                count += 1
+        finally:
+            self.close()
+        return count
+
+    def close(self):
+        """
+        Discard all buffered records and remove the spill files.
+        """
+        with self._lock:
+            for buf in self._buffers:
+                buf.records = []
+                buf.bytes = 0
+            self._spillFiles = []
+        self._tmp.cleanup()
+
+
+class RecordDeduplicator:
+    """
+    Removes duplicate and overlapping records from a sequence of
+    records sorted by end time.
+
+    Unfortunately duplicates do happen sometimes, and not only
+    adjacent to each other. Duplicates are identified by stream ID,
+    start time, sample count and a hash of the record content after
+    the fixed header, which excludes e.g. the sequence number. As
+    duplicates have the same end time, only the keys of the current
+    end time need to be remembered.
+
+    In addition, a record that lies entirely within the time span
+    already covered by previous records of the same stream is removed
+    as overlap. As the records arrive in end time order, this is the
+    contiguous span ending at the latest end time seen for the stream.
+    Partial overlaps cannot be resolved without decoding and
+    re-packing the data and are only counted. Time comparisons use a
+    tolerance of half a sample interval, so that contiguous records
+    are not mistaken for overlapping ones.
+    """
+
+    def __init__(self):
+        self._endTime = None
+        self._keys = set()
+        self._covered = {}  # stream ID -> (start, end) of the covered span
+        self.duplicates = {}
+        self.overlaps = {}
+        self.partialOverlaps = {}
+
+    def _count(self, counter, streamID):
+        counter[streamID] = counter.get(streamID, 0) + 1
+
+    def accept(self, endTime, startTime, streamID, sampleCount, raw):
+        if endTime != self._endTime:
+            self._endTime = endTime
+            self._keys.clear()
+
+        key = (streamID, startTime, sampleCount, hashlib.md5(raw[48:]).digest())
+        if key in self._keys:
+            self._count(self.duplicates, streamID)
+            return False
+        self._keys.add(key)
+
+        # half a sample interval
+        tolerance = 0.5 * (endTime - startTime) / sampleCount if sampleCount > 0 else 0.
+
+        covered = self._covered.get(streamID)
+        if covered is None or startTime > covered[1] + tolerance:
+            # first record or gap
+            self._covered[streamID] = (startTime, endTime)
+            return True
+
+        coveredStart, coveredEnd = covered
+        if startTime >= coveredStart - tolerance and endTime <= coveredEnd + tolerance:
+            self._count(self.overlaps, streamID)
+            return False
+        if startTime < coveredEnd - tolerance:
+            self._count(self.partialOverlaps, streamID)
+        self._covered[streamID] = (min(startTime, coveredStart), max(endTime, coveredEnd))
+        return True
+
+    def report(self, out):
+        streamIDs = set(self.duplicates) | set(self.overlaps) | set(self.partialOverlaps)
+        for streamID in sorted(streamIDs):
+            out.write("%-15s %6d duplicates %6d overlaps removed %6d partial overlaps kept\n" % (
+                streamID, self.duplicates.get(streamID, 0),
+                self.overlaps.get(streamID, 0), self.partialOverlaps.get(streamID, 0)))
+        out.write("%d duplicates and %d overlapping records removed, %d partial overlaps kept\n" % (
+            sum(self.duplicates.values()), sum(self.overlaps.values()),
+            sum(self.partialOverlaps.values())))
+
+
+class FetchProgress:
+    """
+    Accounting of the data fetched for one network
+    """
+
+    def __init__(self, network, streamCount):
+        self.network = network
+        self.streamCount = streamCount
+        self.records = 0
+        self.bytes = 0
+        self.attempts = 0
+        self.seconds = 0.
+
+    def __str__(self):
+        return "%-2s %5d streams %8d records %12d bytes %3d attempt(s) %8.1f s" % (
+            self.network, self.streamCount, self.records, self.bytes,
+            self.attempts, self.seconds)
+
+
+class EventDump:
+    """
+    Time windows and output of one event
+    """
+
+    def __init__(self, eventID, origin, magnitude):
+        self.eventID = eventID
+        self.origin = origin
+        self.magnitude = magnitude
+        # time window per station, (net, sta) -> (t1, t2)
+        self.windows = {}
+        self.sorter = None
+        self.out = None
+        self.lock = threading.Lock()
+        self.records = 0
+        self.dedup = None
+        if sort:
+            self.filename = "%s-M%3.1f.sorted-mseed" % (eventID, magnitude)
+        else:
+            self.filename = "%s-M%3.1f.unsorted-mseed" % (eventID, magnitude)
+
+    def close(self):
+        """
+        Release the sorter and output file if still open, e.g. if the
+        dump was interrupted.
+        """
+        if self.sorter is not None:
+            self.sorter.close()
+            self.sorter = None
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+    def timeSpan(self):
+        t1 = min(t1 for t1, t2 in self.windows.values())
+        t2 = max(t2 for t1, t2 in self.windows.values())
+        return t1, t2
+
+    def writeManifest(self, streams):
+        manifest = {
+            "event": self.eventID,
+            "origin": self.origin.publicID(),
+            "time": self.origin.time().value().toString("%FT%T.%fZ"),
+            "latitude": self.origin.latitude().value(),
+            "longitude": self.origin.longitude().value(),
+            "magnitude": self.magnitude,
+            "file": self.filename,
+            "records": self.records,
+            "streams": [
+                { "stream": "%s.%s.%s.%s" % (net, sta, loc, cha),
+                  "start": self.windows[net, sta][0].toString("%FT%T.%fZ"),
+                  "end": self.windows[net, sta][1].toString("%FT%T.%fZ") }
+                for net, sta, loc, cha in streams if (net, sta) in self.windows ]
+        }
+        if self.dedup is not None:
+            manifest["duplicates"] = sum(self.dedup.duplicates.values())
+            manifest["overlaps"] = sum(self.dedup.overlaps.values())
+            manifest["partialOverlaps"] = sum(self.dedup.partialOverlaps.values())
+        with open(self.filename + ".manifest", "w") as f:
+            json.dump(manifest, f, indent=1)
+
+
+def eventClusters(events, maxEvents=max_cluster_events, maxSpan=max_cluster_span):
+    """
+    Group the events into clusters of events with overlapping time
+    spans. The data for a cluster are fetched only once. A cluster
+    has at most maxEvents events and spans at most maxSpan seconds
+    unless a single event spans more.
+    """
+    cluster = []
+    clusterStart = clusterEnd = None
+    for event in sorted(events, key=lambda event: event.timeSpan()[0]):
+        t1, t2 = event.timeSpan()
+        if cluster and (t1 > clusterEnd or len(cluster) >= maxEvents or
+                        timeToFloat(max(t2, clusterEnd)) - timeToFloat(clusterStart) > maxSpan):
+            yield cluster
+            cluster = []
+        if not cluster:
+            clusterStart, clusterEnd = t1, t2
+        elif t2 > clusterEnd:
+            clusterEnd = t2
+        cluster.append(event)
+    if cluster:
+        yield cluster
+
+
+class ClusterDump:
+    """
+    The data fetched for one cluster of events
+    """
+
+    def __init__(self, events):
+        self.events = events
+        # (net, sta) -> [ (event, t1, t2), ... ]
+        self.routes = {}
+        self.progress = []
+        self.futures = []
+        self.cancelled = False
+
+    def close(self):
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+        for event in self.events:
+            event.close()
+
+
+def mergeTimeWindows(windows):
+    """
+    Merge a list of overlapping (t1, t2) time windows
+    """
+    merged = []
+    for t1, t2 in sorted(windows, key=lambda w: timeToFloat(w[0])):
+        if merged and t1 <= merged[-1][1]:
+            if t2 > merged[-1][1]:
+                merged[-1] = (merged[-1][0], t2)
+            continue
+        merged.append( (t1, t2) )
+    return merged
 
 
 class DumperApp(seiscomp.client.Application):
@@ -93,43 +532,156 @@ class DumperApp(seiscomp.client.Application):
         try:
             self.commandline().addGroup("Dump")
             self.commandline().addStringOption("Dump", "event,E", "ID of event to dump")
+            self.commandline().addStringOption("Dump", "event-list", "file containing IDs of events to dump, one per line")
             self.commandline().addOption("Dump", "unsorted,U", "produce unsorted output (not suitable for direct playback!)")
+            self.commandline().addStringOption("Dump", "buffer-size", "memory used for sorting in MB (default: 512)")
+            self.commandline().addStringOption("Dump", "tmp-dir", "directory for temporary spill files")
+            self.commandline().addStringOption("Dump", "connections", "number of concurrent RecordStream connections, one per network (default: 1)")
+            self.commandline().addStringOption("Dump", "attempts", "number of attempts per network in case of connection problems (default: 1)")
+            self.commandline().addOption("Dump", "adaptive", "use time windows based on theoretical P and S arrivals and a magnitude dependent maximum distance")
+            self.commandline().addStringOption("Dump", "max-distance", "with --adaptive, override the magnitude dependent maximum distance in degrees")
+            self.commandline().addStringOption("Dump", "dedup-report", "write the report of removed duplicate and overlapping records to this file instead of stderr")
+            self.commandline().addStringOption("Dump", "parallel-clusters", "number of clusters of overlapping events fetched concurrently (default: 2)")
+            self.commandline().addStringOption("Dump", "max-cluster-events", "maximum number of events fetched together as one cluster (default: %d)" % max_cluster_events)
         except:
             seiscomp.logging.warning("caught unexpected error %s" % sys.exc_info())
 
-    def get_and_write_data(self, t1, t2, out):
-        dbr = seiscomp.datamodel.DatabaseReader(self.database())
-        streams = getCurrentStreams(dbr)
-
-        # split all streams into groups of same net
-        netsta_streams = {}
-        for net, sta, loc, cha in streams:
-            netsta = net
-            if not netsta in netsta_streams:
-                netsta_streams[netsta] = []
-            netsta_streams[netsta].append( (net, sta, loc, cha) )
-
-        data = []
-        netsta_keys = [key for key in netsta_streams.keys()]
-        for netsta in sorted(netsta_keys):
-
-            # experts only:
-            # increase in case of connection problems, normally not needed
-            number_of_attempts = 1
-
-            for attempt in range(number_of_attempts):
-                if self.isExitRequested(): return
-
-                stream = seiscomp.io.RecordStream.Open(self.recordStreamURL())
-                stream.setTimeout(3600)
-                for net, sta, loc, cha in netsta_streams[netsta]:
-                    if component_whitelist and cha[-1] not in component_whitelist:
-                        continue
-                    stream.addStream(net, sta, loc, cha, t1, t2)
+    def dump(self, events):
+        """
+        Start fetching the data for a cluster of events with
+        overlapping time windows. The data for overlapping time
+        windows are fetched only once and distributed to the events.
+        The fetching is done by the fetch pool, concurrently with
+        other clusters. Returns the ClusterDump to be passed to
+        collect().
+        """
+        job = ClusterDump(events)
+        try:
+            bufferSize = self._bufferSize // self._parallelClusters // len(events)
+            for event in events:
+                if sort:
+                    event.sorter = RecordSorter(self._tmpDir, bufferSize, self._connections)
+                else:
+                    event.out = open(event.filename, "wb")
+                for key, (t1, t2) in event.windows.items():
+                    job.routes.setdefault(key, []).append(
+                        (event, timeToFloat(t1), timeToFloat(t2)) )
+
+            # split all streams into groups of same net
+            netsta_streams = {}
+            for net, sta, loc, cha in self._streams:
+                if (net, sta) not in job.routes:
+                    continue
+                netsta = net
+                if not netsta in netsta_streams:
+                    netsta_streams[netsta] = []
+                windows = mergeTimeWindows([ event.windows[net, sta] for event, t1, t2 in job.routes[net, sta] ])
+                for t1, t2 in windows:
+                    netsta_streams[netsta].append( (net, sta, loc, cha, t1, t2) )
+
+            for netsta in sorted(netsta_streams.keys()):
+                item = FetchProgress(netsta, len(netsta_streams[netsta]))
+                job.progress.append(item)
+                job.futures.append(self._fetchPool.submit(
+                    self._fetch, job, netsta_streams[netsta], item))
+        except:
+            job.close()
+            raise
+        return job
+
+    def collect(self, job):
+        """
+        Wait until the data for a cluster are fetched and hand the
+        events over to the writer pool, which finalizes them in the
+        background.
+        """
+        finishing = False
+        try:
+            for future in job.futures:
+                future.result()
+
+            for item in job.progress:
+                seiscomp.logging.info(str(item))
+            sys.stderr.write("Read %d records in total for %s\n" % (
+                sum(item.records for item in job.progress),
+                " ".join(event.eventID for event in job.events)))
+
+            if self.isExitRequested(): return
+
+            for event in job.events:
+                self._writers.append(self._writerPool.submit(self._finish, event))
+            finishing = True
+        finally:
+            # don't leave spill files behind on early exit or error
+            if not finishing:
+                job.close()
+
+    def _finish(self, event):
+        if self.isExitRequested():
+            event.close()
+            return
+        if sort:
+            # finally write sorted data and ensure uniqueness
+            event.dedup = RecordDeduplicator()
+            try:
+                with open(event.filename, "wb") as out:
+                    event.records = event.sorter.write(out, event.dedup)
+            finally:
+                event.close()
+            with self._reportLock:
+                f = self._dedupReportFile or sys.stderr
+                f.write("# %s\n" % event.eventID)
+                event.dedup.report(f)
+        else:
+            event.close()
+        event.writeManifest(self._streams)
+        sys.stderr.write("Wrote %d records for event %s to %s\n" % (event.records, event.eventID, event.filename))
+
+    def _write(self, job, raw, rec):
+        # route the record to all events with an overlapping time window
+        endTime = timeToFloat(rec.endTime())
+        startTime = timeToFloat(rec.startTime())
+        for event, t1, t2 in job.routes.get((rec.networkCode(), rec.stationCode()), []):
+            if startTime >= t2 or endTime <= t1:
+                continue
+            if sort:
+                event.sorter.add(endTime, startTime, rec.streamID(), rec.sampleCount(), raw)
+            else:
+                with event.lock:
+                    event.out.write(raw)
+                    event.records += 1
+
+    def _wait(self, seconds):
+        # sleep but don't delay the exit if requested
+        end = time.time() + seconds
+        while time.time() < end:
+            if self.isExitRequested(): return
+            time.sleep(min(0.5, end - time.time()))
+
+    def _fetch(self, job, streams, progress):
+        """
+        Fetch the data for the streams of one network using a
+        RecordStream connection of its own. If nothing could be
+        read, retry with exponential backoff.
+
+        Runs in a worker thread.
+        """
+        startTime = time.time()
+        for attempt in range(self._attempts):
+            if self.isExitRequested() or job.cancelled: return
+            progress.attempts += 1
+
+            stream = seiscomp.io.RecordStream.Open(self.recordStreamURL())
+            stream.setTimeout(3600)
+            for net, sta, loc, cha, t1, t2 in streams:
+                if component_whitelist and cha[-1] not in component_whitelist:
+                    continue
+                stream.addStream(net, sta, loc, cha, t1, t2)
 
-                count = 0
-                input = seiscomp.io.RecordInput(stream, seiscomp.core.Array.INT, seiscomp.core.Record.SAVE_RAW)
+            input = seiscomp.io.RecordInput(stream, seiscomp.core.Array.INT, seiscomp.core.Record.SAVE_RAW)
+            try:
                 while 1:
+                    if self.isExitRequested() or job.cancelled: return
                     try:
                         rec = input.next()
                     except:
@@ -137,34 +689,27 @@ class DumperApp(seiscomp.client.Application):
                     if not rec:
                         break
 
-                    count += 1
-                    if sort:
-                        data.append( (rec.endTime(), rec.raw().str()) )
-                    else:
-                        out.write("%s" % rec.raw().str())
+                    raw = rec.raw().str()
+                    progress.records += 1
+                    progress.bytes += len(raw)
+                    self._write(job, raw, rec)
+            finally:
+                stream.close()
 
-                sys.stderr.write("Read %d records for %d streams\n" % (count, len(netsta_streams[netsta])))
-                if count > 0 or attempt+1 == number_of_attempts:
-                    break
-                if self.isExitRequested(): return
-                sys.stderr.write("Trying again\n")
-                time.sleep(5)
+            sys.stderr.write("Read %d records for %d streams of network %s\n" % (progress.records, len(streams), progress.network))
+            if progress.records > 0 or attempt+1 == self._attempts:
+                break
+            delay = min(5 * 2**attempt, 300)
+            sys.stderr.write("Trying again network %s in %d s\n" % (progress.network, delay))
+            self._wait(delay)
 
         if sort:
-            data.sort()
+            # one sorted spill file per network and event
+            for event in job.events:
+                event.sorter.spill()
+        progress.seconds = time.time() - startTime
 
-        if sort:
-            # finally write sorted data and ensure uniqueness
-            previous = None
-            for endTime, raw in data:
-                if previous is not None and raw[6:] == previous[6:]:
-                    # unfortunately duplicates do happen sometimes
-                    continue
-                out.write(raw)
-                previous = raw
-
-
-    def dump(self, eventID):
+    def loadEvent(self, eventID, coordinates):
         seiscomp.logging.debug("Working on " + eventID)
         self._dbq = self.query()
         evt = self._dbq.loadObject(seiscomp.datamodel.Event.TypeInfo(), eventID)
@@ -175,33 +720,125 @@ class DumperApp(seiscomp.client.Application):
         originID = evt.preferredOriginID()
         org = self._dbq.loadObject(seiscomp.datamodel.Origin.TypeInfo(), originID) 
         org = seiscomp.datamodel.Origin.Cast(org)
+        if org is None:
+            raise ValueError("preferred origin '%s' not found" % originID)
 
         magID = evt.preferredMagnitudeID()
         mag = self._dbq.loadObject(seiscomp.datamodel.Magnitude.TypeInfo(), magID)
         mag = seiscomp.datamodel.Magnitude.Cast(mag)
+        if mag is None:
+            raise ValueError("preferred magnitude '%s' not found" % magID)
 
-        now = seiscomp.core.Time.GMT()
- 
         val = mag.magnitude().value()
-        if sort:
-            out = "%s-M%3.1f.sorted-mseed" % (eventID, val)
-        else:
-            out = "%s-M%3.1f.unsorted-mseed" % (eventID, val)
-        out = open(out, "wb")
-
-        t0 = org.time().value()
-        t1, t2 = t0 + seiscomp.core.TimeSpan(-before), t0 + seiscomp.core.TimeSpan(after)
+        event = EventDump(eventID, org, val)
 
-        self.get_and_write_data(t1, t2, out)
-        return True
+        if self._adaptive:
+            event.windows = stationTimeWindows(org, val, coordinates, self._maxDistance)
+            seiscomp.logging.info("%s: using %d of %d stations" % (eventID, len(event.windows), len(coordinates)))
+        else:
+            t0 = org.time().value()
+            t1, t2 = t0 + seiscomp.core.TimeSpan(-before), t0 + seiscomp.core.TimeSpan(after)
+            event.windows = dict( (key, (t1, t2)) for key in coordinates )
+        return event
 
 
     def run(self):
+        global sort
         if self.commandline().hasOption("unsorted"):
             sort = False
 
-        evid = self.commandline().optionString("event")
-        return self.dump(evid)
+        try:
+            self._bufferSize = int(float(self.commandline().optionString("buffer-size"))*1024*1024)
+        except:
+            self._bufferSize = buffer_size
+
+        try:
+            self._tmpDir = self.commandline().optionString("tmp-dir")
+        except:
+            self._tmpDir = None
+
+        self._adaptive = self.commandline().hasOption("adaptive")
+        try:
+            self._maxDistance = float(self.commandline().optionString("max-distance"))
+        except:
+            self._maxDistance = None
+
+        try:
+            self._dedupReport = self.commandline().optionString("dedup-report")
+        except:
+            self._dedupReport = None
+
+        try:
+            self._connections = max(int(self.commandline().optionString("connections")), 1)
+        except:
+            self._connections = 1
+
+        try:
+            self._attempts = max(int(self.commandline().optionString("attempts")), 1)
+        except:
+            self._attempts = 1
+
+        try:
+            self._parallelClusters = max(int(self.commandline().optionString("parallel-clusters")), 1)
+        except:
+            self._parallelClusters = 2
+
+        try:
+            self._maxClusterEvents = max(int(self.commandline().optionString("max-cluster-events")), 1)
+        except:
+            self._maxClusterEvents = max_cluster_events
+
+        if self.commandline().hasOption("event-list"):
+            with open(self.commandline().optionString("event-list")) as f:
+                eventIDs = [ line.strip() for line in f if line.strip() and line[0] != "#" ]
+        else:
+            eventIDs = [ self.commandline().optionString("event") ]
+
+        # The inventory is loaded only once for all events.
+        dbr = seiscomp.datamodel.DatabaseReader(self.database())
+        coordinates = {}
+        self._streams = getCurrentStreams(dbr, coordinates)
+
+        events = []
+        for eventID in eventIDs:
+            try:
+                event = self.loadEvent(eventID, coordinates)
+            except (TypeError, ValueError) as e:
+                if len(eventIDs) == 1:
+                    raise
+                seiscomp.logging.error("%s: %s" % (eventID, str(e)))
+                continue
+            if event.windows:
+                events.append(event)
+
+        self._reportLock = threading.Lock()
+        self._dedupReportFile = open(self._dedupReport, "w") if self._dedupReport else None
+        self._writers = []
+        active = collections.deque()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self._connections) as self._fetchPool, \
+                 concurrent.futures.ThreadPoolExecutor(self._connections) as self._writerPool:
+                try:
+                    # Up to --parallel-clusters clusters are fetched
+                    # concurrently, sharing the --connections.
+                    for cluster in eventClusters(events, self._maxClusterEvents):
+                        if self.isExitRequested(): break
+                        if len(active) >= self._parallelClusters:
+                            self.collect(active.popleft())
+                        seiscomp.logging.info("fetching data for %d event(s): %s" % (
+                            len(cluster), " ".join(event.eventID for event in cluster)))
+                        active.append(self.dump(cluster))
+                    while active:
+                        self.collect(active.popleft())
+                finally:
+                    for job in active:
+                        job.close()
+                for future in self._writers:
+                    future.result()
+        finally:
+            if self._dedupReportFile:
+                self._dedupReportFile.close()
+        return True
 
 
 def main():
@@ -0,0 +1,114 @@
+#!/usr/bin/env seiscomp-python
+# -*- coding: utf-8 -*-
+###########################################################################
+# Copyright (C) GFZ Potsdam                                               #
+# All rights reserved.                                                    #
+#                                                                         #
+# Author: Joachim Saul (saul@gfz-potsdam.de)                              #
+#                                                                         #
+# GNU Affero General Public License Usage                                 #
+# This file may be used under the terms of the GNU Affero                 #
+# Public License version 3.0 as published by the Free Software Foundation #
+# and appearing in the file LICENSE included in the packaging of this     #
+# file. Please review the following information to ensure the GNU Affero  #
+# Public License version 3.0 requirements will be met:                    #
+# https://www.gnu.org/licenses/agpl-3.0.html.                             #
+###########################################################################
+
+
+import sys
+import hashlib
+import optparse
+import seiscomp.core
+import seiscomp.datamodel
+from scstuff.notifierlog import readNotifierLog, notifierMessageFromXML, objectToXML, compact, messages
+
+description="%prog - compact notifiers from log based on start and end time"
+
+p = optparse.OptionParser(usage="%prog --start-time t2 --end-time t2 files >", description=description)
+p.add_option("-s", "--start-time", action="store", help="specify start time")
+p.add_option("-e", "--end-time", action="store", help="specify end time")
+p.add_option("-n", "--max-notifiers", action="store", type="int", default=100, help="maximum number of notifiers per message (default: 100)")
+p.add_option("--verify", action="store_true", help="verify that replaying the compacted notifiers results in the same state as replaying the original ones")
+p.add_option("-v", "--verbose", action="store_true", help="run in verbose mode")
+
+(opt, filenames) = p.parse_args()
+
+
+def replay(xmls):
+    """
+    Apply the notifier messages given as XML to an empty
+    EventParameters instance and return the resulting state as XML.
+    """
+    ep = seiscomp.datamodel.EventParameters()
+    for xml in xmls:
+        nmsg = notifierMessageFromXML(xml)
+        for item in nmsg:
+            n = seiscomp.datamodel.Notifier.Cast(item)
+            n.apply()
+        del nmsg
+    state = objectToXML(ep)
+    del ep
+    return state
+
+
+def parseTime(s):
+    for fmtstr in "%FT%TZ", "%FT%T.%fZ":
+        t = seiscomp.core.Time.GMT()
+        if t.fromString(s, fmtstr):
+            return t
+    raise ValueError("could not parse time string '%s'" %s)
+
+
+def main():
+    startTime = parseTime(opt.start_time) if opt.start_time else None
+    endTime   = parseTime(opt.end_time) if opt.end_time else None
+
+    def original():
+        for filename in filenames:
+            if opt.verbose:
+                print("working on input file '%s'" % filename, file=sys.stderr)
+            for time, header, xml in readNotifierLog(filename, startTime, endTime):
+                yield time, xml
+
+    count = 0
+    def parsed():
+        nonlocal count
+        for time, xml in original():
+            nmsg = notifierMessageFromXML(xml)
+            count += nmsg.size()
+            yield time, nmsg
+
+    # The same publicID occurs in many notifier messages, which
+    # therefore must not be registered while compacting.
+    seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False)
+    entries = compact(parsed())
+    if opt.verbose:
+        print("compacted %d notifiers into %d" % (count, len(entries)), file=sys.stderr)
+
+    compacted = []
+    for time, nmsg in messages(entries, opt.max_notifiers):
+        xml = objectToXML(nmsg)
+        h = hashlib.md5(xml.encode()).hexdigest()
+        timestamp = time.toString("%Y-%m-%dT%H:%M:%S.%f000000")[:26]+"Z"
+        print("####  %s  %s  %d bytes" % (timestamp, h, len(xml)))
+        print(xml)
+        if opt.verify:
+            compacted.append(xml)
+    del entries
+
+    if opt.verify:
+        seiscomp.datamodel.PublicObject.SetRegistrationEnabled(True)
+        expected = replay(xml for time, xml in original())
+        result = replay(compacted)
+        if result != expected:
+            print("verification FAILED: final states differ", file=sys.stderr)
+            return 1
+        if opt.verbose:
+            print("verification passed", file=sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,6 +18,8 @@
 import sys
 import os
 import gc
+import time
+import collections
 import hashlib
 import logging
 import logging.handlers
@@ -25,6 +27,7 @@ import seiscomp.client
 import seiscomp.datamodel
 import seiscomp.io
 import seiscomp.logging
+import scstuff.notifierlog
 from io import BytesIO
 
 
@@ -65,20 +68,6 @@ def objectToXML(obj, expName = "trunk"):
     return None
 
 
-def objectToXML_workaround(obj, formatted=True):
-    # This is a workaround that requires writing to a temporary file
-    ar = seiscomp.io.XMLArchive()
-    ar.setFormattedOutput(formatted)
-    # before we write to /tmp we try to write to ramdisk /dev/shm
-    for tempdir in ["/dev/shm", "/tmp"]:
-        tempfile = os.path.join(tempdir, "notifier-logger.xml")
-        if ar.create(tempfile):
-            ar.writeObject(obj)
-            ar.close()
-            xml = open(tempfile).read().strip()
-            return xml
-
-
 class MyLogHandler(logging.handlers.TimedRotatingFileHandler):
 
     def __init__(self, filename, **kwargs):
@@ -108,10 +97,17 @@ class NotifierLogger(seiscomp.client.Application):
         seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False) 
         self._logger = logging.getLogger("Rotating Log")
         self._logger.setLevel(logging.INFO)
+        # hashes of the recently logged notifier messages
+        self._recentHashes = collections.OrderedDict()
+        self._dedupWindow = 60.
+        self._dedupReference = False
+        self._duplicateCount = 0
 
     def createCommandLineDescription(self):
         self.commandline().addGroup("Output")
         self.commandline().addStringOption("Output", "prefix", "path/file prefix to generate output file names")
+        self.commandline().addStringOption("Output", "dedup-window", "skip notifier messages identical to one logged within this many seconds (default: 60, 0 disables)")
+        self.commandline().addOption("Output", "dedup-reference", "for skipped duplicates write a header line referring to the hash instead of nothing")
         return True
 
     def validateParameters(self):
@@ -121,21 +117,53 @@ class NotifierLogger(seiscomp.client.Application):
             self._prefix = self.commandline().optionString("prefix")
         except:
             self._prefix = "notifier-log"
+        try:
+            self._dedupWindow = float(self.commandline().optionString("dedup-window"))
+        except:
+            pass
+        self._dedupReference = self.commandline().hasOption("dedup-reference")
         handler = MyLogHandler(self._prefix, when="h", interval=1, backupCount=48)
         self._logger.addHandler(handler)
         return True
 
+    def _isDuplicate(self, h):
+        # If we receive notifiers from several scmaster instances,
+        # we get the same notifier message more than once, usually
+        # within a few seconds.
+        if self._dedupWindow <= 0:
+            return False
+        t = time.monotonic()
+        while self._recentHashes:
+            oldest = next(iter(self._recentHashes.values()))
+            if oldest > t - self._dedupWindow:
+                break
+            self._recentHashes.popitem(last=False)
+        if h in self._recentHashes:
+            return True
+        self._recentHashes[h] = t
+        return False
+
     def _writeNotifier(self, xml):
         now = seiscomp.core.Time.GMT().toString("%Y-%m-%dT%H:%M:%S.%f000000")[:26]+"Z"
         h = hashlib.md5(xml.encode()).hexdigest()
+        if self._isDuplicate(h):
+            self._duplicateCount += 1
+            seiscomp.logging.debug("skipping duplicate notifier message %s" % h)
+            if self._dedupReference:
+                self._logger.info("####  %s  %s  duplicate" % (now, h))
+            return
         self._logger.info("####  %s  %s  %d bytes" % (now, h, len(xml)))
         self._logger.info(xml)
         gc.collect()
 
+    def done(self):
+        seiscomp.logging.info("skipped %d duplicate notifier messages" % self._duplicateCount)
+        seiscomp.client.Application.done(self)
+
     def handleMessage(self, msg):
         nmsg = seiscomp.datamodel.NotifierMessage.Cast(msg)
         if nmsg:
-            xml = objectToXML_workaround(nmsg)
+            xml = scstuff.notifierlog.objectToXML(nmsg)
             if xml:
                 self._writeNotifier(xml)
 
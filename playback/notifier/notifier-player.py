@@ -16,60 +16,83 @@
 ###########################################################################
 
 import sys, os
+import collections
+import glob
+import concurrent.futures
+import multiprocessing
 import seiscomp.core
 import seiscomp.client
 import seiscomp.datamodel
 import seiscomp.io
 import seiscomp.logging
-import seiscomp.utils
+import scstuff.util
+from scstuff.notifierlog import readNotifierLog, notifierMessageFromXML
 
 
-def notifierMessageFromXML(xml):
-    b = seiscomp.utils.stringToStreambuf(xml)
-    ar = seiscomp.io.XMLArchive(b)
-    obj = ar.readObject()
-    if obj is None:
-        raise TypeError("got invalid xml")
-    nmsg = seiscomp.datamodel.NotifierMessage.Cast(obj)
+def notifierInput(filename):
+    for time, header, xml in readNotifierLog(filename):
+        yield time, notifierMessageFromXML(xml)
+
+
+# The XML parsing dominates the replay time of large notifier logs.
+# The following functions allow to move the parsing into a pool of
+# worker processes. Each worker parses one notifier message and
+# serializes it into a BinaryArchive on a RAM disk, which is a lot
+# cheaper to read back than the XML.
+
+def notifierMessageXMLToBinary(xml):
+    """
+    Parse the XML of a notifier message and write it to a temporary
+    BinaryArchive. Returns the name of the temporary file.
+
+    This is the task performed by the worker processes.
+    """
+    return scstuff.util.writeObjectToTempFile(notifierMessageFromXML(xml), "notifier-player-")
+
+def notifierMessageFromBinary(filename):
+    """
+    Read a notifier message from a temporary BinaryArchive written
+    by notifierMessageXMLToBinary() and remove the file.
+    """
+    nmsg = seiscomp.datamodel.NotifierMessage.Cast(scstuff.util.readObjectFromTempFile(filename))
     if nmsg is None:
         raise TypeError("no NotifierMessage object found")
     return nmsg
 
-def notifierInput(filename):
-    f = open(filename)
-    while True:
-        while True:
-            line = f.readline()
-            if not line:
-                # empty input
-                return True
-            line = line.strip()
-            if not line:
-                # blank line
-                continue
-            if line[0] == "#":
-                break
+def parallelNotifierInput(entries, workers=4, lookahead=100):
+    """
+    Pipelined variant of notifierInput().
 
-        if len(line.split()) == 3:
-            sharp, timestamp, nbytes = line.split()
-        elif len(line.split()) == 4:
-            sharp, timestamp, nbytes, sbytes = line.split()
-            assert sbytes == "bytes"
-        elif len(line.split()) == 5:
-            sharp, timestamp, md5hash, nbytes, sbytes = line.split()
-            assert sbytes == "bytes"
-        else:
-            break
+    'entries' is an iterable of (time, xml) tuples, e.g. from
+    readNotifierLog(). The XML is parsed by 'workers' processes
+    while at most 'lookahead' entries are kept in flight, so that the
+    memory consumption remains flat regardless of the log size. The
+    (time, NotifierMessage) tuples are yielded in the order of the
+    input, i.e. in strict timestamp order.
+    """
+    # We explicitly fork as the workers need nothing but the
+    # already imported SeisComP modules.
+    context = multiprocessing.get_context("fork")
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as executor:
+        try:
+            for time, xml in entries:
+                pending.append((time, executor.submit(notifierMessageXMLToBinary, xml)))
+                if len(pending) < lookahead:
+                    continue
+                time, future = pending.popleft()
+                yield time, notifierMessageFromBinary(future.result())
 
-        assert sharp[0] == "#"
-        time = seiscomp.core.Time.GMT()
-        time.fromString(timestamp, "%FT%T.%fZ")
-
-        nbytes = int(nbytes)
-        assert sharp[0] == "#"
-        xml = f.read(nbytes).strip()
-
-        yield time, notifierMessageFromXML(xml)
+            while pending:
+                time, future = pending.popleft()
+                yield time, notifierMessageFromBinary(future.result())
+        finally:
+            # Don't leave any temporary files behind if we stop early.
+            for time, future in pending:
+                future.cancel()
+            for time, future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    os.unlink(future.result())
 
 
 class NotifierPlayer(seiscomp.client.Application):
@@ -81,14 +104,26 @@ class NotifierPlayer(seiscomp.client.Application):
         self._startTime = self._endTime = None
         self.xmlInputFileName = None
         self._time = None
+        self._workers = 0
+        self._lookahead = 100
+        self._ep = None
+        self._checkpointDir = None
+        self._checkpointInterval = None
+        self._checkpointTime = None
+        self._nextCheckpoint = None
 
     def createCommandLineDescription(self):
         super(NotifierPlayer, self).createCommandLineDescription()
         self.commandline().addGroup("Play")
         self.commandline().addStringOption("Play", "begin", "specify start of time window")
         self.commandline().addStringOption("Play", "end", "specify end of time window")
+        self.commandline().addGroup("Checkpoints")
+        self.commandline().addStringOption("Checkpoints", "checkpoint-dir", "directory of the checkpoints to start the replay from and/or to write")
+        self.commandline().addStringOption("Checkpoints", "checkpoint-interval", "write a checkpoint every this many seconds, e.g. 3600")
         self.commandline().addGroup("Input")
         self.commandline().addStringOption("Input", "xml-file", "specify xml file")
+        self.commandline().addStringOption("Input", "workers", "number of processes used to parse the XML in parallel (default: 0, i.e. no parallel parsing)")
+        self.commandline().addStringOption("Input", "look-ahead", "maximum number of notifier messages parsed ahead (default: 100)")
 
     def init(self):
         if not super(NotifierPlayer, self).init():
@@ -103,13 +138,29 @@ class NotifierPlayer(seiscomp.client.Application):
         try:    self.xmlInputFileName = self.commandline().optionString("xml-file")
         except: pass
 
+        try:    self._workers = int(self.commandline().optionString("workers"))
+        except: pass
+
+        try:    self._lookahead = int(self.commandline().optionString("look-ahead"))
+        except: pass
+
+        try:    self._checkpointDir = self.commandline().optionString("checkpoint-dir")
+        except: pass
+
+        try:    self._checkpointInterval = int(self.commandline().optionString("checkpoint-interval"))
+        except: pass
+
+        if self._checkpointInterval and not self._checkpointDir:
+            seiscomp.logging.error("need to specify a checkpoint directory")
+            return False
+
         if start:
             self._startTime = seiscomp.core.Time.GMT()
             if self._startTime.fromString(start, "%FT%TZ") == False:
                 seiscomp.logging.error("Wrong 'begin' format")
                 return False
         if end:
-            self._endTime = Core.Time.GMT()
+            self._endTime = seiscomp.core.Time.GMT()
             if self._endTime.fromString(end, "%FT%TZ") == False:
                 seiscomp.logging.error("Wrong 'end' format")
                 return False
@@ -121,25 +172,120 @@ class NotifierPlayer(seiscomp.client.Application):
 
         seiscomp.logging.debug("input file is %s" % self.xmlInputFileName)
 
-        for time,nmsg in notifierInput(self.xmlInputFileName):
+        # The state reconstructed from the notifiers is only kept if
+        # needed for checkpoints. A plain replay doesn't need it.
+        if self._checkpointDir:
+            self._ep = self._readCheckpoint()
+            if self._ep is None:
+                self._ep = seiscomp.datamodel.EventParameters()
 
-            if self._startTime is not None and time < self._startTime:
-                continue
-            if self._endTime is not None and time > self._endTime:
-                break
+        for time,nmsg in self._notifierInput():
+            if self._checkpointInterval:
+                self._writeCheckpoint(time)
             self.sync(time)
 
+            # Notifiers before the time window are only applied to
+            # bring the state up to date.
+            handle = self._startTime is None or time >= self._startTime
+
             # We either extract and handle all Notifier objects individually
             for item in nmsg:
                 n = seiscomp.datamodel.Notifier.Cast(item)
                 assert n is not None
                 n.apply()
-                self.handleNotifier(n)
+                if handle:
+                    self.handleNotifier(n)
             # OR simply handle the NotifierMessage
 #           self.handleMessage(nmsg)
 
         return True
 
+    def _checkpointFileName(self, time):
+        name = time.toString("checkpoint-%Y%m%dT%H%M%SZ.bin")
+        return os.path.join(self._checkpointDir, name)
+
+    def _readCheckpoint(self):
+        """
+        Read the latest checkpoint before the start of the time window
+        (or the end if no start was specified).
+        """
+        if self._startTime is not None:
+            target = self._startTime
+        elif self._endTime is not None:
+            target = self._endTime
+        else:
+            return None
+
+        latest = None
+        for filename in glob.glob(os.path.join(self._checkpointDir, "checkpoint-*.bin")):
+            time = seiscomp.core.Time.GMT()
+            if not time.fromString(os.path.basename(filename), "checkpoint-%Y%m%dT%H%M%SZ.bin"):
+                continue
+            if time > target:
+                continue
+            if latest is None or time > latest[0]:
+                latest = time, filename
+        if latest is None:
+            seiscomp.logging.info("no checkpoint found, starting from empty state")
+            return None
+
+        time, filename = latest
+        ar = seiscomp.io.BinaryArchive()
+        if not ar.open(filename):
+            raise IOError(filename + ": unable to open")
+        obj = ar.readObject()
+        ar.close()
+        ep = seiscomp.datamodel.EventParameters.Cast(obj)
+        if ep is None:
+            raise TypeError(filename + ": no eventparameters found")
+        seiscomp.logging.info("starting from checkpoint %s" % filename)
+        self._checkpointTime = time
+        return ep
+
+    def _writeCheckpoint(self, time):
+        """
+        Write a checkpoint for each checkpoint time crossed since the
+        previous notifier message. The checkpoints contain the state
+        resulting from all notifiers before the checkpoint time. If
+        several intervals passed without any notifiers, the state is
+        the same for all of them.
+        """
+        interval = self._checkpointInterval
+        if self._nextCheckpoint is None:
+            self._nextCheckpoint = seiscomp.core.Time((time.seconds() // interval + 1) * interval, 0)
+            return
+        while time >= self._nextCheckpoint:
+            filename = self._checkpointFileName(self._nextCheckpoint)
+            # write to temporary file first to never leave an
+            # incomplete checkpoint behind
+            ar = seiscomp.io.BinaryArchive()
+            if not ar.create(filename + ".tmp"):
+                raise IOError(filename + ".tmp: unable to create")
+            ar.writeObject(self._ep)
+            ar.close()
+            os.rename(filename + ".tmp", filename)
+            seiscomp.logging.info("wrote checkpoint %s" % filename)
+            self._nextCheckpoint = seiscomp.core.Time(self._nextCheckpoint.seconds() + interval, 0)
+
+    def _entries(self):
+        # Apply the time window before the XML is parsed.
+        for time, header, xml in readNotifierLog(self.xmlInputFileName):
+            if self._checkpointTime is not None and time < self._checkpointTime:
+                # already contained in the checkpoint
+                continue
+            if self._startTime is not None and time < self._startTime and not self._checkpointDir:
+                continue
+            if self._endTime is not None and time > self._endTime:
+                break
+            yield time, xml
+
+    def _notifierInput(self):
+        if self._workers > 0:
+            seiscomp.logging.debug("parsing with %d workers" % self._workers)
+            return parallelNotifierInput(
+                self._entries(), self._workers, max(self._lookahead, 1))
+        return ((time, notifierMessageFromXML(xml)) for time, xml in self._entries())
+
     def sync(self, time):
         self._time = time
         seiscomp.logging.debug("sync time=%s" % time.toString("%FT%T.%fZ"))
@@ -152,5 +298,6 @@ class NotifierPlayer(seiscomp.client.Application):
         # in a usable player, this must be reimplemented
         seiscomp.logging.debug("updateObject class=%s parent=%s" % (obj.className(),parent))
 
-app = NotifierPlayer(len(sys.argv), sys.argv)
-sys.exit(app())
+if __name__ == "__main__":
+    app = NotifierPlayer(len(sys.argv), sys.argv)
+    sys.exit(app())
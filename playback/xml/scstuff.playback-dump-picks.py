@@ -24,6 +24,24 @@ import seiscomp.logging
 import scstuff.dbutil
 
 
+# Amplitudes of picks near a chunk boundary may have a reference time
+# in the neighbouring chunk and are searched this many seconds beyond
+# the chunk.
+chunk_overlap = 60.
+
+
+def inTimeWindow(obj, startTime, endTime):
+    """
+    False for an amplitude with a reference time outside the given
+    time window, True otherwise.
+    """
+    ampl = seiscomp.datamodel.Amplitude.Cast(obj)
+    if ampl is None:
+        return True
+    t = ampl.timeWindow().reference()
+    return startTime <= t <= endTime
+
+
 def parse_time_string(s):
     t = seiscomp.core.Time.GMT()
     for fmt in [ "%FT%T.%fZ", "%FT%TZ", "%F %T" ]:
@@ -32,6 +50,58 @@ def parse_time_string(s):
     print("Wrong time format", file=sys.stderr)
 
 
+class _StringSink(seiscomp.io.ExportSink):
+
+    def __init__(self):
+        seiscomp.io.ExportSink.__init__(self)
+        self.data = []
+
+    def write(self, data, size):
+        self.data.append(data[:size])
+        return size
+
+
+class ChunkWriter:
+    """
+    Writes EventParameters chunk by chunk to stdout as one SC-XML
+    document. The document header is taken from the first non-empty
+    chunk and the footer is written on close.
+    """
+
+    def __init__(self, out=sys.stdout):
+        self._out = out
+        self._footer = None
+
+    def write(self, ep):
+        if ep.pickCount() + ep.amplitudeCount() + ep.originCount() == 0:
+            return
+        exp = seiscomp.io.Exporter.Create("trunk")
+        exp.setFormattedOutput(True)
+        sink = _StringSink()
+        exp.write(sink, ep)
+        xml = b"".join(sink.data).decode("utf-8")
+        i = xml.index("<EventParameters")
+        j = xml.index(">", i) + 1
+        k = xml.rindex("</EventParameters>")
+        if self._footer is None:
+            self._out.write(xml[:j])
+            self._footer = xml[k:]
+        self._out.write(xml[j:k])
+        self._out.flush()
+
+    def close(self):
+        if self._footer is None:
+            # nothing written, dump an empty EventParameters
+            ar = seiscomp.io.XMLArchive()
+            ar.setFormattedOutput(True)
+            ar.create("-")
+            ar.writeObject(seiscomp.datamodel.EventParameters())
+            ar.close()
+        else:
+            self._out.write(self._footer)
+            self._out.flush()
+
+
 class PickLoader(seiscomp.client.Application):
 
     def __init__(self, argc, argv):
@@ -43,6 +113,13 @@ class PickLoader(seiscomp.client.Application):
         # time window relative to origin time of specified event:
         self._before = 4*3600. # 4 hours
         self._after  = 1*3600. # 1 hour
+        # length of the chunks in which the time window is dumped
+        self._chunkLength = 3600.
+        # Amplitudes are searched this many seconds beyond the time
+        # window, but at least chunk_overlap seconds beyond a chunk
+        # within the time window.
+        self._amplitudeMargin = 0.
+        self._shards = 1
 
     ###########################################################################
     def initConfiguration(self):
@@ -80,6 +157,9 @@ class PickLoader(seiscomp.client.Application):
             "specify space separated list of author IDs to be included. If not given, no author filtering is applied")
         self.commandline().addOption("Dump", "no-origins", "don't include any origins")
         self.commandline().addOption("Dump", "no-manual-picks", "don't include any manual picks")
+        self.commandline().addStringOption("Dump", "chunk-length", "dump the time window in chunks of this many seconds (default: 3600)")
+        self.commandline().addStringOption("Dump", "shards", "query each chunk in this many concurrent shards, each through an own database connection (default: 1)")
+        self.commandline().addStringOption("Dump", "amplitude-margin", "search amplitudes of the picks of a chunk this many seconds beyond the chunk (default: 0)")
 
     def _processCommandLineOptions(self):
         try:    start = self.commandline().optionString("begin")
@@ -116,6 +196,19 @@ class PickLoader(seiscomp.client.Application):
             self._endTime = parse_time_string(end)
             if not self._endTime:
                 return False
+        try:    self._chunkLength = float(self.commandline().optionString("chunk-length"))
+        except: pass
+
+        try:    self._amplitudeMargin = float(self.commandline().optionString("amplitude-margin"))
+        except: pass
+
+        try:    self._shards = int(self.commandline().optionString("shards"))
+        except: pass
+
+        if self._shards > 1 and not self.databaseURI():
+            seiscomp.logging.warning("sharding requires the database URI to be given, using a single connection")
+            self._shards = 1
+
         try:
             self._networkBlacklist = self.commandline().optionString("network-blacklist").split()
         except:
@@ -133,7 +226,6 @@ class PickLoader(seiscomp.client.Application):
             return False
 
         dbq = self.query()
-        ep  = seiscomp.datamodel.EventParameters()
 
         # If we got an event ID as command-line argument...
         if self._evid:
@@ -178,19 +270,60 @@ class PickLoader(seiscomp.client.Application):
                         continue
                     seiscomp.logging.debug("event %s: %d manual origins" %(eventID, len(manualOriginIDs)))
 
-        seiscomp.logging.debug("querying database")
-        objects = scstuff.dbutil.loadPicksForTimespan(
-                dbq,
-                self._startTime, self._endTime,
-                withAmplitudes=True, authors=self._authorWhitelist)
+        # The picks are dumped in chunks of the time window, each of
+        # which is written out and freed before the next is loaded.
+        writer = ChunkWriter()
+        # one process pool for all chunks
+        executor = scstuff.dbutil.shardExecutor(self._shards) if self._shards > 1 else None
+        try:
+            previous = set()
+            margin = seiscomp.core.TimeSpan(self._amplitudeMargin)
+            amplitudeStartTime = self._startTime - margin
+            amplitudeEndTime = self._endTime + margin
+            t1 = self._startTime
+            while t1 < self._endTime:
+                t2 = t1 + seiscomp.core.TimeSpan(self._chunkLength)
+                if t2 > self._endTime:
+                    t2 = self._endTime
+                seiscomp.logging.debug("querying database for %s ~ %s" % (t1.iso(), t2.iso()))
+                kwargs = dict(
+                    withAmplitudes=True, authors=self._authorWhitelist,
+                    networkBlacklist=self._networkBlacklist,
+                    amplitudeMargin=max(self._amplitudeMargin, chunk_overlap))
+                if self._shards > 1:
+                    loaded = scstuff.dbutil.loadPicksForTimespanSharded(
+                        self.databaseURI(), t1, t2, shards=self._shards,
+                        executor=executor, **kwargs)
+                else:
+                    loaded = scstuff.dbutil.iteratePicksForTimespan(dbq, t1, t2, **kwargs)
+                objects = {}
+                for obj in loaded:
+                    # The chunk overlap must not extend the search
+                    # for amplitudes beyond the time window.
+                    if not inTimeWindow(obj, amplitudeStartTime, amplitudeEndTime):
+                        continue
+                    objects[obj.publicID()] = obj
+                del loaded
+
+                # Objects at the chunk boundary are loaded twice.
+                current = set(objects)
+                for publicID in previous & current:
+                    del objects[publicID]
+                previous = current
 
-        seiscomp.logging.debug("adding %d objects to EventParameters " % len(objects))
-        for publicID in objects:
-            ep.add(objects[publicID])
-        seiscomp.logging.debug("deleting %d objects" % len(objects))
-        del objects
-        seiscomp.logging.debug("finished deleting objects")
+                ep = seiscomp.datamodel.EventParameters()
+                seiscomp.logging.debug("adding %d objects to EventParameters " % len(objects))
+                for publicID in objects:
+                    ep.add(objects[publicID])
+                del objects
+                writer.write(ep)
+                del ep
+                t1 = t2
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
+        ep  = seiscomp.datamodel.EventParameters()
         if not self.commandline().hasOption("no-origins"):
             for i,orid in enumerate(self._orids):
                 # XXX There was occasionally a problem with:
@@ -209,15 +342,9 @@ class PickLoader(seiscomp.client.Application):
                 ep.add(org)
             seiscomp.logging.debug("loaded %d manual origins" % ep.originCount())
 
-        seiscomp.logging.debug("dumping EventParameters to XMLArchive")
-        # finally dump event parameters as formatted XML archive to stdout
-        ar = seiscomp.io.XMLArchive()
-        ar.setFormattedOutput(True)
-        ar.create("-")
-        ar.writeObject(ep)
-        ar.close()
-        seiscomp.logging.debug("deleting EventParameters")
+        writer.write(ep)
         del ep
+        writer.close()
         seiscomp.logging.debug("done")
         return True
 
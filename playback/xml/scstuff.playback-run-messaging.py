@@ -1,11 +1,248 @@
 #!/usr/bin/env seiscomp-python
 
-import sys, os, time, tempfile
+import sys, os, time, tempfile, sqlite3
 import seiscomp.core
 import seiscomp.client
 import seiscomp.datamodel
 import seiscomp.io
 import seiscomp.logging
+import seiscomp.utils
+
+
+class Scheduler:
+    """
+    Paces the playback of objects according to their times.
+
+    The first object is played back immediately, each following
+    object at its exact deadline relative to the first one, taking
+    the speed factor into account. Instead of polling, we sleep until
+    the deadline. The lag, i.e. the delay behind the deadline, is
+    measured for each object.
+    """
+
+    def __init__(self, speed=1, exitRequested=None):
+        self.speed = speed
+        self._exitRequested = exitRequested
+        self._firstTime = None
+        self._start = None
+        self.count = 0
+        self.totalLag = 0.
+        self.maxLag = 0.
+        self.sent = 0
+        self._sendStart = None
+
+    def deadline(self, t):
+        if self._firstTime is None:
+            self._firstTime = t
+            self._start = time.monotonic()
+        return self._start + float(t - self._firstTime) / self.speed
+
+    def lag(self, t):
+        """
+        Current lag in seconds behind the deadline of an object with time t
+        """
+        if self.speed is None:
+            return 0.
+        return time.monotonic() - self.deadline(t)
+
+    def wait(self, t):
+        """
+        Sleep until the deadline of an object with time t. Returns
+        the lag in seconds.
+        """
+        if self.speed is None:
+            return 0.
+        deadline = self.deadline(t)
+        while True:
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                break
+            if self._exitRequested and self._exitRequested():
+                break
+            # don't sleep too long at once to be able to exit
+            time.sleep(min(delay, 0.5))
+        lag = time.monotonic() - deadline
+        return lag
+
+    def account(self, lag, count=1):
+        self.count += count
+        self.totalLag += lag*count
+        self.maxLag = max(self.maxLag, lag)
+
+    def accountSent(self, count):
+        if self._sendStart is None:
+            self._sendStart = time.monotonic()
+        self.sent += count
+
+    def report(self):
+        if self.sent and self._sendStart is not None:
+            elapsed = time.monotonic() - self._sendStart
+            seiscomp.logging.info("sent %d objects in %.3f s, i.e. %.1f objects per second" % (
+                self.sent, elapsed, self.sent/elapsed if elapsed > 0 else float("inf")))
+        if not self.count or self.speed is None:
+            return
+        seiscomp.logging.info("lag behind schedule for %d objects: mean %.3f s, max %.3f s" % (
+            self.count, self.totalLag/self.count, self.maxLag))
+
+
+class _CountingSink(seiscomp.io.ExportSink):
+
+    def __init__(self):
+        seiscomp.io.ExportSink.__init__(self)
+        self.written = 0
+
+    def write(self, data, size):
+        self.written += size
+        return size
+
+
+def objectSize(obj):
+    """
+    Size of the object serialized to XML in bytes
+    """
+    exp = seiscomp.io.Exporter.Create("trunk")
+    sink = _CountingSink()
+    exp.write(sink, obj)
+    return sink.written
+
+
+def groupedByTime(sortlist):
+    """
+    Group a sorted list of (time, object) tuples into (time, [objects])
+    """
+    group = []
+    for t, obj in sortlist:
+        if group and t != group[0][0]:
+            yield group[0][0], [ o for (_, o) in group ]
+            group = []
+        group.append( (t, obj) )
+    if group:
+        yield group[0][0], [ o for (_, o) in group ]
+
+
+def notifierMessage(ep, objs):
+    """
+    NotifierMessage with the notifiers for adding the objects to the
+    EventParameters 'ep'.
+
+    Afterwards the objects are removed from 'ep' again, with the
+    Notifier disabled, so that 'ep' doesn't hold on to the objects
+    already sent and the memory doesn't grow during a long playback.
+    """
+    seiscomp.datamodel.Notifier.Enable()
+    try:
+        for obj in objs:
+            ep.add(obj)
+        msg = seiscomp.datamodel.Notifier.GetMessage()
+    finally:
+        seiscomp.datamodel.Notifier.Disable()
+    for obj in objs:
+        ep.remove(obj)
+    return msg
+
+
+def parseTime(s):
+    for fmtstr in "%FT%T.%fZ", "%FT%TZ":
+        t = seiscomp.core.Time.GMT()
+        if t.fromString(s, fmtstr):
+            return t
+
+
+class ObjectIndex:
+    """
+    On-disk index of the pick, amplitude and origin elements of an
+    SC-XML file.
+
+    The file is scanned once with expat, recording for each object
+    element the creation time and the byte offsets in an sqlite
+    database. The elements can then be read back from the file in
+    order of creation time without ever holding more than one of them
+    in memory.
+    """
+
+    objectElements = [ "pick", "amplitude", "origin" ]
+
+    def __init__(self, tmpDir=None):
+        fd, self.filename = tempfile.mkstemp(".sqlite", "playback-index-", dir=tmpDir)
+        os.close(fd)
+        self._db = sqlite3.connect(self.filename)
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE objects (seconds INTEGER, microseconds INTEGER, start INTEGER, endtag INTEGER, name TEXT)")
+        self.namespace = "http://geofon.gfz-potsdam.de/ns/seiscomp3-schema/0.7"
+        self.version = "0.7"
+        self.count = 0
+
+    def build(self, xmlFile, startTime=None, endTime=None):
+        import xml.parsers.expat
+
+        path = []
+        rows = []
+        current = {}
+
+        def startElement(name, attrs):
+            name = name.split(":")[-1]
+            path.append(name)
+            if len(path) == 1 and name == "seiscomp":
+                self.namespace = attrs.get("xmlns", self.namespace)
+                self.version = attrs.get("version", self.version)
+            elif len(path) == 3 and name in self.objectElements:
+                current.clear()
+                current["start"] = parser.CurrentByteIndex
+                current["text"] = []
+            elif len(path) == 5 and path[3:] == ["creationInfo", "creationTime"]:
+                current["text"] = []
+
+        def endElement(qname):
+            if len(path) == 3 and path[-1] in self.objectElements and "start" in current:
+                t = parseTime("".join(current.get("time", [])).strip())
+                if t is not None and \
+                   (startTime is None or t >= startTime) and \
+                   (endTime is None or t <= endTime):
+                    rows.append( (t.seconds(), t.microseconds(), current["start"], parser.CurrentByteIndex, qname) )
+                current.clear()
+                if len(rows) >= 10000:
+                    self._insert(rows)
+            elif len(path) == 5 and path[3:] == ["creationInfo", "creationTime"]:
+                current["time"] = current["text"]
+            path.pop()
+
+        def characterData(data):
+            if len(path) == 5 and path[3:] == ["creationInfo", "creationTime"]:
+                current["text"].append(data)
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = startElement
+        parser.EndElementHandler = endElement
+        parser.CharacterDataHandler = characterData
+        with open(xmlFile, "rb") as f:
+            parser.ParseFile(f)
+        self._insert(rows)
+        self._db.execute("CREATE INDEX objects_time ON objects (seconds, microseconds)")
+        self._db.commit()
+
+    def _insert(self, rows):
+        self._db.executemany("INSERT INTO objects VALUES (?,?,?,?,?)", rows)
+        self.count += len(rows)
+        del rows[:]
+
+    def elements(self, f):
+        """
+        Read the object elements from the open file f in order of
+        creation time. Objects with the same creation time are
+        returned in file order.
+        """
+        cursor = self._db.execute("SELECT start, endtag, name FROM objects ORDER BY seconds, microseconds, rowid")
+        for start, endtag, name in cursor:
+            f.seek(start)
+            # The end offset is that of the end tag, which we need
+            # to include.
+            data = f.read(endtag - start + len(name) + 3)
+            yield data.decode("utf-8")
+
+    def close(self):
+        self._db.close()
+        os.unlink(self.filename)
 
 
 class PickPlayer(seiscomp.client.Application):
@@ -19,6 +256,12 @@ class PickPlayer(seiscomp.client.Application):
         self._xmlFile = None
         self._tmpDir = None
         self.speed = 1
+        self._batchCount = 1
+        self._batchBytes = None
+        self._batchTime = 0.
+        # running totals of the current batch
+        self._batchObjectCount = 0
+        self._batchByteCount = 0
 
     def createCommandLineDescription(self):
         seiscomp.client.Application.createCommandLineDescription(self)
@@ -28,9 +271,14 @@ class PickPlayer(seiscomp.client.Application):
         self.commandline().addStringOption("Play", "begin", "specify start of time window")
         self.commandline().addStringOption("Play", "end", "specify end of time window")
         self.commandline().addStringOption("Play", "speed", "specify speed factor")
+        self.commandline().addGroup("Batch")
+        self.commandline().addStringOption("Batch", "batch-count", "maximum number of objects per message (default: 1, but objects with the same time are always sent together)")
+        self.commandline().addStringOption("Batch", "batch-bytes", "maximum size of the objects per message in bytes")
+        self.commandline().addStringOption("Batch", "batch-time", "maximum time span of the objects per message in seconds (default: 0, ignored with speed 0)")
         self.commandline().addGroup("Input")
         self.commandline().addStringOption("Input", "xml-file", "specify xml file")
-        self.commandline().addStringOption("Input", "tmp-dir", "specify tmp directory (default is /tmp)")
+        self.commandline().addOption("Input", "external-sort", "sort the objects of the xml file using an on-disk index instead of in memory")
+        self.commandline().addStringOption("Input", "tmp-dir", "specify tmp directory for the on-disk index (default is /tmp)")
 
     def validateParameters(self):
         if not self.commandline().hasOption("test"):
@@ -63,6 +311,15 @@ class PickPlayer(seiscomp.client.Application):
                 self.speed = float(self.speed)
         except: self.speed = 1
 
+        try:    self._batchCount = int(self.commandline().optionString("batch-count"))
+        except: pass
+
+        try:    self._batchBytes = int(self.commandline().optionString("batch-bytes"))
+        except: pass
+
+        try:    self._batchTime = float(self.commandline().optionString("batch-time"))
+        except: pass
+
         if start:
             self._startTime = seiscomp.core.Time.GMT()
             if self._startTime.fromString(start, "%F %T") == False:
@@ -88,10 +345,11 @@ class PickPlayer(seiscomp.client.Application):
             raise TypeError(self._xmlFile + ": no eventparameters found")
         return ep
 
-    def _runBatchMode(self):
-        ep = self._readEventParametersFromXML()
-
-        # collect the objects
+    def _takeObjects(self, ep):
+        """
+        Remove the picks, amplitudes and origins from the
+        EventParameters and return them as list.
+        """
         objs = []
         while ep.pickCount() > 0:
             # FIXME: The cast hack forces the SeisComP refcounter to be increased.
@@ -108,6 +366,12 @@ class PickPlayer(seiscomp.client.Application):
             origin = seiscomp.datamodel.Origin.Cast(ep.origin(0))
             ep.removeOrigin(0)
             objs.append(origin)
+        return objs
+
+    def _runBatchMode(self):
+        ep = self._readEventParametersFromXML()
+
+        objs = self._takeObjects(ep)
         del ep
 
         # DSU sort all objects by object creation time
@@ -117,80 +381,177 @@ class PickPlayer(seiscomp.client.Application):
             try:    t = obj.creationInfo().creationTime()
             except: continue
 
-            if self._startTime is not None and t < self._startTime:
-                continue
-            if self._endTime is not None and t > self._endTime:
+            if not self._inTimeWindow(t):
                 continue
             sortlist.append( (t,obj) )
-        sortlist.sort()
+        sortlist.sort(key=lambda item: item[0])
 
-        time_of_1st_object, obj = sortlist[0]
-        time_of_playback_start = seiscomp.core.Time.GMT()
+        return self._play(sortlist)
 
+    def _runIndexedMode(self):
+        index = ObjectIndex(self._tmpDir)
+        try:
+            index.build(self._xmlFile, self._startTime, self._endTime)
+            seiscomp.logging.debug("indexed %d objects" % index.count)
+            return self._play(self._indexedObjects(index))
+        finally:
+            index.close()
+
+    def _indexedObjects(self, index):
+        with open(self._xmlFile, "rb") as f:
+            for element in index.elements(f):
+                for obj in self._parseElement(element, index.namespace, index.version):
+                    try:    t = obj.creationInfo().creationTime()
+                    except: continue
+                    yield t, obj
+
+    def _fits(self, batch, t, count, size):
+        """
+        Check whether 'count' more objects of time t and total size
+        'size' fit into the batch.
+        """
+        if self._batchObjectCount + count > self._batchCount:
+            return False
+        if self._batchBytes is not None:
+            if self._batchByteCount + size > self._batchBytes:
+                return False
+        if self.speed is not None and float(t - batch[0][0]) > self._batchTime:
+            return False
+        return True
+
+    def _play(self, items):
+        """
+        Play back the (time, object) items sorted by time.
+
+        Objects are batched into one message as long as the limits
+        for the number of objects, their size and the time span are
+        not exceeded. Objects due at the same time are always sent in
+        one message. A batch is sent at the deadline of its latest
+        object.
+        """
         ep = seiscomp.datamodel.EventParameters()
-        pickampl = {}
+        scheduler = Scheduler(self.speed, self.isExitRequested)
 
-        # go through the sorted list of object and process them sequentially
-        for t,obj in sortlist:
+        batch = []
+        self._batchObjectCount = self._batchByteCount = 0
+        for t,objs in groupedByTime(items):
             if self.isExitRequested(): return
 
-            if self.speed:
-                t = time_of_playback_start + seiscomp.core.TimeSpan(float(t - time_of_1st_object) / self.speed)
-                while t > seiscomp.core.Time.GMT():
-                    time.sleep(0.1)
-
-            if obj.ClassName() not in [ "Pick", "Amplitude", "Origin" ]:
+            objs = [ obj for obj in objs if obj.ClassName() in [ "Pick", "Amplitude", "Origin" ] ]
+            if not objs:
                 continue
+            size = sum(objectSize(obj) for obj in objs) if self._batchBytes is not None else 0
+            if batch and not self._fits(batch, t, len(objs), size):
+                self._sendBatch(ep, scheduler, batch)
+            batch.append( (t, objs, size) )
+            self._batchObjectCount += len(objs)
+            self._batchByteCount += size
+        if batch and not self.isExitRequested():
+            self._sendBatch(ep, scheduler, batch)
+
+        scheduler.report()
+        return True
 
-            seiscomp.datamodel.Notifier.Enable()
-            ep.add(obj)
-            msg = seiscomp.datamodel.Notifier.GetMessage()
-            if self.commandline().hasOption("test"):
+    def _sendBatch(self, ep, scheduler, batch):
+        scheduler.wait(batch[-1][0])
+        objs = [ obj for (_, group, _) in batch for obj in group ]
+        self._send(ep, objs)
+        scheduler.accountSent(len(objs))
+        for t, group, _ in batch:
+            lag = scheduler.lag(t)
+            scheduler.account(lag, len(group))
+            seiscomp.logging.debug("lag %.3f s" % lag)
+        del batch[:]
+        self._batchObjectCount = self._batchByteCount = 0
+        self.sync()
+
+    def _send(self, ep, objs):
+        """
+        Send the objects in one NotifierMessage
+        """
+        msg = notifierMessage(ep, objs)
+        if self.commandline().hasOption("test"):
+            for obj in objs:
                 sys.stderr.write("Test mode - not sending %-10s %s\n" % (obj.ClassName(), obj.publicID()))
-            else:
-                if self.connection().send(msg):
+        else:
+            if self.connection().send(msg):
+                for obj in objs:
                     sys.stderr.write("Sent %s %s\n" % (obj.ClassName(), obj.publicID()))
-                else:
+            else:
+                for obj in objs:
                     sys.stderr.write("Failed to send %-10s %s\n" % (obj.ClassName(), obj.publicID()))
-            seiscomp.datamodel.Notifier.Disable()
-            self.sync()
 
-        return True
 
+    def _parseElement(self, element, namespace, version):
+        """
+        Parse an object element given as XML string. Returns the
+        list of objects.
+        """
+        # wrap object into a SeisComP XML template and parse
+        # it directly from memory
+        doc = '<?xml version="1.0" encoding="UTF-8"?><seiscomp xmlns="%s" version="%s"><EventParameters>%s</EventParameters></seiscomp>' % (namespace, version, element)
+        ar = seiscomp.io.XMLArchive(seiscomp.utils.stringToStreambuf(doc))
+        ep = seiscomp.datamodel.EventParameters.Cast(ar.readObject())
+        ar.close()
+        if ep is None:
+            seiscomp.logging.warning("failed to parse element %s" % element[:80])
+            return []
+        return self._takeObjects(ep)
 
-    def _runStreamMode(self, stream=sys.stdin):
+    def _inTimeWindow(self, t):
+        if self._startTime is not None and t < self._startTime:
+            return False
+        if self._endTime is not None and t > self._endTime:
+            return False
+        return True
 
+    def _streamObjects(self, stream):
+        """
+        Parse the pick, amplitude and origin elements from the stream
+        and yield them as (time, object) tuples in input order.
+        """
         import xml.dom.pulldom
+        namespace = "http://geofon.gfz-potsdam.de/ns/seiscomp3-schema/0.7"
+        version = "0.7"
         events = xml.dom.pulldom.parse(stream, bufsize=100)
-        for event in events:
-            typ, node = event
-            if typ == 'START_ELEMENT' and node.nodeName in ["pick","amplitude","origin"]:
-                events.expandNode(node)
-                xmlNode = node.toxml()
-                ofile = open(self._xmlFile, "w")
-                # wrap object into a SeisComP XML template
-                ofile.write('<?xml version="1.0" encoding="UTF-8"?><seiscomp xmlns="http://geofon.gfz-potsdam.de/ns/seiscomp3-schema/0.7" version="0.7"><EventParameters>%s</EventParameters></seiscomp>\n' % xmlNode)
-                ofile.close()
-                # in batch mode pick up data in temp file
-                self._runBatchMode()
-        return True
+        for typ, node in events:
+            if typ != 'START_ELEMENT':
+                continue
+            if node.nodeName == "seiscomp":
+                namespace = node.namespaceURI or namespace
+                version = node.getAttribute("version") or version
+                continue
+            if node.nodeName not in ["pick","amplitude","origin"]:
+                continue
+            events.expandNode(node)
+            for obj in self._parseElement(node.toxml(), namespace, version):
+                try:    t = obj.creationInfo().creationTime()
+                except: continue
+                if self._inTimeWindow(t):
+                    yield t, obj
+
+    def _runStreamMode(self, stream=sys.stdin):
+        # The objects are played back as they arrive, in input order
+        # and with one pacing clock for the whole stream.
+        return self._play(self._streamObjects(stream))
 
     def run(self):
 
         if self._xmlFile:
             seiscomp.logging.debug("running in batch mode")
             seiscomp.logging.debug("input file is %s" % self._xmlFile)
+            if self.commandline().hasOption("external-sort"):
+                return self._runIndexedMode()
             return self._runBatchMode()
 
-        self._xmlFile = tempfile.mktemp(".xml", dir=self._tmpDir)
         seiscomp.logging.debug("running in stream mode")
-        seiscomp.logging.debug("temp file is %s" % self._xmlFile)
-        status = self._runStreamMode()
-        if os.path.exists(self._xmlFile):
-            os.unlink(self._xmlFile)
-        return status
+        return self._runStreamMode()
+
 
+def main():
+    app = PickPlayer(len(sys.argv), sys.argv)
+    return app()
 
 
-app = PickPlayer(len(sys.argv), sys.argv)
-sys.exit(app())
+if __name__ == "__main__":
+    sys.exit(main())
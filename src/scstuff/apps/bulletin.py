@@ -35,7 +35,9 @@ Nevertheless, this is still work in progress. Suggestions and ideas for improvem
 import sys
 import seiscomp.client
 import scstuff.bulletin
+import scstuff.cache
 import scstuff.dbutil
+import scstuff.util
 
 
 class App(seiscomp.client.Application):
@@ -74,10 +76,19 @@ class App(seiscomp.client.Application):
             "Dump", "dist-in-km,k",
             "plot distances in km instead of degree")
 
+        self.commandline().addGroup("Cache")
+        self.commandline().addStringOption(
+            "Cache", "cache-dir",
+            "cache objects loaded from the database in this directory")
+        self.commandline().addStringOption(
+            "Cache", "cache-size",
+            "maximum size of the cache in MB (default: 256)")
+
         self.commandline().addGroup("Input")
         self.commandline().addStringOption(
             "Input", "format,f",
-            "input format to use (xml [default], zxml (zipped xml), binary)")
+            "input format to use (xml, zxml (zipped xml), gzxml, binary), "
+            "default: detected from the file content")
         self.commandline().addStringOption(
             "Input", "input,i", "input file, default: stdin")
 
@@ -148,6 +159,20 @@ class App(seiscomp.client.Application):
         if self.commandline().hasOption("dist-in-km"):
             bulletin.distInKM = True
 
+        cache = None
+        try:
+            cacheDir = self.commandline().optionString("cache-dir")
+        except RuntimeError:
+            cacheDir = None
+        if dbq and cacheDir:
+            try:
+                cacheSize = float(self.commandline().optionString("cache-size"))
+            except RuntimeError:
+                cacheSize = 256
+            cache = scstuff.cache.ObjectCache(
+                cacheDir, maxSize=int(cacheSize*1024*1024))
+            scstuff.dbutil.setObjectCache(cache)
+
         if dbq:
             ep = scstuff.dbutil.loadCompleteEvent(
                 dbq, eventID, comments=True, allmagnitudes=True,
@@ -159,39 +184,37 @@ class App(seiscomp.client.Application):
             elif originID:
                 txt = bulletin.printOrigin(originID)
         else:
-            # if there is no file name specified
-            inputFormat = "xml"
-
             try:
                 inputFile = self.commandline().optionString("input")
             except RuntimeError:
                 inputFile = "-"
 
-            if inputFile.lower().endswith(".xml.gz"):
-                inputFormat == "gzxml"
-
             try:
                 inputFormat = self.commandline().optionString("format")
             except RuntimeError:
-                pass
-
-            if inputFormat in ("xml", "zxml", "gzxml"):
-                ar = seiscomp.io.XMLArchive()
-                if inputFormat in ("zxml", "gzxml"):
-                    ar.setCompression(True)
-                    if inputFormat == "gzxml":
-                        ar.setCompressionMethod(seiscomp.io.XMLArchive.GZIP)
-            elif inputFormat == "binary":
-                ar = seiscomp.io.BinaryArchive()
+                # detect the format from the file content
+                inputFormat = None
+
+            if inputFormat is None:
+                obj = scstuff.util.readObjectFromFile(inputFile)
             else:
-                raise TypeError("unknown input format '" + inputFormat + "'")
+                if inputFormat in ("xml", "zxml", "gzxml"):
+                    ar = seiscomp.io.XMLArchive()
+                    if inputFormat in ("zxml", "gzxml"):
+                        ar.setCompression(True)
+                        if inputFormat == "gzxml":
+                            ar.setCompressionMethod(seiscomp.io.XMLArchive.GZIP)
+                elif inputFormat == "binary":
+                    ar = seiscomp.io.BinaryArchive()
+                else:
+                    raise TypeError("unknown input format '" + inputFormat + "'")
 
-            if ar.open(inputFile) is False:
-                raise IOError(inputFile + ": unable to open")
+                if ar.open(inputFile) is False:
+                    raise IOError(inputFile + ": unable to open")
 
-            obj = ar.readObject()
-            if obj is None:
-                raise TypeError(inputFile + ": invalid format")
+                obj = ar.readObject()
+                if obj is None:
+                    raise TypeError(inputFile + ": invalid format")
 
             ep = seiscomp.datamodel.EventParameters.Cast(obj)
             if ep is None:
@@ -229,6 +252,10 @@ class App(seiscomp.client.Application):
         if txt:
             print(txt)
 
+        if cache:
+            cache.logStatistics()
+            cache.close()
+
         return True
 
 
@@ -19,26 +19,52 @@ import sys
 import seiscomp.core
 import seiscomp.client
 from scstuff.inventory import InventoryIterator
+import scstuff.inventorysnapshot
 
 
 class App(seiscomp.client.Application):
     def __init__(self, argc, argv):
-        super.__init__(argc, argv)
+        super().__init__(argc, argv)
         self.setMessagingEnabled(False)
         self.setDatabaseEnabled(True, True)
         self.setLoggingToStdErr(True)
         self.setLoadInventoryEnabled(True)
 
+    def createCommandLineDescription(self):
+        super().createCommandLineDescription()
+        self.commandline().addGroup("Inventory")
+        self.commandline().addStringOption("Inventory", "inventory-snapshot", "use a cached inventory snapshot in the specified directory")
+        return True
+
+    def validateParameters(self):
+        if not super().validateParameters():
+            return False
+        try:
+            self._snapshotDir = self.commandline().optionString("inventory-snapshot")
+        except:
+            self._snapshotDir = None
+        if self._snapshotDir:
+            self.setLoadInventoryEnabled(False)
+        return True
+
     def run(self):
         now = seiscomp.core.Time.GMT()
         lines = []
-        inv = seiscomp.client.Inventory.Instance().inventory()
 
-        for network, station, location, stream in InventoryIterator(inv, now):
-            n,s,l,c = network.code(), station.code(), location.code(), stream.code()
-            if l.strip() == "": l="--" # for readability
-            line = "%-2s %-5s %-2s %-3s %g" % (n,s,l,c, stream.gain())
-            lines.append(line)
+        if self._snapshotDir:
+            with scstuff.inventorysnapshot.openInventorySnapshot(self.query(), self._snapshotDir) as snapshot:
+                for epoch in snapshot.streams(now):
+                    n,s,l,c = epoch.network, epoch.station, epoch.location, epoch.stream
+                    if l.strip() == "": l="--" # for readability
+                    line = "%-2s %-5s %-2s %-3s %g" % (n,s,l,c, epoch.gain)
+                    lines.append(line)
+        else:
+            inv = seiscomp.client.Inventory.Instance().inventory()
+            for network, station, location, stream in InventoryIterator(inv, now):
+                n,s,l,c = network.code(), station.code(), location.code(), stream.code()
+                if l.strip() == "": l="--" # for readability
+                line = "%-2s %-5s %-2s %-3s %g" % (n,s,l,c, stream.gain())
+                lines.append(line)
         lines.sort()
         for line in lines:
             print(line)
@@ -27,6 +27,7 @@ import sys
 import seiscomp.client
 import seiscomp.core
 from scstuff.inventory import InventoryIterator
+import scstuff.inventorysnapshot
 
 class App(seiscomp.client.Application):
     def __init__(self, argc, argv):
@@ -36,18 +37,44 @@ class App(seiscomp.client.Application):
         self.setLoggingToStdErr(True)
         self.setLoadInventoryEnabled(True)
 
+    def createCommandLineDescription(self):
+        super().createCommandLineDescription()
+        self.commandline().addGroup("Inventory")
+        self.commandline().addStringOption("Inventory", "inventory-snapshot", "use a cached inventory snapshot in the specified directory")
+        return True
+
+    def validateParameters(self):
+        if not super().validateParameters():
+            return False
+        try:
+            self._snapshotDir = self.commandline().optionString("inventory-snapshot")
+        except:
+            self._snapshotDir = None
+        if self._snapshotDir:
+            self.setLoadInventoryEnabled(False)
+        return True
+
     def run(self):
         now = seiscomp.core.Time.GMT()
         lines = []
         coord = {}
-        inv = seiscomp.client.Inventory.Instance().inventory()
 
-        for (network, station, location, stream) in InventoryIterator(inv, now):
-            n,s,l,c = network.code(), station.code(), location.code(), stream.code()
-            if (n,s) in coord:
-                continue
+        if self._snapshotDir:
+            with scstuff.inventorysnapshot.openInventorySnapshot(self.query(), self._snapshotDir) as snapshot:
+                for epoch in snapshot.streams(now):
+                    n,s = epoch.network, epoch.station
+                    if (n,s) in coord:
+                        continue
+
+                    coord[n,s] = (epoch.latitude, epoch.longitude, epoch.elevation)
+        else:
+            inv = seiscomp.client.Inventory.Instance().inventory()
+            for (network, station, location, stream) in InventoryIterator(inv, now):
+                n,s,l,c = network.code(), station.code(), location.code(), stream.code()
+                if (n,s) in coord:
+                    continue
 
-            coord[n,s] = (station.latitude(), station.longitude(), station.elevation())
+                coord[n,s] = (station.latitude(), station.longitude(), station.elevation())
 
         for (n,s) in coord:
             lat,lon,elev = coord[n,s]
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+# Copyright (C) GFZ Potsdam                                               #
+# All rights reserved.                                                    #
+#                                                                         #
+# Author: Joachim Saul (saul@gfz-potsdam.de)                              #
+#                                                                         #
+# GNU Affero General Public License Usage                                 #
+# This file may be used under the terms of the GNU Affero                 #
+# Public License version 3.0 as published by the Free Software Foundation #
+# and appearing in the file LICENSE included in the packaging of this     #
+# file. Please review the following information to ensure the GNU Affero  #
+# Public License version 3.0 requirements will be met:                    #
+# https://www.gnu.org/licenses/agpl-3.0.html.                             #
+###########################################################################
+
+
+import io
+import os
+import time
+import sqlite3
+import seiscomp.io
+import seiscomp.logging
+import seiscomp.utils
+
+
+# Child tables whose row count and latest modification are checked in
+# addition to the object itself to detect children that were added,
+# removed or modified without updating the object, e.g. a magnitude
+# revised in place. These are all tables loaded along with the object.
+# A tuple means a descendant table followed by its ancestor tables up
+# to the child table, e.g. a grandchild table followed by the child
+# table. Note that Arrival's have no comments.
+_childTables = {
+    "Event": [
+        "OriginReference", "FocalMechanismReference",
+        "EventDescription", "Comment" ],
+    "Origin": [
+        "Arrival", "Magnitude", "StationMagnitude", "Comment",
+        "CompositeTime",
+        ("StationMagnitudeContribution", "Magnitude"),
+        ("Comment", "Magnitude"),
+        ("Comment", "StationMagnitude") ],
+    "Magnitude": [
+        "StationMagnitudeContribution", "Comment" ],
+    "FocalMechanism": [
+        "MomentTensor", "Comment",
+        ("MomentTensorStationContribution", "MomentTensor"),
+        ("DataUsed", "MomentTensor"),
+        ("MomentTensorPhaseSetting", "MomentTensor"),
+        ("Comment", "MomentTensor"),
+        ("MomentTensorComponentContribution", "MomentTensorStationContribution", "MomentTensor") ],
+}
+
+
+class _BytesSink(seiscomp.io.ExportSink):
+
+    def __init__(self, buf):
+        seiscomp.io.ExportSink.__init__(self)
+        self.buf = buf
+
+    def write(self, data, size):
+        self.buf.write(data[:size])
+        return size
+
+
+def _serialize(obj):
+    exp = seiscomp.io.Exporter.Create("trunk")
+    exp.setFormattedOutput(False)
+    buf = io.BytesIO()
+    if not exp.write(_BytesSink(buf), obj):
+        raise IOError("failed to serialize " + obj.publicID())
+    return buf.getvalue()
+
+
+def _deserialize(data):
+    ar = seiscomp.io.XMLArchive(seiscomp.utils.stringToStreambuf(data.decode("utf-8")))
+    obj = ar.readObject()
+    ar.close()
+    return obj
+
+
+class ObjectCache:
+    """
+    Persistent read-through cache of fully loaded objects.
+
+    The objects are stored serialized in an SQLite database in the
+    given directory, keyed by class name and publicID. Along with
+    each object a stamp is stored that consists of the creation,
+    modification and last database update time of the object as well
+    as the number and latest database update time of its children.
+    Before a cached object is returned, the current
+    stamp is fetched with a single cheap query. If it differs, the
+    object is loaded from the database and the cache is updated.
+
+    If the total size of the cached objects exceeds maxSize bytes,
+    the least recently used objects are evicted.
+
+    Changes to the cache database are committed in batches of
+    'batchSize' loads and when the cache is closed.
+    """
+
+    def __init__(self, directory, maxSize=256*1024*1024, batchSize=100):
+        os.makedirs(directory, exist_ok=True)
+        self.maxSize = maxSize
+        self._db = sqlite3.connect(os.path.join(directory, "objects.sqlite"), timeout=30)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            "key TEXT PRIMARY KEY, stamp TEXT, data BLOB, size INTEGER, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS objects_accessed ON objects (accessed)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size),0) FROM objects").fetchone()[0]
+        self.batchSize = batchSize
+        self._pending = 0
+        self._accessed = {}  # key -> access time not yet written
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.evicted = 0
+
+    def _stamp(self, query, className, publicID):
+        """
+        Fetch the current stamp of an object from the database.
+        Returns None if there is no such object.
+        """
+        driver = query.driver()
+        col = driver.convertColumnName
+        fields = [ "%s.%s" % (className, col(name)) for name in [
+            "creationInfo_creationTime", "creationInfo_creationTime_ms",
+            "creationInfo_modificationTime", "creationInfo_modificationTime_ms" ] ]
+        fields.append("%s._last_modified" % className)
+        for child in _childTables.get(className, []):
+            tables = list(child) if isinstance(child, tuple) else [ child ]
+            child = tables[0]
+            conditions = [ "%s._parent_oid=%s._oid" % (table, parent)
+                           for table, parent in zip(tables, tables[1:] + [ className ]) ]
+            where = "from %s where %s" % (",".join(tables), " and ".join(conditions))
+            fields.append("(select count(*) %s)" % where)
+            fields.append("(select max(%s._last_modified) %s)" % (child, where))
+        sql = "select %s from %s,PublicObject where %s._oid=PublicObject._oid and PublicObject.%s='%s'" % (
+            ",".join(fields), className, className, col("publicID"), publicID.replace("'", "''"))
+
+        if not driver.beginQuery(sql):
+            raise RuntimeError("query failed: " + sql)
+        try:
+            if not driver.fetchRow():
+                return None
+            values = []
+            for i in range(driver.getRowFieldCount()):
+                value = driver.getRowFieldString(i)
+                values.append(value if value is not None else "")
+        finally:
+            driver.endQuery()
+        return "|".join(values)
+
+    def load(self, query, tp, publicID):
+        """
+        Return the object of type tp, e.g. seiscomp.datamodel.Origin,
+        with the given publicID including all children, or None if
+        it could not be loaded.
+        """
+        className = tp.TypeInfo().className()
+        key = "%s/%s" % (className, publicID)
+        stamp = self._stamp(query, className, publicID)
+        if stamp is None:
+            self.misses += 1
+            return None
+
+        row = self._db.execute("SELECT stamp, data, size FROM objects WHERE key=?", (key,)).fetchone()
+        if row is not None:
+            if row[0] == stamp:
+                obj = tp.Cast(_deserialize(row[1]))
+                if obj is not None:
+                    self.hits += 1
+                    self._accessed[key] = time.time()
+                    self._changed()
+                    return obj
+            self.invalidated += 1
+            self._size -= row[2]
+        self.misses += 1
+
+        obj = tp.Cast(query.loadObject(tp.TypeInfo(), publicID))
+        if obj is None:
+            return None
+        data = _serialize(obj)
+        self._db.execute(
+            "INSERT OR REPLACE INTO objects VALUES (?,?,?,?,?)",
+            (key, stamp, data, len(data), time.time()))
+        self._accessed.pop(key, None)
+        self._size += len(data)
+        self._evict()
+        self._changed()
+        return obj
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= self.batchSize:
+            self.flush()
+
+    def _writeAccessed(self):
+        if self._accessed:
+            self._db.executemany(
+                "UPDATE objects SET accessed=? WHERE key=?",
+                [ (t, key) for key, t in self._accessed.items() ])
+            self._accessed.clear()
+
+    def flush(self):
+        """
+        Write the pending access times and commit.
+        """
+        self._writeAccessed()
+        self._db.commit()
+        self._pending = 0
+
+    def _evict(self):
+        if self._size <= self.maxSize:
+            return
+        # access times not yet written must be taken into account
+        self._writeAccessed()
+        keys = []
+        for key, size in self._db.execute("SELECT key, size FROM objects ORDER BY accessed"):
+            if self._size <= self.maxSize:
+                break
+            keys.append( (key,) )
+            self._size -= size
+        self._db.executemany("DELETE FROM objects WHERE key=?", keys)
+        self.evicted += len(keys)
+
+    def statistics(self):
+        count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size),0) FROM objects").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidated": self.invalidated,
+            "evicted": self.evicted,
+            "objects": count,
+            "bytes": size }
+
+    def logStatistics(self):
+        stats = self.statistics()
+        seiscomp.logging.info(
+            "object cache: %(hits)d hits, %(misses)d misses (%(invalidated)d invalidated), "
+            "%(evicted)d evicted, %(objects)d objects with %(bytes)d bytes" % stats)
+
+    def close(self):
+        self.flush()
+        self._db.close()
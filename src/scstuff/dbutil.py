@@ -1,6 +1,8 @@
 #!/usr/bin/env seiscomp-python
 # -*- coding: utf-8 -*-
 
+import os
+import seiscomp.core
 import seiscomp.client
 import seiscomp.datamodel
 import seiscomp.io
@@ -14,6 +16,27 @@ from seiscomp.datamodel import \
     Magnitude, Pick, Amplitude, CreationInfo
 
 
+_objectCache = None
+
+
+def setObjectCache(cache):
+    """
+    Put a read-through cache like scstuff.cache.ObjectCache in front of
+    loadEvent(), loadOrigin(), loadMagnitude() and loadFocalMechanism().
+    Only full loads are cached. Pass None to disable the cache.
+    """
+    global _objectCache
+    _objectCache = cache
+
+
+def _load(query, tp, publicID, full):
+    if full and _objectCache is not None:
+        return _objectCache.load(query, tp, publicID)
+    load = query.loadObject if full else query.getObject
+    obj = load(tp.TypeInfo(), publicID)
+    return tp.Cast(obj)
+
+
 def loadEvent(query, publicID, full=True):
     """
     Retrieve an event from DB
@@ -34,12 +57,7 @@ def loadEvent(query, publicID, full=True):
         focalMechanismReference
     """
 
-    load = query.loadObject if full else query.getObject
-
-    obj = load(seiscomp.datamodel.Event.TypeInfo(), publicID)
-    obj = seiscomp.datamodel.Event.Cast(obj)
-
-    return obj  # may be None
+    return _load(query, seiscomp.datamodel.Event, publicID, full)  # may be None
 
 
 def loadOrigin(query, publicID, full=True):
@@ -61,10 +79,7 @@ def loadOrigin(query, publicID, full=True):
         stationMagnitude
     """
 
-    load = query.loadObject if full else query.getObject
-    obj = load(seiscomp.datamodel.Origin.TypeInfo(), publicID)
-    obj = seiscomp.datamodel.Origin.Cast(obj)
-    return obj  # may be None
+    return _load(query, seiscomp.datamodel.Origin, publicID, full)  # may be None
 
 
 def loadMagnitude(query, publicID, full=True):
@@ -81,10 +96,7 @@ def loadMagnitude(query, publicID, full=True):
         comment
     """
 
-    load = query.loadObject if full else query.getObject
-    obj = load(seiscomp.datamodel.Magnitude.TypeInfo(), publicID)
-    obj = seiscomp.datamodel.Magnitude.Cast(obj)
-    return obj  # may be None
+    return _load(query, seiscomp.datamodel.Magnitude, publicID, full)  # may be None
 
 
 def loadFocalMechanism(query, publicID, full=True):
@@ -109,10 +121,65 @@ def loadFocalMechanism(query, publicID, full=True):
     that must be loaded separately with loadOrigin(..., full=True) and
     which then contains the moment magnitude as child.
     """
-    load = query.loadObject if full else query.getObject
-    obj = load(seiscomp.datamodel.FocalMechanism.TypeInfo(), publicID)
-    obj = seiscomp.datamodel.FocalMechanism.Cast(obj)
-    return obj  # may be None
+    return _load(query, seiscomp.datamodel.FocalMechanism, publicID, full)  # may be None
+
+
+def _publicObjectOids(query, publicIDs, batchSize=500):
+    """
+    Look up the database object IDs of the given publicIDs. Returns a
+    dict publicID -> _oid.
+    """
+    driver = query.driver()
+    oids = dict()
+    publicIDs = list(publicIDs)
+    for i in range(0, len(publicIDs), batchSize):
+        sql = "select _oid,%s from PublicObject where %s in (%s)" % (
+            driver.convertColumnName("publicID"),
+            driver.convertColumnName("publicID"),
+            _sqlList(publicIDs[i:i+batchSize]))
+        if not driver.beginQuery(sql):
+            raise RuntimeError("query failed: " + sql)
+        try:
+            while driver.fetchRow():
+                oids[driver.getRowFieldString(1)] = int(driver.getRowFieldString(0))
+        finally:
+            driver.endQuery()
+    return oids
+
+
+def _loadChildrenBulk(query, parents, childType, batchSize=500):
+    """
+    Load all children of type childType, e.g. Arrival, of the parent
+    objects given as dict _oid -> object with one query per batch of
+    parents instead of one query per parent. Returns the loaded public
+    children as dict publicID -> object.
+    """
+    table = childType.TypeInfo().className()
+    public = childType.TypeInfo().isTypeOf(seiscomp.datamodel.PublicObject.TypeInfo())
+    oids = sorted(parents)
+    children = dict()
+    for i in range(0, len(oids), batchSize):
+        oidList = ",".join(str(oid) for oid in oids[i:i+batchSize])
+        if public:
+            sql = "select P%s.%s,%s.* from %s,PublicObject as P%s where %s._oid=P%s._oid and %s._parent_oid in (%s)" % (
+                table, query.driver().convertColumnName("publicID"), table, table, table, table, table, table, oidList)
+        else:
+            sql = "select %s.* from %s where %s._parent_oid in (%s)" % (table, table, table, oidList)
+        it = query.getObjectIterator(sql, childType.TypeInfo())
+        while it.get() is not None:
+            child = childType.Cast(it.get())
+            parent = parents.get(it.parentOid())
+            it.step()
+            if child is None or parent is None:
+                continue
+            parent.add(child)
+            if public:
+                children[child.publicID()] = child
+        it.close()
+        if len(oids) > batchSize:
+            seiscomp.logging.debug("loaded %s children of %d/%d objects" % (
+                table, min(i+batchSize, len(oids)), len(oids)))
+    return children
 
 
 def loadOriginsForEvent(query, publicID, full=False):
@@ -126,14 +193,16 @@ def loadOriginsForEvent(query, publicID, full=False):
     In a second query it also retrieves the FocalMechanism's, loads the
     MomentTensor children and the Origin's referenced from there.
 
-    Warning: This can be slow if full==True and if there are many origins.
+    If full==True, the children of the origins, i.e. arrivals, comments,
+    composite times, magnitudes and station magnitudes incl. their own
+    children, are loaded in bulk with one query per child type and batch of origins.
     """
-    origins = list()
+    origins = dict()
     for origin in query.getOrigins(publicID):
         origin = seiscomp.datamodel.Origin.Cast(origin)
         if not origin:
             continue
-        origins.append(origin)
+        origins[origin.publicID()] = origin
 
     focalMechanisms = list()
     for focalMechanism in query.getFocalMechanismsDescending(publicID):
@@ -145,19 +214,48 @@ def loadOriginsForEvent(query, publicID, full=False):
         for i in range(momentTensorCount):
             momentTensor = focalMechanism.momentTensor(i)
             derivedOriginID = momentTensor.derivedOriginID()
-            if derivedOriginID:
-                origin = loadOrigin(query, derivedOriginID, full=False)
-            origins.append(origin)
+            if not derivedOriginID or derivedOriginID in origins:
+                continue
+            origin = loadOrigin(query, derivedOriginID, full=False)
+            if origin is None:
+                seiscomp.logging.warning("%s: failed to load derived origin %s" % (publicID, derivedOriginID))
+                continue
+            origins[derivedOriginID] = origin
 
+    origins = list(origins.values())
     if not full:
         return origins
 
-    fullOrigins = list()
+    seiscomp.logging.debug("%s: loading children of %d origins" % (publicID, len(origins)))
+    oids = _publicObjectOids(query, [ origin.publicID() for origin in origins ])
+    parents = dict()
     for origin in origins:
-        fullOrigin = loadOrigin(query, origin.publicID(), full=full)
-        fullOrigins.append(fullOrigin)
+        if origin.publicID() in oids:
+            parents[oids[origin.publicID()]] = origin
+
+    Arrival = seiscomp.datamodel.Arrival
+    Comment = seiscomp.datamodel.Comment
+    CompositeTime = seiscomp.datamodel.CompositeTime
+    StationMagnitude = seiscomp.datamodel.StationMagnitude
+    StationMagnitudeContribution = seiscomp.datamodel.StationMagnitudeContribution
+
+    for childType in [ Arrival, Comment, CompositeTime, StationMagnitude, Magnitude ]:
+        children = _loadChildrenBulk(query, parents, childType)
+        seiscomp.logging.debug("%s: loaded %s children of %d origins" % (
+            publicID, childType.TypeInfo().className(), len(parents)))
+        if not children:
+            continue
+
+        # the children of the magnitudes and station magnitudes
+        oids = _publicObjectOids(query, children)
+        grandparents = dict( (oids[i], children[i]) for i in children if i in oids )
+        grandchildTypes = [ Comment ]
+        if childType == Magnitude:
+            grandchildTypes.append(StationMagnitudeContribution)
+        for grandchildType in grandchildTypes:
+            _loadChildrenBulk(query, grandparents, grandchildType)
 
-    return full_origins
+    return origins
 
 
 getOrigins = loadOriginsForEvent
@@ -177,7 +275,7 @@ def loadFocalMechanismsForEvent(query, publicID, full=False):
 
     fullFocalMechanisms = list()
     for focalMechanism in focalMechanisms:
-        fullFocalMechanism = loadfocalMechanism(query, focalMechanism.publicID(), full=full)
+        fullFocalMechanism = loadFocalMechanism(query, focalMechanism.publicID(), full=full)
         fullFocalMechanisms.append(fullFocalMechanism)
 
     return fullFocalMechanisms
@@ -437,11 +535,14 @@ def loadCompleteEvent(
 def loadPicksForTimespan(
         query, startTime, endTime,
         withAmplitudes=False,
-        authors=None):
+        authors=None,
+        amplitudeMargin=0):
 
     """
     Load from the database all picks within the given time span. If specified,
     also all amplitudes that reference any of these picks may be returned.
+    The amplitudes are searched within the time span extended by
+    amplitudeMargin seconds on both sides.
     """
 
     seiscomp.logging.debug("using author whitelist: "+str(authors))
@@ -471,7 +572,8 @@ def loadPicksForTimespan(
     if not withAmplitudes:
         return objects
         
-    for obj in query.getAmplitudes(startTime, endTime):
+    margin = seiscomp.core.TimeSpan(amplitudeMargin)
+    for obj in query.getAmplitudes(startTime - margin, endTime + margin):
         totalObjectCount += 1
         ampl = Amplitude.Cast(obj)
         if ampl:
@@ -489,3 +591,222 @@ def loadPicksForTimespan(
     seiscomp.logging.debug("loaded %d objects in total" % totalObjectCount)
 
     return objects
+
+
+def _sqlList(values):
+    return ", ".join("'%s'" % v.replace("'", "''") for v in values)
+
+
+def _timeBound(driver, table, column, op, t):
+    """
+    SQL condition comparing a time column with t using op (">=" or
+    "<="). Like SeisComP's own queries, the microseconds stored in
+    the separate _ms column are taken into account.
+    """
+    col = driver.convertColumnName
+    value = driver.timeToString(t)
+    return "(%s.%s%s'%s' or (%s.%s='%s' and %s.%s%s%d))" % (
+        table, col(column), op[0], value,
+        table, col(column), value,
+        table, col(column + "_ms"), op, t.microseconds())
+
+
+def iteratePicksForTimespan(
+        query, startTime, endTime,
+        withAmplitudes=False,
+        authors=None,
+        networkBlacklist=None,
+        amplitudeMargin=0):
+
+    """
+    Like loadPicksForTimespan, but the filtering by author whitelist and
+    network blacklist as well as the matching of amplitudes to picks is
+    done by the database. The objects are yielded while the rows are
+    streamed from the database, first all picks and then all amplitudes.
+
+    As only one query can be active at a time, no other query must be
+    issued while iterating.
+    """
+
+    driver = query.driver()
+    col = driver.convertColumnName
+
+    conditions = [
+        "Pick._oid=PPick._oid",
+        _timeBound(driver, "Pick", "time_value", ">=", startTime),
+        _timeBound(driver, "Pick", "time_value", "<=", endTime) ]
+    if authors:
+        conditions.append("Pick.%s in (%s)" % (col("creationInfo_author"), _sqlList(authors)))
+    if networkBlacklist:
+        conditions.append("Pick.%s not in (%s)" % (col("waveformID_networkCode"), _sqlList(networkBlacklist)))
+
+    sql = "select PPick.%s,Pick.* from Pick,PublicObject as PPick where %s" % (
+        col("publicID"), " and ".join(conditions))
+    pickCount = 0
+    for obj in query.getObjectIterator(sql, Pick.TypeInfo()):
+        pick = Pick.Cast(obj)
+        if pick:
+            pickCount += 1
+            yield pick
+    seiscomp.logging.debug("loaded %d picks" % pickCount)
+
+    if not withAmplitudes:
+        return
+
+    margin = seiscomp.core.TimeSpan(amplitudeMargin)
+    conditions += [
+        "Amplitude._oid=PAmplitude._oid",
+        "Amplitude.%s=PPick.%s" % (col("pickID"), col("publicID")),
+        _timeBound(driver, "Amplitude", "timeWindow_reference", ">=", startTime - margin),
+        _timeBound(driver, "Amplitude", "timeWindow_reference", "<=", endTime + margin) ]
+    sql = "select PAmplitude.%s,Amplitude.* from Amplitude,PublicObject as PAmplitude,Pick,PublicObject as PPick where %s" % (
+        col("publicID"), " and ".join(conditions))
+    amplitudeCount = 0
+    for obj in query.getObjectIterator(sql, Amplitude.TypeInfo()):
+        ampl = Amplitude.Cast(obj)
+        if ampl:
+            amplitudeCount += 1
+            yield ampl
+    seiscomp.logging.debug("loaded %d amplitudes" % amplitudeCount)
+
+
+def _loadPicksShard(databaseURI, startTime, endTime, **kwargs):
+    """
+    Load the picks and amplitudes of one shard through an own database
+    connection and return them in a temporary file.
+
+    This is the task performed by the worker processes.
+    """
+    db = seiscomp.io.DatabaseInterface.Open(databaseURI)
+    if db is None:
+        raise IOError("failed to open database " + databaseURI)
+    query = seiscomp.datamodel.DatabaseQuery(db)
+    startTime = seiscomp.core.Time(*startTime)
+    endTime = seiscomp.core.Time(*endTime)
+    ep = EventParameters()
+    for obj in iteratePicksForTimespan(query, startTime, endTime, **kwargs):
+        ep.add(obj)
+    filename = scstuff.util.writeObjectToTempFile(ep, "scstuff-shard-")
+    del ep
+    db.disconnect()
+    return filename
+
+
+def _objectTime(obj):
+    pick = Pick.Cast(obj)
+    if pick:
+        t = pick.time().value()
+    else:
+        try:
+            t = Amplitude.Cast(obj).timeWindow().reference()
+        except ValueError:
+            t = obj.creationInfo().creationTime()
+    return t.seconds() + 1.e-6*t.microseconds()
+
+
+def shardExecutor(shards=4):
+    """
+    Process pool for loadPicksForTimespanSharded. Pass it to several
+    calls, e.g. one per chunk of a long time span, to avoid starting
+    new processes for each call. Shut it down when done, e.g. by
+    using it as context manager.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    # The workers need nothing but the already imported modules.
+    context = multiprocessing.get_context("fork")
+    return concurrent.futures.ProcessPoolExecutor(shards, mp_context=context)
+
+
+def loadPicksForTimespanSharded(
+        databaseURI, startTime, endTime,
+        shards=4,
+        withAmplitudes=False,
+        authors=None,
+        networkBlacklist=None,
+        amplitudeMargin=0,
+        executor=None):
+
+    """
+    Load picks and optionally amplitudes like iteratePicksForTimespan,
+    but with the time span split into the given number of shards that
+    are queried concurrently by as many processes, each through an own
+    connection to the database given by its URI, e.g.
+    "sqlite3:///path/to/seiscomp.sqlite".
+
+    Returns a list of the objects ordered by time, i.e. pick time and
+    amplitude reference time. Objects found in more than one shard,
+    i.e. at the shard boundaries, are returned only once.
+
+    The publicIDs of the returned objects are not registered.
+
+    If no executor created by shardExecutor() is given, a process
+    pool is created for this call only.
+    """
+    import concurrent.futures
+    import heapq
+
+    length = float(endTime - startTime)
+    bounds = [ startTime + seiscomp.core.TimeSpan(length*i/shards) for i in range(shards) ]
+    bounds.append(endTime)
+
+    kwargs = dict(
+        withAmplitudes=withAmplitudes, authors=authors,
+        networkBlacklist=networkBlacklist, amplitudeMargin=amplitudeMargin)
+
+    pool = executor or shardExecutor(shards)
+    try:
+        futures = [
+            pool.submit(
+                _loadPicksShard, databaseURI,
+                (t1.seconds(), t1.microseconds()),
+                (t2.seconds(), t2.microseconds()), **kwargs)
+            for t1, t2 in zip(bounds[:-1], bounds[1:]) ]
+        concurrent.futures.wait(futures)
+    finally:
+        if executor is None:
+            pool.shutdown()
+
+    # All shards are finished here, successfully or not.
+    filenames = [ future.result() for future in futures if future.exception() is None ]
+    errors = [ future.exception() for future in futures if future.exception() is not None ]
+    if errors:
+        for filename in filenames:
+            os.unlink(filename)
+        raise errors[0]
+
+    # Boundary objects occur in two shards and therefore must not
+    # be registered while reading the shards.
+    registrationEnabled = seiscomp.datamodel.PublicObject.IsRegistrationEnabled()
+    seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False)
+    try:
+        results = []
+        for filename in filenames:
+            ep = EventParameters.Cast(scstuff.util.readObjectFromTempFile(filename))
+            objects = []
+            while ep.pickCount() > 0:
+                # FIXME: The cast hack forces the SeisComP refcounter to be increased.
+                obj = Pick.Cast(ep.pick(0))
+                ep.removePick(0)
+                objects.append( (_objectTime(obj), len(objects), obj) )
+            while ep.amplitudeCount() > 0:
+                obj = Amplitude.Cast(ep.amplitude(0))
+                ep.removeAmplitude(0)
+                objects.append( (_objectTime(obj), len(objects), obj) )
+            del ep
+            objects.sort(key=lambda item: item[:2])
+            results.append(objects)
+    finally:
+        seiscomp.datamodel.PublicObject.SetRegistrationEnabled(registrationEnabled)
+
+    merged = []
+    seen = set()
+    for t, i, obj in heapq.merge(*results, key=lambda item: item[0]):
+        publicID = obj.publicID()
+        if publicID in seen:
+            continue
+        seen.add(publicID)
+        merged.append(obj)
+    seiscomp.logging.debug("loaded %d objects from %d shards" % (len(merged), shards))
+    return merged
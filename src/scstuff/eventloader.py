@@ -15,19 +15,134 @@
 # https://www.gnu.org/licenses/agpl-3.0.html.                             #
 ###########################################################################
 
+import os
+import sys
+import concurrent.futures
+import multiprocessing
+import seiscomp.core
 import seiscomp.client
 import seiscomp.datamodel
+import seiscomp.io
 import seiscomp.logging
+import scstuff.dbutil
 import scstuff.util
+import scstuff.querytrace
+
+
+def loadEventParameters(query, eventID):
+    """
+    Load from the database for the given event:
+    - event
+    - preferred origin
+    - preferred focal mechanism incl. moment tensors and derived origin
+    - picks
+    - amplitudes
+
+    Returns an EventParameters instance or None if the event or its
+    preferred origin could not be loaded.
+    """
+    evt = scstuff.dbutil.loadEvent(query, eventID)
+    if not evt:
+        seiscomp.logging.error("unknown Event '%s'" % eventID)
+        return
+
+    originID = evt.preferredOriginID()
+    org = scstuff.dbutil.loadOrigin(query, originID)
+    if not org:
+        seiscomp.logging.error("unknown Origin '%s'" % originID)
+        return
+
+    fm = None
+    derivedOrigins = []
+    fmID = evt.preferredFocalMechanismID()
+    if fmID:
+        fm = scstuff.dbutil.loadFocalMechanism(query, fmID)
+        if fm is None:
+            seiscomp.logging.error("unknown FocalMechanism '%s'" % fmID)
+    if fm:
+        for i in range(fm.momentTensorCount()):
+            mt = fm.momentTensor(i)
+            derivedOriginID = mt.derivedOriginID()
+            if not derivedOriginID or derivedOriginID == originID:
+                continue
+            # the derived origin contains the moment magnitude
+            derivedOrigin = scstuff.dbutil.loadOrigin(query, derivedOriginID)
+            if derivedOrigin:
+                derivedOrigins.append(derivedOrigin)
+
+    pick = {}
+    for obj in query.getPicks(originID):
+        p = seiscomp.datamodel.Pick.Cast(obj)
+        key = p.publicID()
+        pick[key] = p
+
+    ampl = {}
+    for obj in query.getAmplitudesForOrigin(originID):
+        amp = seiscomp.datamodel.Amplitude.Cast(obj)
+        key = amp.publicID()
+        ampl[key] = amp
+
+    # create and populate EventParameters instance
+    ep = seiscomp.datamodel.EventParameters()
+    ep.add(evt)
+    ep.add(org)
+    for derivedOrigin in derivedOrigins:
+        ep.add(derivedOrigin)
+    if fm:
+        ep.add(fm)
+
+    for key in pick:
+        ep.add(pick[key])
+    for key in ampl:
+        ep.add(ampl[key])
+    return ep
+
+
+# database query of a worker process
+_workerQuery = None
+
+
+def _initWorker(databaseURI, traced=False):
+    global _workerQuery
+    db = seiscomp.io.DatabaseInterface.Open(databaseURI)
+    if db is None:
+        raise IOError("failed to open database " + databaseURI)
+    _workerQuery = seiscomp.datamodel.DatabaseQuery(db)
+    if traced:
+        _workerQuery = scstuff.querytrace.TracedQuery(_workerQuery)
+
+
+def _loadEventToFile(eventID):
+    """
+    Load the event parameters for one event and return them in a
+    temporary file.
+
+    This is the task performed by the worker processes. Returns the
+    file name, None if the event could not be loaded, and the
+    database calls recorded meanwhile if traced.
+    """
+    ep = loadEventParameters(_workerQuery, eventID)
+    calls = []
+    if isinstance(_workerQuery, scstuff.querytrace.TracedQuery):
+        calls = _workerQuery.takeCalls()
+    if ep is None:
+        return None, calls
+    filename = scstuff.util.writeObjectToTempFile(ep, "scstuff-event-")
+    del ep
+    return filename, calls
 
 
 class EventLoaderApp(seiscomp.client.Application):
     """
     Reads event parameters either
-      * from a SeisComP database (for a specific event) or
+      * from a SeisComP database (for a specific event, a list of
+        events or all events within a time window) or
       * from a SeisComP XML file (for potentially more than one event)
       
-    An EventParameters instance is created to be used by derived classes.
+    An EventParameters instance is created to be used by derived classes,
+    either via readEventParameters() for a single event or via
+    processEventParameters(), which passes one instance per event to
+    a handler as soon as it is loaded.
     """
 
     def __init__(self, argc, argv):
@@ -38,6 +153,7 @@ class EventLoaderApp(seiscomp.client.Application):
         self.setDaemonEnabled(False)
         self.setRecordStreamEnabled(False)
         self._xmlFile = None
+        self._tracedQuery = None
 
     def setXmlEnabled(self, enable=True):
         """ To be called from __init__() """
@@ -60,6 +176,15 @@ class EventLoaderApp(seiscomp.client.Application):
 
         if self.xmlEnabled():
             self.commandline().addStringOption("Input", "xml", "specify xml file")
+
+        self.commandline().addStringOption("Input", "event-list", "file with IDs of events to dump, one per line")
+        self.commandline().addStringOption("Input", "begin", "dump all events with origin time after this time")
+        self.commandline().addStringOption("Input", "end", "dump all events with origin time before this time")
+        self.commandline().addStringOption("Input", "workers", "number of concurrent database connections used to load multiple events (default: 4)")
+
+        self.commandline().addGroup("Query")
+        self.commandline().addOption("Query", "query-stats", "log a summary of the database queries at the end")
+        self.commandline().addStringOption("Query", "query-trace", "write a trace of all database queries to the specified file")
         return True
 
     def validateParameters(self):
@@ -83,39 +208,63 @@ class EventLoaderApp(seiscomp.client.Application):
         except:
             self._eventID = None
 
+        try:
+            self._eventListFile = self.commandline().optionString("event-list")
+        except:
+            self._eventListFile = None
+
+        try:
+            self._beginTime = scstuff.util.parseTime(self.commandline().optionString("begin"))
+        except RuntimeError:
+            self._beginTime = None
+        except ValueError as e:
+            seiscomp.logging.error("--begin: %s" % str(e))
+            return False
+        try:
+            self._endTime = scstuff.util.parseTime(self.commandline().optionString("end"))
+        except RuntimeError:
+            self._endTime = None
+        except ValueError as e:
+            seiscomp.logging.error("--end: %s" % str(e))
+            return False
+
+        try:
+            self._workers = int(self.commandline().optionString("workers"))
+        except:
+            self._workers = 4
+
         if self._xmlFile:
             self.setDatabaseEnabled(False, False)
         else:
             self.setDatabaseEnabled(True, True)
 
         return True
-    
-    def _loadEvent(self, publicID):
-        # load an Event object from database
-        tp = seiscomp.datamodel.Event
-        obj = self.query().loadObject(tp.TypeInfo(), publicID)
-        obj = tp.Cast(obj)
-        if obj is None:
-            seiscomp.logging.error("unknown Event '%s'" % publicID)
-        return obj
-
-    def _loadOrigin(self, publicID):
-        # load an Origin object from database
-        tp = seiscomp.datamodel.Origin
-        obj = self.query().loadObject(tp.TypeInfo(), publicID)
-        obj = tp.Cast(obj)
-        if obj is None:
-            seiscomp.logging.error("unknown Origin '%s'" % publicID)
-        return obj
-
-    def _loadFocalMechanism(self, publicID):
-        # load a FocalMechanism object from database
-        tp = seiscomp.datamodel.FocalMechanism
-        obj = self.query().loadObject(tp.TypeInfo(), publicID)
-        obj = tp.Cast(obj)
-        if obj is None:
-            seiscomp.logging.error("unknown FocalMechanism '%s'" % publicID)
-        return obj
+
+    def query(self):
+        """
+        The database query, wrapped in a TracedQuery if requested
+        via --query-stats or --query-trace.
+        """
+        query = seiscomp.client.Application.query(self)
+        if query is None:
+            return None
+        if not self.commandline().hasOption("query-stats") and \
+           not self.commandline().hasOption("query-trace"):
+            return query
+        if self._tracedQuery is None:
+            try:
+                traceFile = self.commandline().optionString("query-trace")
+            except:
+                traceFile = None
+            self._tracedQuery = scstuff.querytrace.TracedQuery(query, traceFile)
+        return self._tracedQuery
+
+    def done(self):
+        if self._tracedQuery is not None:
+            if self.commandline().hasOption("query-stats"):
+                self._tracedQuery.logSummary()
+            self._tracedQuery.close()
+        seiscomp.client.Application.done(self)
 
     def _readEventParametersFromXML(self):
         """
@@ -129,54 +278,9 @@ class EventLoaderApp(seiscomp.client.Application):
 
     def _readEventParametersFromDatabase(self):
         """
-        Read from the database for the event specified as self._eventID:
-        - event
-        - preferred origin
-        - picks
-        - amplitudes
+        Read from the database for the event specified as self._eventID.
         """
-        evt = self._loadEvent(self._eventID)
-        if not evt:
-            return
-
-        originID = evt.preferredOriginID()
-        org = self._loadOrigin(originID)
-        if not org:
-            return
-
-        fmID = evt.preferredFocalMechanismID()
-        fm = self._loadFocalMechanism(fmID)
-        if fm:
-            mt = fm.momentTensor(0)
-            derivedOriginID = mt.derivedOriginID()
-            derivedOrigin = self._loadOrigin(derivedOriginID)
-            mmid = mt.momentMagnitudeID()
-
-        pick = {}
-        for obj in self.query().getPicks(originID):
-            p = seiscomp.datamodel.Pick.Cast(obj)
-            key = p.publicID()
-            pick[key] = p
-
-        ampl = {}
-        for obj in self.query().getAmplitudesForOrigin(originID):
-            amp = seiscomp.datamodel.Amplitude.Cast(obj)
-            key = amp.publicID()
-            ampl[key] = amp
-
-        # create and populate EventParameters instance
-        ep = seiscomp.datamodel.EventParameters()
-        ep.add(evt)
-        ep.add(org)
-        if fm:
-            ep.add(fm)
-
-        for key in pick:
-            ep.add(pick[key])
-        for key in ampl:
-            ep.add(ampl[key])
-        return ep
-        # TODO: focal mechanisms for completeness
+        return loadEventParameters(self.query(), self._eventID)
 
     def readEventParameters(self):
         """
@@ -201,3 +305,119 @@ class EventLoaderApp(seiscomp.client.Application):
             ep = self._readEventParametersFromDatabase()
 
         return ep
+
+    def eventIDs(self):
+        """
+        The IDs of the events to load from the database, given either
+        via --event, --event-list or the time window --begin/--end.
+        """
+        if self._eventID:
+            return [ self._eventID ]
+
+        if self._eventListFile:
+            f = sys.stdin if self._eventListFile == "-" else open(self._eventListFile)
+            eventIDs = []
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    eventIDs.append(line.split()[0])
+            return eventIDs
+
+        if self._beginTime or self._endTime:
+            begin = self._beginTime or seiscomp.core.Time(0)
+            end = self._endTime or seiscomp.core.Time.GMT()
+            eventIDs = []
+            for obj in self.query().getEvents(begin, end):
+                evt = seiscomp.datamodel.Event.Cast(obj)
+                if evt:
+                    eventIDs.append(evt.publicID())
+            return eventIDs
+
+        return []
+
+    def iterEventParameters(self, eventIDs):
+        """
+        Load the event parameters of the given events from the database
+        and yield one EventParameters instance per event as soon as it
+        is loaded, which need not be in the order of the event IDs.
+
+        Up to the specified number of workers are used concurrently,
+        each running in an own process with an own database connection.
+        If the database URI is not known, e.g. if it was obtained via
+        messaging, the events are loaded sequentially. If queries are
+        traced, the workers trace their queries as well and the calls
+        are merged into the trace of self.query().
+        """
+        query = self.query()
+        if self._workers <= 1 or len(eventIDs) <= 1 or not self.databaseURI():
+            for eventID in eventIDs:
+                ep = loadEventParameters(query, eventID)
+                if ep is not None:
+                    yield ep
+            return
+
+        tracer = query if isinstance(query, scstuff.querytrace.TracedQuery) else None
+
+        # We explicitly fork as the workers need nothing but the
+        # already imported SeisComP modules.
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(
+                self._workers, mp_context=context,
+                initializer=_initWorker, initargs=(self.databaseURI(), tracer is not None)) as executor:
+            pending = set()
+            ready = []
+            eventIDs = list(eventIDs)
+            loaded = 0
+            try:
+                while eventIDs or pending:
+                    # keep the number of loaded but not yet handled events small
+                    while eventIDs and len(pending) < 2*self._workers:
+                        pending.add(executor.submit(_loadEventToFile, eventIDs.pop(0)))
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    ready = list(done)
+                    while ready:
+                        filename, calls = ready.pop().result()
+                        if tracer is not None:
+                            tracer.merge(calls)
+                        if filename is None:
+                            continue
+                        ep = seiscomp.datamodel.EventParameters.Cast(
+                            scstuff.util.readObjectFromTempFile(filename))
+                        loaded += 1
+                        seiscomp.logging.debug("loaded %d events, %d pending" % (loaded, len(pending)+len(eventIDs)))
+                        yield ep
+            finally:
+                # Don't leave any temporary files behind if we stop early.
+                for future in pending:
+                    future.cancel()
+                for future in list(pending) + ready:
+                    if not future.cancelled() and future.exception() is None and future.result()[0]:
+                        os.unlink(future.result()[0])
+
+    def processEventParameters(self, handler):
+        """
+        Read the event parameters from either an XML file or from the
+        database and pass them to handler, a callable taking an
+        EventParameters instance. From the database, one instance per
+        event is passed as soon as it is loaded, while the other events
+        are still loading.
+        """
+        if self._xmlFile:
+            handler(self._readEventParametersFromXML())
+            return True
+
+        eventIDs = self.eventIDs()
+        if not eventIDs:
+            seiscomp.logging.error("need to specify events to read from database")
+            return False
+
+        events = self.iterEventParameters(eventIDs)
+        try:
+            for ep in events:
+                handler(ep)
+                if self.isExitRequested():
+                    return False
+        finally:
+            events.close()
+        return True
@@ -15,8 +15,14 @@
 ###########################################################################
 
 
+import array
+import fnmatch
+import fractions
+import math
+import seiscomp.core
 import seiscomp.datamodel
 import seiscomp.io
+import scstuff.util
 
 
 def operational(obj, time):
@@ -133,17 +139,10 @@ def inventoryFromStationLocationFile(filename):
 def readInventoryFromXML(xmlFile="-"):
     """
     Reads an Inventory root element from a (possibly gzipped)
-    SeisComP XML file.
-    """
-    ar = seiscomp.io.XMLArchive()
-    if xmlFile.lower().endswith(".gz"):
-        ar.setCompression(True)
-        ar.setCompressionMethod(seiscomp.io.XMLArchive.GZIP)
-    if ar.open(xmlFile) is False:
-        raise IOError(xmlFile + ": unable to open")
-    obj = ar.readObject()
-    if obj is None:
-        raise TypeError(xmlFile + ": invalid format")
+    SeisComP XML file or a binary file, see
+    scstuff.util.readObjectFromFile().
+    """
+    obj = scstuff.util.readObjectFromFile(xmlFile)
     inv = seiscomp.datamodel.Inventory.Cast(obj)
     if inv is None:
         raise TypeError(xmlFile + ": no inventory found")
@@ -183,25 +182,382 @@ def streamComponents(inventory, time, net_sta_blacklist=None):
     """
     Returns a dict with stream id (n,s,l,c[:2]) as key, and a list
     of component codes (c[2]) as values, valid for the specified time.
+
+    The inventory may also be given as StreamTable, which is much
+    faster if the components are needed for more than one time.
     """
 
     components = dict()
 
-    inv = InventoryIterator(inventory, time)
-    for network, station, location, stream in inv:
+    if isinstance(inventory, StreamTable):
+        table = inventory
+        indices = table.select(time)
+        # The stream id is computed once per distinct combination
+        # of codes.
+        ids = dict()
+        for i in indices:
+            key = (table.network[i], table.station[i], table.location[i], table.stream[i])
+            item = ids.get(key)
+            if item is None:
+                net, sta, loc, cha = table.codes(i)
+                if net_sta_blacklist and (net, sta) in net_sta_blacklist:
+                    item = ids[key] = False
+                else:
+                    item = ids[key] = ((net, sta, loc or "--", cha[:2]), cha[2])
+            if item:
+                nslc, comp = item
+                components.setdefault(nslc, []).append(comp)
+        return components
+
+    for network, station, location, stream in InventoryIterator(inventory, time):
         net = network.code()
         sta = station.code()
         if net_sta_blacklist and (net, sta) in net_sta_blacklist:
             continue
-        loc = location.code()
-        cha =   stream.code()
-        if loc == "":
-            loc = "--"
-        comp = cha[2]
-        cha = cha[:2]
-        nslc = (net, sta, loc, cha)
-        if nslc not in components:
-            components[nslc] = []
-        components[nslc].append(comp)
+        loc = location.code() or "--"
+        cha = stream.code()
+        components.setdefault((net, sta, loc, cha[:2]), []).append(cha[2])
 
     return components
+
+
+def _ranking(codes, normalize=None):
+    # The ranking as dict code -> position. Codes not listed are
+    # ranked last if the ranking contains the wildcard "*", otherwise
+    # they are not listed in the dict, i.e. have no rank.
+    ranking = dict()
+    for position, code in enumerate(codes):
+        if normalize:
+            code = normalize(code)
+        ranking.setdefault(code, position)
+    last = len(codes) if "*" in ranking else None
+    return ranking, last
+
+
+def selectStreams(streams, bandCodes="BHS", instrumentCodes="H", locationCodes=("*",)):
+    """
+    From a list of (net, sta, loc, cha) tuples select for each
+    station the stream group with the highest priority.
+
+    A stream group consists of all components of a location code and
+    stream code, i.e. the first two characters of the channel code.
+    The priority is given by the positions of band code, instrument
+    code and location code in the respective ranking, which may be
+    a string or a list of codes. Codes not contained in the ranking
+    are not considered unless the ranking contains "*", in which
+    case they are ranked last. The empty location code may be given
+    as "" or "--".
+
+    With the default ranking, BH streams are preferred over HH and
+    SH streams, with any location code.
+
+    The selected tuples are returned as list in their original order.
+    """
+    bandRanking, bandLast = _ranking(bandCodes)
+    instrumentRanking, instrumentLast = _ranking(instrumentCodes)
+    locationRanking, locationLast = _ranking(locationCodes, lambda code: code or "--")
+
+    best = dict()
+    for net, sta, loc, cha in streams:
+        band = bandRanking.get(cha[0], bandLast)
+        instrument = instrumentRanking.get(cha[1], instrumentLast)
+        location = locationRanking.get(loc or "--", locationLast)
+        if band is None or instrument is None or location is None:
+            continue
+        rank = (band, instrument, location, loc, cha[:2])
+        key = (net, sta)
+        if key not in best or rank < best[key]:
+            best[key] = rank
+
+    selected = list()
+    for net, sta, loc, cha in streams:
+        rank = best.get((net, sta))
+        if rank is not None and rank[3:] == (loc, cha[:2]):
+            selected.append( (net, sta, loc, cha) )
+    return selected
+
+
+def _timeToFloat(t):
+    return t.seconds() + 1.e-6*t.microseconds()
+
+
+def _floatToTime(t):
+    seconds = math.floor(t)
+    return seiscomp.core.Time(int(seconds), int(round((t - seconds)*1.e6)))
+
+
+class StreamTable:
+    """
+    Compact flat table of the stream epochs of an inventory.
+
+    Each row is one stream epoch. The codes are interned, i.e. stored
+    as indices into a shared list of distinct codes, all other values
+    as float arrays: the epoch (the intersection of the network,
+    station, location and stream epochs, NaN start if unknown and inf
+    end if open), station coordinates, gain, gain frequency and sample
+    rate. Unlike with InventoryIterator, filtering and grouping never
+    touch the SeisComP objects. Code filters are evaluated once per
+    distinct code rather than once per row.
+    """
+
+    __slots__ = (
+        "_codes", "_codeIndex",
+        "network", "station", "location", "stream",
+        "start", "end", "latitude", "longitude", "elevation",
+        "gain", "gainFrequency", "sampleRate" )
+
+    _codeColumns = ( "network", "station", "location", "stream" )
+    _floatColumns = (
+        "start", "end", "latitude", "longitude", "elevation",
+        "gain", "gainFrequency", "sampleRate" )
+
+    def __init__(self, codes=None):
+        # codes shared with subtables of the same table
+        if codes is None:
+            codes = ( [], {} )
+        self._codes, self._codeIndex = codes
+        for name in self._codeColumns:
+            setattr(self, name, array.array("I"))
+        for name in self._floatColumns:
+            setattr(self, name, array.array("d"))
+
+    def _intern(self, code):
+        index = self._codeIndex.get(code)
+        if index is None:
+            index = self._codeIndex[code] = len(self._codes)
+            self._codes.append(code)
+        return index
+
+    def append(self, net, sta, loc, cha, start=math.nan, end=math.inf,
+               latitude=math.nan, longitude=math.nan, elevation=math.nan,
+               gain=math.nan, gainFrequency=math.nan, sampleRate=math.nan):
+        self.network.append(self._intern(net))
+        self.station.append(self._intern(sta))
+        self.location.append(self._intern(loc))
+        self.stream.append(self._intern(cha))
+        for name, value in zip(self._floatColumns, (
+                start, end, latitude, longitude, elevation,
+                gain, gainFrequency, sampleRate)):
+            getattr(self, name).append(value)
+
+    @classmethod
+    def fromInventory(cls, inventory):
+        """
+        Convert an Inventory into a StreamTable in one pass.
+        """
+        def optional(get):
+            try:
+                return get()
+            except ValueError:
+                return math.nan
+
+        table = cls()
+        for inet in range(inventory.networkCount()):
+            network = inventory.network(inet)
+            net = network.code()
+            for ista in range(network.stationCount()):
+                station = network.station(ista)
+                sta = station.code()
+                lat = optional(station.latitude)
+                lon = optional(station.longitude)
+                elev = optional(station.elevation)
+                for iloc in range(station.sensorLocationCount()):
+                    location = station.sensorLocation(iloc)
+                    loc = location.code()
+                    for istr in range(location.streamCount()):
+                        stream = location.stream(istr)
+                        start, end = -math.inf, math.inf
+                        for obj in (network, station, location, stream):
+                            try:
+                                start = max(start, _timeToFloat(obj.start()))
+                            except ValueError:
+                                start = math.nan
+                                break
+                        for obj in (network, station, location, stream):
+                            try:
+                                end = min(end, _timeToFloat(obj.end()))
+                            except ValueError:
+                                pass
+                        try:
+                            sampleRate = stream.sampleRateNumerator()/stream.sampleRateDenominator()
+                        except (ValueError, ZeroDivisionError):
+                            sampleRate = math.nan
+                        table.append(
+                            net, sta, loc, stream.code(), start, end,
+                            lat, lon, elev,
+                            optional(stream.gain), optional(stream.gainFrequency),
+                            sampleRate)
+        return table
+
+    def __len__(self):
+        return len(self.network)
+
+    def codes(self, i):
+        """
+        (net, sta, loc, cha) of row i
+        """
+        c = self._codes
+        return c[self.network[i]], c[self.station[i]], c[self.location[i]], c[self.stream[i]]
+
+    def rows(self):
+        for i in range(len(self)):
+            yield self.codes(i)
+
+    def take(self, indices):
+        """
+        New table with the given rows, sharing the codes with this one
+        """
+        table = StreamTable((self._codes, self._codeIndex))
+        for name in self._codeColumns + self._floatColumns:
+            column = getattr(self, name)
+            getattr(table, name).extend(column[i] for i in indices)
+        return table
+
+    def _matchingCodes(self, pattern):
+        # indices of the distinct codes matching the pattern
+        return set(i for i, code in enumerate(self._codes) if fnmatch.fnmatchcase(code, pattern))
+
+    def select(self, time=None, net="*", sta="*", loc="*", cha="*"):
+        """
+        Indices of the rows operational at the given time (if any)
+        and matching the code patterns, which may contain wildcards.
+        """
+        indices = range(len(self))
+        for name, pattern in zip(self._codeColumns, (net, sta, loc, cha)):
+            if pattern == "*":
+                continue
+            matching = self._matchingCodes(pattern)
+            column = getattr(self, name)
+            indices = [ i for i in indices if column[i] in matching ]
+        if time is not None:
+            t = _timeToFloat(time)
+            start, end = self.start, self.end
+            indices = [ i for i in indices if start[i] <= t <= end[i] ]
+        return list(indices)
+
+    def filter(self, time=None, net="*", sta="*", loc="*", cha="*"):
+        """
+        New table with the rows selected by select()
+        """
+        return self.take(self.select(time, net, sta, loc, cha))
+
+    def groupBy(self, key):
+        """
+        Group the rows by a key computed from (net, sta, loc, cha),
+        e.g. lambda n, s, l, c: (n, s, l, c[:2]). Returns a dict of
+        key -> list of row indices. The key is computed only once per
+        distinct combination of codes.
+        """
+        groups = dict()
+        keys = dict()
+        c = self._codes
+        columns = self.network, self.station, self.location, self.stream
+        for i, ids in enumerate(zip(*columns)):
+            k = keys.get(ids)
+            if k is None:
+                k = keys[ids] = key(c[ids[0]], c[ids[1]], c[ids[2]], c[ids[3]])
+            group = groups.get(k)
+            if group is None:
+                group = groups[k] = []
+            group.append(i)
+        return groups
+
+    def _envelope(self, indices):
+        # The envelope (start, end) of the epochs of the given rows.
+        # If any start is unknown (NaN), so is the start of the
+        # envelope. Note that min() is not reliable with NaN.
+        starts = [ self.start[i] for i in indices ]
+        if any(math.isnan(t) for t in starts):
+            start = math.nan
+        else:
+            start = min(starts)
+        return start, max(self.end[i] for i in indices)
+
+    def _coordinates(self, i):
+        # (lat, lon, elev) of row i with None for unknown values, as
+        # NaN never compares equal
+        return tuple(None if math.isnan(v) else v for v in (
+            self.latitude[i], self.longitude[i], self.elevation[i]))
+
+    def toInventory(self):
+        """
+        Convert the table into an Inventory with networks, stations,
+        sensor locations and streams but without instrument responses.
+
+        Rows of a station with different coordinates become separate
+        station epochs, as do their sensor locations. The network,
+        station and location epochs are the envelopes of the stream
+        epochs, with unknown start if any stream start is unknown.
+        """
+        def setEpoch(obj, start, end):
+            if not math.isnan(start) and start > -math.inf:
+                obj.setStart(_floatToTime(start))
+            if end < math.inf:
+                obj.setEnd(_floatToTime(end))
+
+        # rows per sensor location of each station epoch, the latter
+        # identified by the station coordinates
+        locations = dict()
+        for i, (net, sta, loc, cha) in enumerate(self.rows()):
+            key = (net, sta, self._coordinates(i), loc)
+            locations.setdefault(key, []).append(i)
+
+        rows = dict()
+        for (net, sta, coordinates, loc), indices in locations.items():
+            for key in (net,), (net, sta, coordinates):
+                rows.setdefault(key, []).extend(indices)
+        epochs = dict( (key, self._envelope(indices)) for key, indices in rows.items() )
+
+        def order(item):
+            # station epochs in chronological order, the first row
+            # decides between station epochs of equal start
+            (net, sta, coordinates, loc), indices = item
+            start = epochs[net, sta, coordinates][0]
+            if math.isnan(start):
+                start = -math.inf
+            return net, sta, start, min(rows[net, sta, coordinates]), loc
+
+        inventory = seiscomp.datamodel.Inventory()
+        objects = dict()
+        for (net, sta, coordinates, loc), indices in sorted(locations.items(), key=order):
+            network = objects.get((net,))
+            if network is None:
+                network = objects[net,] = seiscomp.datamodel.Network.Create()
+                network.setCode(net)
+                setEpoch(network, *epochs[net,])
+                inventory.add(network)
+
+            station = objects.get((net, sta, coordinates))
+            if station is None:
+                station = objects[net, sta, coordinates] = seiscomp.datamodel.Station.Create()
+                station.setCode(sta)
+                setEpoch(station, *epochs[net, sta, coordinates])
+                lat, lon, elev = coordinates
+                if lat is not None:
+                    station.setLatitude(lat)
+                if lon is not None:
+                    station.setLongitude(lon)
+                if elev is not None:
+                    station.setElevation(elev)
+                network.add(station)
+
+            location = seiscomp.datamodel.SensorLocation.Create()
+            location.setCode(loc)
+            setEpoch(location, *self._envelope(indices))
+            station.add(location)
+
+            for i in indices:
+                stream = seiscomp.datamodel.Stream.Create()
+                stream.setCode(self._codes[self.stream[i]])
+                setEpoch(stream, self.start[i], self.end[i])
+                if not math.isnan(self.gain[i]):
+                    stream.setGain(self.gain[i])
+                if not math.isnan(self.gainFrequency[i]):
+                    stream.setGainFrequency(self.gainFrequency[i])
+                if not math.isnan(self.sampleRate[i]):
+                    rate = fractions.Fraction(self.sampleRate[i]).limit_denominator(1000000)
+                    stream.setSampleRateNumerator(rate.numerator)
+                    stream.setSampleRateDenominator(rate.denominator)
+                location.add(stream)
+
+        return inventory
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+# Copyright (C) GFZ Potsdam                                               #
+# All rights reserved.                                                    #
+#                                                                         #
+# Author: Joachim Saul (saul@gfz-potsdam.de)                              #
+#                                                                         #
+# GNU Affero General Public License Usage                                 #
+# This file may be used under the terms of the GNU Affero                 #
+# Public License version 3.0 as published by the Free Software Foundation #
+# and appearing in the file LICENSE included in the packaging of this     #
+# file. Please review the following information to ensure the GNU Affero  #
+# Public License version 3.0 requirements will be met:                    #
+# https://www.gnu.org/licenses/agpl-3.0.html.                             #
+###########################################################################
+
+"""
+Cached snapshot of the inventory for inventory-dependent tools.
+
+Loading the full inventory from the database takes long for large
+inventories. The snapshot is kept in a subdirectory of a directory,
+one per generation of the snapshot, and consists of
+
+  * streams.bin: one fixed-size record per stream epoch with codes,
+    coordinates and gain, read via mmap,
+  * inventory.scbin: the full inventory incl. responses as binary
+    archive, only read if needed,
+  * stamp: the state of the inventory tables when the snapshot was
+    taken.
+
+The file 'current' in the directory names the current generation. It
+is replaced last, so that the files of a snapshot are published
+together and an interrupted update leaves the previous snapshot in
+place.
+
+The snapshot is rebuilt only if the inventory in the database has
+changed, which is checked with a single cheap query.
+"""
+
+import collections
+import math
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import seiscomp.datamodel
+import seiscomp.io
+import seiscomp.logging
+from scstuff.inventory import InventoryIterator, _timeToFloat
+
+
+_magic = b"SCINVSN1"
+_header = struct.Struct("<8sQ")
+_record = struct.Struct("<8s8s8s8sddddddd16s")
+# sizes of the string fields of a record
+_codeSize, _unitSize = 8, 16
+
+# Inventory tables whose row count and latest modification determine
+# the state of the inventory
+_tables = [
+    "Network", "Station", "SensorLocation", "Stream",
+    "Sensor", "SensorCalibration", "Datalogger", "DataloggerCalibration",
+    "Decimation", "ResponsePAZ", "ResponseFIR", "ResponseIIR",
+    "ResponsePolynomial", "ResponseFAP" ]
+
+
+StreamEpoch = collections.namedtuple("StreamEpoch", [
+    "network", "station", "location", "stream", "start", "end",
+    "latitude", "longitude", "elevation",
+    "gain", "gainFrequency", "gainUnit" ])
+
+
+def _epoch(objs):
+    """
+    The intersection of the epochs of the objects, e.g. network,
+    station, location and stream, as (start, end). Returns None if
+    any start time is unknown.
+    """
+    start, end = -math.inf, math.inf
+    for obj in objs:
+        try:
+            start = max(start, _timeToFloat(obj.start()))
+        except ValueError:
+            return None
+        try:
+            end = min(end, _timeToFloat(obj.end()))
+        except ValueError:
+            pass
+    return start, end
+
+
+def _optional(get, default):
+    try:
+        return get()
+    except ValueError:
+        return default
+
+
+def _encode(value, size, what):
+    # struct.pack would silently truncate longer strings
+    data = value.encode()
+    if len(data) > size:
+        raise ValueError("%s '%s' exceeds the %d bytes of an inventory snapshot record" % (what, value, size))
+    return data
+
+
+def _currentGeneration(directory):
+    """
+    The directory of the current generation of the snapshot or None
+    """
+    try:
+        with open(os.path.join(directory, "current")) as f:
+            name = f.read().strip()
+    except IOError:
+        return None
+    if not name:
+        return None
+    return os.path.join(directory, name)
+
+
+def inventoryStamp(query):
+    """
+    The current state of the inventory in the database as string or
+    None if it could not be determined.
+    """
+    driver = query.driver()
+    fields = []
+    for table in _tables:
+        fields.append("(select count(*) from %s)" % table)
+        fields.append("(select max(_last_modified) from %s)" % table)
+    if not driver.beginQuery("select " + ",".join(fields)):
+        return None
+    try:
+        if not driver.fetchRow():
+            return None
+        values = []
+        for i in range(driver.getRowFieldCount()):
+            value = driver.getRowFieldString(i)
+            values.append(value if value is not None else "")
+    finally:
+        driver.endQuery()
+    return "|".join(values)
+
+
+def writeInventorySnapshot(inventory, directory, stamp):
+    os.makedirs(directory, exist_ok=True)
+    previous = _currentGeneration(directory)
+    generation = tempfile.mkdtemp(prefix="snapshot-", dir=directory)
+    try:
+        count = _writeGeneration(inventory, generation, stamp)
+
+        # Publish the new generation with a single atomic replace.
+        fd, tmp = tempfile.mkstemp(".tmp", "current-", directory)
+        with os.fdopen(fd, "w") as f:
+            f.write(os.path.basename(generation))
+        os.replace(tmp, os.path.join(directory, "current"))
+    except:
+        shutil.rmtree(generation, ignore_errors=True)
+        raise
+    seiscomp.logging.debug("wrote inventory snapshot with %d stream epochs" % count)
+
+    # Remove older generations. The previous one is kept for readers
+    # that opened it but didn't read the inventory yet.
+    keep = set([ generation, previous ])
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith("snapshot-") and path not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _writeGeneration(inventory, generation, stamp):
+    count = 0
+    with open(os.path.join(generation, "streams.bin"), "wb") as f:
+        f.write(_header.pack(_magic, 0))
+        for network, station, location, stream in InventoryIterator(inventory):
+            epoch = _epoch((network, station, location, stream))
+            if epoch is None:
+                continue
+            f.write(_record.pack(
+                _encode(network.code(), _codeSize, "network code"),
+                _encode(station.code(), _codeSize, "station code"),
+                _encode(location.code(), _codeSize, "location code"),
+                _encode(stream.code(), _codeSize, "stream code"),
+                epoch[0], epoch[1],
+                _optional(station.latitude, math.nan),
+                _optional(station.longitude, math.nan),
+                _optional(station.elevation, math.nan),
+                _optional(stream.gain, math.nan),
+                _optional(stream.gainFrequency, math.nan),
+                _encode(_optional(stream.gainUnit, ""), _unitSize, "gain unit")))
+            count += 1
+        f.seek(0)
+        f.write(_header.pack(_magic, count))
+
+    ar = seiscomp.io.BinaryArchive()
+    if not ar.create(os.path.join(generation, "inventory.scbin")):
+        raise IOError(generation + ": unable to write inventory snapshot")
+    ar.writeObject(inventory)
+    ar.close()
+
+    with open(os.path.join(generation, "stamp"), "w") as f:
+        f.write(stamp or "")
+    return count
+
+
+class InventorySnapshot:
+
+    def __init__(self, directory):
+        # All files are read from the generation current at this time.
+        self._directory = _currentGeneration(directory)
+        if self._directory is None:
+            raise IOError(directory + ": no inventory snapshot")
+        self._file = open(os.path.join(self._directory, "streams.bin"), "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = _header.unpack_from(self._map, 0)
+        if magic != _magic:
+            raise TypeError(directory + ": invalid inventory snapshot")
+        self._inventory = None
+
+    def __len__(self):
+        return self._count
+
+    def epoch(self, i):
+        values = list(_record.unpack_from(self._map, _header.size + i*_record.size))
+        for k in (0, 1, 2, 3, 11):
+            values[k] = values[k].rstrip(b"\0").decode()
+        return StreamEpoch(*values)
+
+    def streams(self, time=None):
+        """
+        Iterate over the stream epochs, if a time is given only over
+        those operational at that time.
+        """
+        t = _timeToFloat(time) if time is not None else None
+        for i in range(self._count):
+            epoch = self.epoch(i)
+            if t is not None and not epoch.start <= t <= epoch.end:
+                continue
+            yield epoch
+
+    def inventory(self):
+        """
+        The full inventory incl. responses
+        """
+        if self._inventory is None:
+            filename = os.path.join(self._directory, "inventory.scbin")
+            ar = seiscomp.io.BinaryArchive()
+            if not ar.open(filename):
+                raise IOError(filename + ": unable to open")
+            self._inventory = seiscomp.datamodel.Inventory.Cast(ar.readObject())
+            ar.close()
+            if self._inventory is None:
+                raise TypeError(filename + ": no inventory found")
+        return self._inventory
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def openInventorySnapshot(query, directory):
+    """
+    Open the inventory snapshot in the given directory. It is
+    (re)built from the database first if missing or outdated.
+
+    The snapshot should be closed after use, e.g. by using it as
+    context manager.
+    """
+    stamp = inventoryStamp(query)
+    if stamp is None:
+        seiscomp.logging.warning("cannot determine the state of the inventory, rebuilding snapshot")
+    generation = _currentGeneration(directory)
+    current = False
+    if generation is not None:
+        try:
+            with open(os.path.join(generation, "stamp")) as f:
+                current = f.read() == stamp
+        except IOError:
+            pass
+
+    if not current:
+        seiscomp.logging.info("loading inventory from database for snapshot")
+        inventory = query.loadInventory()
+        if inventory is None:
+            raise RuntimeError("failed to load inventory from database")
+        writeInventorySnapshot(inventory, directory, stamp)
+        del inventory
+
+    return InventorySnapshot(directory)
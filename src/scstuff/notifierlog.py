@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+# Copyright (C) GFZ Potsdam                                               #
+# All rights reserved.                                                    #
+#                                                                         #
+# Author: Joachim Saul (saul@gfz-potsdam.de)                              #
+#                                                                         #
+# GNU Affero General Public License Usage                                 #
+# This file may be used under the terms of the GNU Affero                 #
+# Public License version 3.0 as published by the Free Software Foundation #
+# and appearing in the file LICENSE included in the packaging of this     #
+# file. Please review the following information to ensure the GNU Affero  #
+# Public License version 3.0 requirements will be met:                    #
+# https://www.gnu.org/licenses/agpl-3.0.html.                             #
+###########################################################################
+
+"""
+Reading and writing of notifier logs as written by notifier-logger.py.
+
+Each log entry consists of a header line
+
+  ####  <timestamp>  [<md5>]  <nbytes> bytes
+
+followed by the XML of one NotifierMessage of nbytes bytes. Skipped
+duplicates are logged as header lines ending in "duplicate" without
+XML.
+
+compact() computes the minimal equivalent sequence of notifiers as
+written by notifier-compact.py.
+"""
+
+import gzip
+import os
+import tempfile
+import seiscomp.core
+import seiscomp.datamodel
+import seiscomp.io
+import seiscomp.utils
+import scstuff.util
+
+
+def readNotifierLog(filename, startTime=None, endTime=None):
+    """
+    Read the raw entries from a notifier log, which may be gzipped,
+    without parsing the XML.
+
+    Yields (time, header, xml) tuples in the order of the log. If
+    given, entries before startTime are skipped and reading stops
+    at the first entry after endTime.
+    """
+    if filename.endswith(".gz"):
+        f = gzip.open(filename, "rt")
+    else:
+        f = open(filename)
+
+    with f:
+        while True:
+            while True:
+                line = f.readline()
+                if not line:
+                    # empty input / EOF
+                    return
+                line = line.strip()
+                if not line:
+                    # blank line
+                    continue
+                if line[0] == "#":
+                    break
+
+            if len(line.split()) == 4 and line.split()[3] == "duplicate":
+                # reference to a previously logged notifier message
+                continue
+            if len(line.split()) == 3:
+                sharp, timestamp, nbytes = line.split()
+            elif len(line.split()) == 4:
+                sharp, timestamp, nbytes, sbytes = line.split()
+                assert sbytes == "bytes"
+            elif len(line.split()) == 5:
+                sharp, timestamp, md5hash, nbytes, sbytes = line.split()
+                assert sbytes == "bytes"
+            else:
+                return
+
+            assert sharp[0] == "#"
+            time = seiscomp.core.Time.GMT()
+            time.fromString(timestamp, "%FT%T.%fZ")
+            xml = f.read(int(nbytes)).strip()
+            if startTime is not None and time < startTime:
+                continue
+            if endTime is not None and time > endTime:
+                return
+
+            yield time, line, xml
+
+
+def notifierMessageFromXML(xml):
+    b = seiscomp.utils.stringToStreambuf(xml)
+    ar = seiscomp.io.XMLArchive(b)
+    obj = ar.readObject()
+    if obj is None:
+        raise TypeError("got invalid xml")
+    nmsg = seiscomp.datamodel.NotifierMessage.Cast(obj)
+    if nmsg is None:
+        raise TypeError("no NotifierMessage object found")
+    return nmsg
+
+
+def objectToXML(obj, formatted=True):
+    """
+    Serialize an object to XML as written to the notifier logs.
+
+    This is a workaround that requires writing to a temporary file,
+    preferably on a RAM disk.
+    """
+    ar = seiscomp.io.XMLArchive()
+    ar.setFormattedOutput(formatted)
+    fd, filename = tempfile.mkstemp(".xml", "notifier-", scstuff.util.tempDir())
+    os.close(fd)
+    try:
+        if not ar.create(filename):
+            raise IOError(filename + ": unable to create")
+        ar.writeObject(obj)
+        ar.close()
+        with open(filename) as f:
+            return f.read().strip()
+    finally:
+        os.unlink(filename)
+
+
+OP_ADD = seiscomp.datamodel.OP_ADD
+OP_UPDATE = seiscomp.datamodel.OP_UPDATE
+OP_REMOVE = seiscomp.datamodel.OP_REMOVE
+
+
+class Entry:
+    """
+    One notifier of the compacted sequence.
+
+    'parent' is the entry of the parent object if that was added or
+    updated within the time window. 'previous' is the entry of an
+    earlier notifier of the same object that is still part of the
+    sequence, e.g. the add of an object before an update that could
+    not be folded into it.
+    """
+
+    def __init__(self, time, notifier, parent, previous=None):
+        self.time = time
+        self.notifier = notifier
+        self.parent = parent
+        self.previous = previous
+        self.dropped = False
+        # superseded by a later entry of the same object
+        self.moved = False
+
+    def operation(self):
+        return self.notifier.operation()
+
+    def alive(self):
+        # An entry is dropped along with its parent, i.e. if the
+        # parent object is removed within the time window.
+        entry = self
+        while entry is not None:
+            if entry.dropped:
+                return False
+            entry = entry.parent
+        return True
+
+    def drop(self):
+        """
+        Drop this entry and the earlier ones of the same object.
+        Returns True if the object was added within the time window.
+        """
+        entry = self
+        while entry is not None:
+            entry.dropped = True
+            if entry.operation() == OP_ADD:
+                return True
+            entry = entry.previous
+        return False
+
+
+def compact(items):
+    """
+    Compute the minimal equivalent notifier sequence for the
+    (time, NotifierMessage) items.
+
+    For public objects
+      * add + updates are folded into a single add,
+      * subsequent updates are folded into a single update,
+      * add + (updates) + remove cancel each other,
+      * updates + remove are folded into the remove,
+    each time keeping the final state of the object. A folded add
+    stays at the position of the add, as its children follow it. A
+    folded update is moved to the position of the last update, as
+    it may refer to objects added in between. The notifiers of
+    children of an object removed within the time window are
+    dropped. Notifiers for other objects (e.g. arrivals or comments)
+    cannot be identified by a publicID and are passed on unchanged.
+
+    The items are consumed one by one and only the entries that may
+    still be part of the output are kept, i.e. the memory consumption
+    is determined by the size of the compacted sequence rather than
+    by the number of input messages.
+
+    Returns the list of surviving entries in output order.
+    """
+    entries = []
+    current = {}  # publicID -> latest entry of that object
+    stale = 0     # dropped or moved entries still in 'entries'
+
+    for time, nmsg in items:
+        for item in nmsg:
+            n = seiscomp.datamodel.Notifier.Cast(item)
+            assert n is not None
+            op = n.operation()
+            parent = current.get(n.parentID())
+            po = seiscomp.datamodel.PublicObject.Cast(n.object())
+            if po is None:
+                entries.append(Entry(time, n, parent))
+                continue
+
+            publicID = po.publicID()
+            prev = current.get(publicID)
+            if prev is not None and prev.dropped:
+                prev = None
+
+            if stale > len(entries) // 2:
+                # forget the dropped and moved entries
+                entries = [ entry for entry in entries if not entry.moved and entry.alive() ]
+                stale = 0
+
+            if op == OP_UPDATE and prev is not None and prev.operation() in (OP_ADD, OP_UPDATE):
+                # Only the attributes are updated, the children are
+                # taken care of by notifiers of their own.
+                if prev.notifier.object().assign(po):
+                    if prev.operation() == OP_UPDATE:
+                        entry = Entry(time, prev.notifier, prev.parent, prev)
+                        prev.moved = True
+                        stale += 1
+                        current[publicID] = entry
+                        entries.append(entry)
+                    continue
+
+            if op == OP_REMOVE and prev is not None and prev.operation() in (OP_ADD, OP_UPDATE):
+                stale += 1
+                if prev.drop():
+                    # The object didn't exist before the time window.
+                    del current[publicID]
+                    continue
+                prev = None
+
+            if op == OP_UPDATE:
+                entry = Entry(time, n, parent, prev)
+            else:
+                entry = Entry(time, n, parent)
+            current[publicID] = entry
+            entries.append(entry)
+
+    return [ entry for entry in entries if not entry.moved and entry.alive() ]
+
+
+def messages(entries, maxNotifiers):
+    """
+    Pack the entries into NotifierMessage's of at most maxNotifiers
+    notifiers. A message only contains notifiers of the same time.
+    """
+    nmsg = None
+    time = None
+    for entry in entries:
+        if nmsg is not None and (entry.time != time or nmsg.size() >= maxNotifiers):
+            yield time, nmsg
+            nmsg = None
+        if nmsg is None:
+            nmsg = seiscomp.datamodel.NotifierMessage()
+            time = entry.time
+        nmsg.attach(entry.notifier)
+    if nmsg is not None:
+        yield time, nmsg
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+# Copyright (C) GFZ Potsdam                                               #
+# All rights reserved.                                                    #
+#                                                                         #
+# Author: Joachim Saul (saul@gfz-potsdam.de)                              #
+#                                                                         #
+# GNU Affero General Public License Usage                                 #
+# This file may be used under the terms of the GNU Affero                 #
+# Public License version 3.0 as published by the Free Software Foundation #
+# and appearing in the file LICENSE included in the packaging of this     #
+# file. Please review the following information to ensure the GNU Affero  #
+# Public License version 3.0 requirements will be met:                    #
+# https://www.gnu.org/licenses/agpl-3.0.html.                             #
+###########################################################################
+
+"""
+Instrumentation of database queries.
+
+A TracedQuery is used in place of a seiscomp.datamodel.DatabaseQuery
+and records for each call the method, object type, number of returned
+objects and the time spent in the database. At the end a summary can
+be logged, including the slowest calls and N+1 patterns, i.e. the same
+method called for many different publicIDs. Optionally each call is
+written to a trace file as one JSON object per line.
+"""
+
+import json
+import time
+import seiscomp.logging
+
+
+# DatabaseQuery methods that take SQL rather than publicIDs
+_sqlMethods = set([ "getObjectIterator", "getObjectCount" ])
+
+
+class QueryCall:
+
+    def __init__(self, method, args):
+        self.method = method
+        self.type = None
+        self.ids = []
+        for arg in args:
+            if isinstance(arg, str):
+                # Strings are publicIDs, except e.g. the SQL passed to
+                # getObjectIterator().
+                if method not in _sqlMethods and not any(c.isspace() for c in arg):
+                    self.ids.append(arg)
+            elif hasattr(arg, "publicID"):
+                # object to load children into
+                self.type = arg.ClassName()
+                self.ids.append(arg.publicID())
+            elif hasattr(arg, "className"):
+                # TypeInfo
+                self.type = arg.className()
+        self.rows = 0
+        self.latency = 0.
+        self.start = time.time()
+
+    def record(self, obj):
+        if obj is None:
+            return
+        self.rows += 1
+        if self.type is None and hasattr(obj, "ClassName"):
+            self.type = obj.ClassName()
+
+    def asDict(self):
+        return {
+            "start": self.start, "method": self.method, "type": self.type,
+            "ids": self.ids, "rows": self.rows, "latency": self.latency }
+
+    @classmethod
+    def fromDict(cls, d):
+        call = cls(d["method"], ())
+        call.type = d["type"]
+        call.ids = list(d["ids"])
+        call.rows = d["rows"]
+        call.latency = d["latency"]
+        call.start = d["start"]
+        return call
+
+
+class _TracedIterator:
+    """
+    Wraps a DatabaseIterator to count the returned objects and the
+    time spent fetching them. The call is recorded when the iterator
+    is exhausted, closed or deleted, whichever comes first, no matter
+    whether it is used as Python iterator or through get()/step().
+    """
+
+    def __init__(self, it, call, tracer):
+        self._it = it
+        self._call = call
+        self._tracer = tracer
+        self._fresh = True
+        self._finished = False
+
+    def __iter__(self):
+        it = iter(self._it)
+        try:
+            while True:
+                t0 = time.monotonic()
+                try:
+                    obj = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    self._call.latency += time.monotonic() - t0
+                self._call.record(obj)
+                yield obj
+        finally:
+            self._finish()
+
+    def get(self):
+        t0 = time.monotonic()
+        obj = self._it.get()
+        self._call.latency += time.monotonic() - t0
+        if self._fresh:
+            # count each row once, no matter how often get() is called
+            self._fresh = False
+            self._call.record(obj)
+        if obj is None:
+            self._finish()
+        return obj
+
+    def step(self):
+        t0 = time.monotonic()
+        result = self._it.step()
+        self._call.latency += time.monotonic() - t0
+        self._fresh = True
+        return result
+
+    def close(self):
+        self._it.close()
+        self._finish()
+
+    def _finish(self):
+        if not self._finished:
+            self._finished = True
+            self._tracer.finish(self._call)
+
+    def __del__(self):
+        self._finish()
+
+    def __getattr__(self, name):
+        return getattr(self._it, name)
+
+
+class TracedQuery:
+    """
+    Proxy for a DatabaseQuery that records all method calls.
+    """
+
+    def __init__(self, query, traceFile=None):
+        self._query = query
+        self._trace = open(traceFile, "w") if traceFile else None
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if not callable(attr) or name.startswith("_") or name == "driver":
+            return attr
+
+        def traced(*args, **kwargs):
+            call = QueryCall(name, args)
+            t0 = time.monotonic()
+            result = attr(*args, **kwargs)
+            call.latency = time.monotonic() - t0
+            if type(result).__name__ == "DatabaseIterator":
+                return _TracedIterator(result, call, self)
+            if isinstance(result, bool):
+                call.rows = int(result)
+            elif isinstance(result, int):
+                call.rows = result
+            else:
+                call.record(result)
+            self.finish(call)
+            return result
+
+        return traced
+
+    def finish(self, call):
+        self.calls.append(call)
+        if self._trace:
+            self._trace.write(json.dumps(call.asDict()) + "\n")
+
+    def takeCalls(self):
+        """
+        Remove the recorded calls and return them as list of dicts,
+        e.g. to pass them from a worker process to merge().
+        """
+        calls = [ call.asDict() for call in self.calls ]
+        del self.calls[:]
+        return calls
+
+    def merge(self, calls):
+        """
+        Record the calls given as dicts by takeCalls() of another
+        TracedQuery, e.g. in a worker process.
+        """
+        for d in calls:
+            self.finish(QueryCall.fromDict(d))
+
+    def summary(self, slowest=10, nPlusOne=10):
+        """
+        Return a summary of the recorded calls as text.
+
+        Methods called for at least 'nPlusOne' different publicIDs
+        are reported as N+1 patterns.
+        """
+        lines = []
+        total = sum(call.latency for call in self.calls)
+        lines.append("%d queries, %d objects, %.3f s" % (
+            len(self.calls), sum(call.rows for call in self.calls), total))
+
+        methods = {}
+        for call in self.calls:
+            key = (call.method, call.type)
+            if key not in methods:
+                methods[key] = [0, 0, 0., set()]
+            m = methods[key]
+            m[0] += 1
+            m[1] += call.rows
+            m[2] += call.latency
+            m[3].update(call.ids)
+        lines.append("per method:")
+        for (method, tp), (count, rows, latency, ids) in sorted(methods.items(), key=lambda item: -item[1][2]):
+            lines.append("  %-32s %-20s %6d calls %8d objects %9.3f s" % (method, tp or "-", count, rows, latency))
+
+        lines.append("slowest calls:")
+        for call in sorted(self.calls, key=lambda call: -call.latency)[:slowest]:
+            lines.append("  %-32s %-20s %8d objects %9.3f s  %s" % (
+                call.method, call.type or "-", call.rows, call.latency, " ".join(call.ids)))
+
+        patterns = [ (key, m) for key, m in methods.items() if len(m[3]) >= nPlusOne ]
+        if patterns:
+            lines.append("N+1 patterns:")
+            for (method, tp), (count, rows, latency, ids) in patterns:
+                lines.append("  %s(%s) called for %d different IDs, %.3f s in total" % (
+                    method, tp or "-", len(ids), latency))
+        return "\n".join(lines)
+
+    def logSummary(self):
+        for line in self.summary().split("\n"):
+            seiscomp.logging.info(line)
+
+    def close(self):
+        if self._trace:
+            self._trace.close()
+            self._trace = None
@@ -20,10 +20,175 @@ import seiscomp.datamodel
 import seiscomp.io
 import seiscomp.logging
 import operator
+import os
 import sys
+import tempfile
 from math import pi
 
 
+# Binary sidecar cache for large XML files, see readObjectFromFile().
+# Can be enabled for all tools by setting the environment variable
+# SCSTUFF_BINARY_CACHE to the minimum file size in MB. The variable
+# is only evaluated when first needed.
+_binaryCacheMinSize = None
+_binaryCacheConfigured = False
+
+
+def setBinaryCacheEnabled(enable=True, minSize=10*1024*1024):
+    """
+    Enable or disable the binary sidecar cache for XML files of at
+    least minSize bytes.
+    """
+    global _binaryCacheMinSize, _binaryCacheConfigured
+    _binaryCacheMinSize = minSize if enable else None
+    _binaryCacheConfigured = True
+
+
+def _binaryCacheThreshold():
+    global _binaryCacheMinSize, _binaryCacheConfigured
+    if not _binaryCacheConfigured:
+        _binaryCacheConfigured = True
+        value = os.environ.get("SCSTUFF_BINARY_CACHE")
+        if value:
+            try:
+                _binaryCacheMinSize = int(float(value)*1024*1024)
+            except ValueError:
+                seiscomp.logging.warning(
+                    "ignoring invalid SCSTUFF_BINARY_CACHE value '%s'" % value)
+    return _binaryCacheMinSize
+
+
+def _isXML(head):
+    return head.lstrip(b"\xef\xbb\xbf \t\r\n")[:1] == b"<"
+
+
+def _isZlib(head):
+    # RFC 1950 header: deflate method and header checksum
+    return len(head) >= 2 and head[0] & 0x0f == 8 and (head[0]*256 + head[1]) % 31 == 0
+
+
+def _isBinaryArchive(head):
+    # A BinaryArchive starts with the packed data model version
+    # (major << 16 | minor) as 32 bit little endian integer.
+    if len(head) < 4:
+        return False
+    minor = head[0] | head[1] << 8
+    major = head[2] | head[3] << 8
+    return major < 16 and minor < 1000
+
+
+def archiveFormat(filename):
+    """
+    Detect the format of a SeisComP archive file from its first bytes.
+    Returns "xml", "gzxml", "zxml" or "binary". Raises TypeError for
+    any other format.
+    """
+    with open(filename, "rb") as f:
+        head = f.read(64)
+    if head[:2] == b"\x1f\x8b":
+        import gzip
+        with gzip.open(filename, "rb") as f:
+            head = f.read(64)
+        if _isXML(head):
+            return "gzxml"
+        raise TypeError(filename + ": unsupported compressed format")
+    if _isXML(head):
+        return "xml"
+    if _isZlib(head):
+        import zlib
+        head = zlib.decompressobj().decompress(head)
+        if _isXML(head):
+            return "zxml"
+        raise TypeError(filename + ": unsupported compressed format")
+    if _isBinaryArchive(head):
+        return "binary"
+    raise TypeError(filename + ": unknown format")
+
+
+def _sidecarPrefix(filename):
+    directory, basename = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, "." + basename + ".")
+
+
+def _sidecarName(filename):
+    # The name contains size and mtime of the XML file so that a
+    # modified file is never read from a stale sidecar.
+    st = os.stat(filename)
+    return _sidecarPrefix(filename) + "%d-%d.scbin" % (st.st_size, st.st_mtime_ns)
+
+
+def _readArchive(filename, fmt):
+    if fmt == "binary":
+        ar = seiscomp.io.BinaryArchive()
+    else:
+        ar = seiscomp.io.XMLArchive()
+        if fmt == "gzxml":
+            ar.setCompression(True)
+            ar.setCompressionMethod(seiscomp.io.XMLArchive.GZIP)
+        elif fmt == "zxml":
+            ar.setCompression(True)
+            ar.setCompressionMethod(seiscomp.io.XMLArchive.ZIP)
+    if ar.open(filename) is False:
+        raise IOError(filename + ": unable to open")
+    obj = ar.readObject()
+    ar.close()
+    if obj is None:
+        raise TypeError(filename + ": invalid format")
+    return obj
+
+
+def _writeSidecar(filename, obj):
+    import glob
+    sidecar = _sidecarName(filename)
+    for stale in glob.glob(glob.escape(_sidecarPrefix(filename)) + "*.scbin"):
+        try:
+            os.unlink(stale)
+        except OSError:
+            pass
+    tmp = "%s.%d.tmp" % (sidecar, os.getpid())
+    ar = seiscomp.io.BinaryArchive()
+    if not ar.create(tmp):
+        seiscomp.logging.debug("%s: cannot write binary cache" % filename)
+        return
+    ar.writeObject(obj)
+    ar.close()
+    os.rename(tmp, sidecar)
+
+
+def readObjectFromFile(filename="-"):
+    """
+    Read the root object from a SeisComP XML, gzip or zlib compressed
+    XML or binary archive file. The format is detected from the first bytes of the
+    file. From stdin ("-") only XML can be read.
+
+    If the binary cache is enabled, a binary copy of a large XML file
+    is kept next to it as hidden sidecar file and read instead of the
+    XML file as long as the latter is unchanged.
+    """
+    if filename == "-":
+        return _readArchive(filename, "xml")
+
+    fmt = archiveFormat(filename)
+    minSize = _binaryCacheThreshold()
+    cache = fmt != "binary" and minSize is not None \
+        and os.path.getsize(filename) >= minSize
+    if cache:
+        sidecar = _sidecarName(filename)
+        if os.path.exists(sidecar):
+            try:
+                return _readArchive(sidecar, "binary")
+            except (IOError, TypeError):
+                seiscomp.logging.warning("%s: ignoring invalid binary cache" % filename)
+
+    obj = _readArchive(filename, fmt)
+    if cache:
+        try:
+            _writeSidecar(filename, obj)
+        except OSError as e:
+            seiscomp.logging.debug("%s: cannot write binary cache: %s" % (filename, e))
+    return obj
+
+
 def readEventParametersFromXML(xmlFile="-"):
     """
     Reads an EventParameters root element from a SC XML file.
@@ -31,16 +196,11 @@ def readEventParametersFromXML(xmlFile="-"):
     The EventParameters instance holds all event parameters
     contained in the XML file. In particular there can be
     more than one event.
+
+    Despite the name, gzipped XML and binary files are read as
+    well, see readObjectFromFile().
     """
-    ar = seiscomp.io.XMLArchive()
-    if xmlFile.lower().endswith(".gz"):
-        ar.setCompression(True)
-        ar.setCompressionMethod(seiscomp.io.XMLArchive.GZIP)
-    if ar.open(xmlFile) is False:
-        raise IOError(xmlFile + ": unable to open")
-    obj = ar.readObject()
-    if obj is None:
-        raise TypeError(xmlFile + ": invalid format")
+    obj = readObjectFromFile(xmlFile)
     ep  = seiscomp.datamodel.EventParameters.Cast(obj)
     if ep is None:
         raise TypeError(xmlFile + ": no eventparameters found")
@@ -57,6 +217,49 @@ def writeEventParametersToXML(ep, xmlFile="-", formatted=True):
     return False
 
 
+def tempDir():
+    # before we write to /tmp we try to write to ramdisk /dev/shm
+    for tempdir in ["/dev/shm", "/tmp"]:
+        if os.path.isdir(tempdir):
+            return tempdir
+
+
+def writeObjectToTempFile(obj, prefix="scstuff-"):
+    """
+    Write an object to a temporary BinaryArchive. Returns the name
+    of the temporary file.
+
+    This is used to pass objects between processes.
+    """
+    fd, filename = tempfile.mkstemp(".bin", prefix, tempDir())
+    os.close(fd)
+    ar = seiscomp.io.BinaryArchive()
+    if not ar.create(filename):
+        os.unlink(filename)
+        raise IOError(filename + ": unable to create")
+    ar.writeObject(obj)
+    ar.close()
+    return filename
+
+
+def readObjectFromTempFile(filename):
+    """
+    Read an object from a temporary BinaryArchive written by
+    writeObjectToTempFile() and remove the file.
+    """
+    ar = seiscomp.io.BinaryArchive()
+    try:
+        if not ar.open(filename):
+            raise IOError(filename + ": unable to open")
+        obj = ar.readObject()
+        ar.close()
+    finally:
+        os.unlink(filename)
+    if obj is None:
+        raise TypeError(filename + ": invalid format")
+    return obj
+
+
 def EventParametersEvents(ep):
     for i in range(ep.eventCount()):
         # FIXME: The cast hack forces the SC refcounter to be increased.
@@ -795,6 +998,26 @@ def ArrivalIterator(origin):
         yield origin.arrival(i)
 
 
+def parameterSetValues(parameterSetID, cache=None):
+    """
+    The parameters of the parameter set with the given ID as dict
+    name -> value. If a dict is passed as cache, the result is
+    memoized in it by parameterSetID.
+    """
+    if cache is not None and parameterSetID in cache:
+        return cache[parameterSetID]
+    values = None
+    params = seiscomp.datamodel.ParameterSet.Find(parameterSetID)
+    if params:
+        values = dict()
+        for k in range(params.parameterCount()):
+            param = params.parameter(k)
+            values[param.name()] = param.value()
+    if cache is not None:
+        cache[parameterSetID] = values
+    return values
+
+
 def configuredStreams(configModule, setupName):
     """
     Get the configured streams from the specified config module.
@@ -804,44 +1027,26 @@ def configuredStreams(configModule, setupName):
     """
     items = []
 
+    # Many stations share the same parameter set, e.g. via profiles.
+    # Each parameter set is therefore only read once.
+    parameterSets = dict()
+
     # loop over all configured stations
     for i in range(configModule.configStationCount()):
         # config for one station
         cfg = configModule.configStation(i)
 
-        net, sta = cfg.networkCode(), cfg.stationCode()
-        seiscomp.logging.debug("Config  %s  %s" % (net, sta))
-
         # client-specific setup for this station
         setup = seiscomp.datamodel.findSetup(cfg, setupName, True)
         if not setup:
-            seiscomp.logging.debug("no setup found")
             continue
 
-        # break setup down do a set of parameters
-        paramSet = setup.parameterSetID()
-        seiscomp.logging.debug("paramSet " + paramSet)
-        params = seiscomp.datamodel.ParameterSet.Find(setup.parameterSetID())
-        if not params:
-            seiscomp.logging.debug("no params found")
+        values = parameterSetValues(setup.parameterSetID(), parameterSets)
+        if not values:
             continue
 
-        # search for "detecStream" and "detecLocid"
-        detecStream = None
-        detecLocid = ""
-
-        # We cannot look them up by name, therefore need
-        # to check all available parameters.
-        for k in range(params.parameterCount()):
-            param = params.parameter(k)
-            seiscomp.logging.debug(
-                "Config  %s  %s - %s %s" % (
-                    net, sta, param.name(), param.value()))
-
-            if param.name() == "detecStream":
-                detecStream = param.value()
-            elif param.name() == "detecLocid":
-                detecLocid = param.value()
+        detecStream = values.get("detecStream")
+        detecLocid = values.get("detecLocid", "")
         if detecLocid == "":
             # TODO: Review! Do we need to rewrite this?
             detecLocid = "--"
@@ -849,9 +1054,9 @@ def configuredStreams(configModule, setupName):
             # ignore stations without detecStream
             continue
 
-        item = (cfg.networkCode(), cfg.stationCode(), detecLocid, detecStream)
-        seiscomp.logging.debug("Config  %s  %s %s" % (net, sta, str(item)))
-        items.append(item)
+        items.append( (cfg.networkCode(), cfg.stationCode(), detecLocid, detecStream) )
 
+    seiscomp.logging.debug("%d of %d configured stations with detecStream, %d parameter sets" % (
+        len(items), configModule.configStationCount(), len(parameterSets)))
     return items
 
@@ -0,0 +1,144 @@
+import time
+import seiscomp.core
+import seiscomp.datamodel
+import scstuff.inventory
+import scstuff.util
+
+
+stationCount = 10000
+
+
+def makeConfigModule(parameterSetCount=100):
+    """
+    Synthetic config module with 'stationCount' stations sharing
+    'parameterSetCount' parameter sets, as with binding profiles.
+    """
+    config = seiscomp.datamodel.Config()
+    module = seiscomp.datamodel.ConfigModule.Create()
+    module.setName("test")
+    config.add(module)
+
+    parameterSets = []
+    for i in range(parameterSetCount):
+        ps = seiscomp.datamodel.ParameterSet.Create()
+        for name, value in [
+                ("detecStream", "BH" if i % 2 else "HH"),
+                ("detecLocid", "" if i % 3 else "00"),
+                ("detecFilter", "RMHP(10)>>ITAPER(30)>>BW(4,0.7,2)>>STALTA(2,80)"),
+                ("trigOn", "3"), ("trigOff", "1.5") ]:
+            p = seiscomp.datamodel.Parameter.Create()
+            p.setName(name)
+            p.setValue(value)
+            ps.add(p)
+        config.add(ps)
+        parameterSets.append(ps)
+
+    for i in range(stationCount):
+        cs = seiscomp.datamodel.ConfigStation.Create()
+        cs.setNetworkCode("N%d" % (i % 50))
+        cs.setStationCode("S%04d" % i)
+        cs.setEnabled(True)
+        setup = seiscomp.datamodel.Setup()
+        setup.setName("default")
+        setup.setEnabled(True)
+        setup.setParameterSetID(parameterSets[i % parameterSetCount].publicID())
+        cs.add(setup)
+        module.add(cs)
+
+    return config, module
+
+
+def configuredStreamsReference(configModule, setupName):
+    # straightforward per-station, per-parameter version
+    items = []
+    for i in range(configModule.configStationCount()):
+        cfg = configModule.configStation(i)
+        setup = seiscomp.datamodel.findSetup(cfg, setupName, True)
+        if not setup:
+            continue
+        params = seiscomp.datamodel.ParameterSet.Find(setup.parameterSetID())
+        if not params:
+            continue
+        detecStream = None
+        detecLocid = ""
+        for k in range(params.parameterCount()):
+            param = params.parameter(k)
+            if param.name() == "detecStream":
+                detecStream = param.value()
+            elif param.name() == "detecLocid":
+                detecLocid = param.value()
+        if not detecStream:
+            continue
+        items.append( (cfg.networkCode(), cfg.stationCode(), detecLocid or "--", detecStream) )
+    return items
+
+
+def makeInventory():
+    inventory = seiscomp.datamodel.Inventory()
+    start = seiscomp.core.Time(946684800)
+    for i in range(stationCount):
+        if i % 50 == 0:
+            network = seiscomp.datamodel.Network.Create()
+            network.setCode("N%d" % (i // 50))
+            network.setStart(start)
+            inventory.add(network)
+        station = seiscomp.datamodel.Station.Create()
+        station.setCode("S%04d" % i)
+        station.setStart(start)
+        network.add(station)
+        location = seiscomp.datamodel.SensorLocation.Create()
+        location.setCode("" if i % 3 else "00")
+        location.setStart(start)
+        station.add(location)
+        for cha in ["BHZ", "BHN", "BHE"]:
+            stream = seiscomp.datamodel.Stream.Create()
+            stream.setCode(cha)
+            stream.setStart(start)
+            location.add(stream)
+    return inventory
+
+
+def timed(func, *args):
+    t0 = time.monotonic()
+    func(*args)
+    return time.monotonic() - t0
+
+
+def test_configuredStreams():
+    config, module = makeConfigModule()
+    expected = configuredStreamsReference(module, "default")
+    result = scstuff.util.configuredStreams(module, "default")
+    assert len(result) == stationCount
+    assert result == expected
+
+
+def test_streamComponents():
+    inventory = makeInventory()
+    now = seiscomp.core.Time.GMT()
+    blacklist = set([ ("N1", "S%04d" % i) for i in range(50, 100) ])
+
+    expected = scstuff.inventory.streamComponents(inventory, now, blacklist)
+    table = scstuff.inventory.StreamTable.fromInventory(inventory)
+    result = scstuff.inventory.streamComponents(table, now, blacklist)
+    assert len(result) == stationCount - len(blacklist)
+    assert result == expected
+
+
+def benchmark():
+    config, module = makeConfigModule()
+    t1 = timed(configuredStreamsReference, module, "default")
+    t2 = timed(scstuff.util.configuredStreams, module, "default")
+    print("configuredStreams: %d stations, reference %.3f s, current %.3f s" % (stationCount, t1, t2))
+
+    inventory = makeInventory()
+    now = seiscomp.core.Time.GMT()
+    table = scstuff.inventory.StreamTable.fromInventory(inventory)
+    t1 = timed(scstuff.inventory.streamComponents, inventory, now)
+    t2 = timed(scstuff.inventory.streamComponents, table, now)
+    print("streamComponents: %d stations, Inventory %.3f s, StreamTable %.3f s" % (stationCount, t1, t2))
+
+
+if __name__ == "__main__":
+    # Timings are not part of the tests as they depend on the
+    # machine. Run as: scpython config-streams.py
+    benchmark()
@@ -0,0 +1,327 @@
+import os
+import sqlite3
+import pytest
+import seiscomp.core
+import seiscomp.datamodel
+import seiscomp.io
+import seiscomp.system
+import scstuff.dbutil
+
+
+# Start of the test data set
+t0 = 1600000000
+
+
+def makeEventParameters():
+    """
+    Picks and amplitudes spread over one hour, incl. picks exactly at
+    and within a second of the boundaries used in the tests below.
+    """
+    ep = seiscomp.datamodel.EventParameters()
+    offsets = [ 0, 0.5, 599.9, 600, 600.25, 1199.75, 1200, 1800.5, 3599.999, 3600 ]
+    offsets += [ 7.3*i for i in range(1, 400) ]
+    for i, offset in enumerate(offsets):
+        seconds = int(offset)
+        t = seiscomp.core.Time(t0 + seconds, int(round((offset - seconds)*1.e6)))
+
+        pick = seiscomp.datamodel.Pick.Create("Pick/%04d" % i)
+        pick.setTime(seiscomp.datamodel.TimeQuantity(t))
+        pick.setWaveformID(seiscomp.datamodel.WaveformStreamID(
+            "XX" if i % 10 == 0 else "GE", "STA%02d" % (i % 20), "", "BHZ", ""))
+        ci = seiscomp.datamodel.CreationInfo()
+        ci.setAuthor("a%d" % (i % 3))
+        ci.setCreationTime(t)
+        pick.setCreationInfo(ci)
+        ep.add(pick)
+
+        ampl = seiscomp.datamodel.Amplitude.Create("Amplitude/%04d" % i)
+        ampl.setType("mb")
+        ampl.setPickID(pick.publicID())
+        ampl.setAmplitude(seiscomp.datamodel.RealQuantity(float(i)))
+        ampl.setTimeWindow(seiscomp.datamodel.TimeWindow(t + seiscomp.core.TimeSpan(2.), 0, 10))
+        ampl.setCreationInfo(ci)
+        ep.add(ampl)
+
+    addEvent(ep)
+    return ep
+
+
+def comment(id, text):
+    c = seiscomp.datamodel.Comment()
+    c.setId(id)
+    c.setText(text)
+    return c
+
+
+def addEvent(ep):
+    """
+    Event with two origins that have children of all types loaded
+    in bulk by loadOriginsForEvent
+    """
+    RealQuantity = seiscomp.datamodel.RealQuantity
+    event = seiscomp.datamodel.Event.Create("Event/1")
+    for k in range(2):
+        origin = seiscomp.datamodel.Origin.Create("Origin/%d" % k)
+        origin.setTime(seiscomp.datamodel.TimeQuantity(seiscomp.core.Time(t0 + 60*k)))
+        origin.setLatitude(RealQuantity(10.*k))
+        origin.setLongitude(RealQuantity(20.))
+        for i in range(k, 30, 2):
+            arrival = seiscomp.datamodel.Arrival()
+            arrival.setPickID("Pick/%04d" % i)
+            arrival.setPhase(seiscomp.datamodel.Phase("P" if i % 3 else "S"))
+            arrival.setWeight(1. if i % 4 else 0.)
+            origin.add(arrival)
+        origin.add(comment("origin", "comment of origin %d" % k))
+        origin.add(comment("other", "another comment"))
+        compositeTime = seiscomp.datamodel.CompositeTime()
+        compositeTime.setYear(seiscomp.datamodel.IntegerQuantity(2020 + k))
+        origin.add(compositeTime)
+
+        stationMagnitudeIDs = []
+        for i in range(5):
+            stationMagnitude = seiscomp.datamodel.StationMagnitude.Create(
+                "StationMagnitude/%d/%d" % (k, i))
+            stationMagnitude.setType("mb")
+            stationMagnitude.setMagnitude(RealQuantity(4. + 0.1*i))
+            stationMagnitude.add(comment("sm", "station magnitude %d" % i))
+            origin.add(stationMagnitude)
+            stationMagnitudeIDs.append(stationMagnitude.publicID())
+
+        for i, magnitudeType in enumerate([ "mb", "M" ]):
+            magnitude = seiscomp.datamodel.Magnitude.Create("Magnitude/%d/%d" % (k, i))
+            magnitude.setType(magnitudeType)
+            magnitude.setMagnitude(RealQuantity(4.2 + i))
+            magnitude.add(comment("mag", "magnitude %s" % magnitudeType))
+            for stationMagnitudeID in stationMagnitudeIDs[i:]:
+                contribution = seiscomp.datamodel.StationMagnitudeContribution()
+                contribution.setStationMagnitudeID(stationMagnitudeID)
+                contribution.setWeight(0.5)
+                magnitude.add(contribution)
+            origin.add(magnitude)
+
+        ep.add(origin)
+        event.add(seiscomp.datamodel.OriginReference(origin.publicID()))
+    ep.add(event)
+
+
+@pytest.fixture(scope="module")
+def databaseURI(tmp_path_factory):
+    # An existing database may be given to test against real data,
+    # e.g. sqlite3:///path/to/seiscomp.sqlite
+    if os.environ.get("SCSTUFF_TEST_DATABASE"):
+        return os.environ["SCSTUFF_TEST_DATABASE"]
+
+    schema = os.path.join(seiscomp.system.Environment.Instance().shareDir(), "db", "sqlite3.sql")
+    if not os.path.exists(schema):
+        pytest.skip("SQLite schema not found")
+
+    filename = str(tmp_path_factory.mktemp("db") / "seiscomp.sqlite")
+    con = sqlite3.connect(filename)
+    with open(schema) as f:
+        con.executescript(f.read())
+    con.close()
+
+    uri = "sqlite3://" + filename
+    db = seiscomp.io.DatabaseInterface.Open(uri)
+    assert db is not None
+    ar = seiscomp.datamodel.DatabaseArchive(db)
+    writer = seiscomp.datamodel.DatabaseObjectWriter(ar)
+    registrationEnabled = seiscomp.datamodel.PublicObject.IsRegistrationEnabled()
+    seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False)
+    try:
+        assert writer(makeEventParameters())
+    finally:
+        seiscomp.datamodel.PublicObject.SetRegistrationEnabled(registrationEnabled)
+    db.disconnect()
+    return uri
+
+
+def query(databaseURI):
+    db = seiscomp.io.DatabaseInterface.Open(databaseURI)
+    return db, seiscomp.datamodel.DatabaseQuery(db)
+
+
+def test_same_picks_as_getPicks(databaseURI):
+    startTime = seiscomp.core.Time(t0 + 600, 250000)
+    endTime = seiscomp.core.Time(t0 + 1199, 750000)
+
+    db, q = query(databaseURI)
+    expected = set(
+        seiscomp.datamodel.Pick.Cast(obj).publicID()
+        for obj in q.getPicks(startTime, endTime))
+    result = set(
+        obj.publicID() for obj in scstuff.dbutil.iteratePicksForTimespan(q, startTime, endTime))
+    db.disconnect()
+
+    assert expected
+    assert result == expected
+
+
+def summary(objects):
+    """
+    The picks and amplitudes as dicts publicID -> attributes to compare
+    """
+    picks, amplitudes = {}, {}
+    for obj in objects:
+        pick = seiscomp.datamodel.Pick.Cast(obj)
+        if pick:
+            picks[pick.publicID()] = (
+                pick.time().value().iso(), pick.waveformID().networkCode(),
+                pick.creationInfo().author())
+            continue
+        ampl = seiscomp.datamodel.Amplitude.Cast(obj)
+        amplitudes[ampl.publicID()] = (
+            ampl.pickID(), ampl.amplitude().value(),
+            ampl.timeWindow().reference().iso())
+    return picks, amplitudes
+
+
+# Time spans with bounds exactly at, just inside and just outside of
+# the times of picks, incl. fractional seconds
+timespans = [
+    ((t0 + 600, 0), (t0 + 1200, 0)),
+    ((t0 + 600, 250000), (t0 + 1199, 750000)),
+    ((t0 + 600, 250001), (t0 + 1199, 749999)),
+    ((t0, 0), (t0 + 3600, 0)),
+    ((t0 + 3599, 999000), (t0 + 3600, 0)) ]
+
+
+@pytest.mark.parametrize("timespan", timespans)
+@pytest.mark.parametrize("authors", [None, ["a0"], ["a1", "a2"]])
+@pytest.mark.parametrize("margin", [0, 5])
+def test_same_as_loadPicksForTimespan(databaseURI, timespan, authors, margin):
+    # The filtering by the database must give the same result as the
+    # filtering in Python by loadPicksForTimespan.
+    startTime = seiscomp.core.Time(*timespan[0])
+    endTime = seiscomp.core.Time(*timespan[1])
+    kwargs = dict(withAmplitudes=True, authors=authors, amplitudeMargin=margin)
+
+    db, q = query(databaseURI)
+    expected = summary(scstuff.dbutil.loadPicksForTimespan(q, startTime, endTime, **kwargs).values())
+    result = summary(scstuff.dbutil.iteratePicksForTimespan(q, startTime, endTime, **kwargs))
+    db.disconnect()
+
+    assert expected[0]
+    assert result == expected
+
+
+def test_networkBlacklist_same_as_filtering(databaseURI):
+    # loadPicksForTimespan has no network blacklist. The database
+    # must give the same result as filtering its result in Python.
+    startTime = seiscomp.core.Time(t0 + 600, 250000)
+    endTime = seiscomp.core.Time(t0 + 3600)
+    kwargs = dict(withAmplitudes=True, authors=["a0", "a2"], amplitudeMargin=5)
+
+    db, q = query(databaseURI)
+    picks, amplitudes = summary(scstuff.dbutil.loadPicksForTimespan(q, startTime, endTime, **kwargs).values())
+    result = summary(scstuff.dbutil.iteratePicksForTimespan(
+        q, startTime, endTime, networkBlacklist=["XX"], **kwargs))
+    db.disconnect()
+
+    picks = dict( (k, v) for k, v in picks.items() if v[1] != "XX" )
+    amplitudes = dict( (k, v) for k, v in amplitudes.items() if v[0] in picks )
+    assert picks and amplitudes
+    assert result == (picks, amplitudes)
+
+
+def comments(obj):
+    return sorted( (obj.comment(i).id(), obj.comment(i).text()) for i in range(obj.commentCount()) )
+
+
+def originSummary(origin):
+    """
+    The origin incl. all children as nested tuples independent of the
+    order of the children
+    """
+    arrivals = sorted(
+        (a.pickID(), a.phase().code(), a.weight())
+        for a in (origin.arrival(i) for i in range(origin.arrivalCount())))
+    compositeTimes = sorted(
+        origin.compositeTime(i).year().value() for i in range(origin.compositeTimeCount()))
+    stationMagnitudes = sorted(
+        (m.publicID(), m.type(), m.magnitude().value(), comments(m))
+        for m in (origin.stationMagnitude(i) for i in range(origin.stationMagnitudeCount())))
+    magnitudes = sorted(
+        (m.publicID(), m.type(), m.magnitude().value(), comments(m),
+         sorted( (m.stationMagnitudeContribution(j).stationMagnitudeID(),
+                  m.stationMagnitudeContribution(j).weight())
+                 for j in range(m.stationMagnitudeContributionCount()) ))
+        for m in (origin.magnitude(i) for i in range(origin.magnitudeCount())))
+    return (origin.publicID(), arrivals, comments(origin), compositeTimes,
+            stationMagnitudes, magnitudes)
+
+
+def test_bulk_children_same_as_single(databaseURI):
+    # The children loaded in bulk must be the same as those loaded
+    # one by one per parent object.
+    db, q = query(databaseURI)
+    origins = scstuff.dbutil.loadOriginsForEvent(q, "Event/1", full=True)
+    result = sorted(originSummary(origin) for origin in origins)
+    del origins
+
+    origins = scstuff.dbutil.loadOriginsForEvent(q, "Event/1", full=False)
+    for origin in origins:
+        assert origin.arrivalCount() == origin.magnitudeCount() == 0
+        q.loadArrivals(origin)
+        q.loadComments(origin)
+        q.loadCompositeTimes(origin)
+        q.loadStationMagnitudes(origin)
+        q.loadMagnitudes(origin)
+        for i in range(origin.stationMagnitudeCount()):
+            q.loadComments(origin.stationMagnitude(i))
+        for i in range(origin.magnitudeCount()):
+            magnitude = origin.magnitude(i)
+            q.loadComments(magnitude)
+            q.loadStationMagnitudeContributions(magnitude)
+    expected = sorted(originSummary(origin) for origin in origins)
+    del origins
+    db.disconnect()
+
+    assert len(expected) == 2
+    for publicID, arrivals, originComments, compositeTimes, stationMagnitudes, magnitudes in expected:
+        assert arrivals and originComments and compositeTimes
+        assert stationMagnitudes and stationMagnitudes[0][3]
+        assert magnitudes and magnitudes[0][3] and magnitudes[0][4]
+    assert result == expected
+
+
+def test_sharded_equals_single(databaseURI):
+    startTime = seiscomp.core.Time(t0)
+    endTime = seiscomp.core.Time(t0 + 3600)
+    kwargs = dict(withAmplitudes=True, authors=["a0", "a1"], networkBlacklist=["XX"])
+
+    db, q = query(databaseURI)
+    expected = set(
+        obj.publicID() for obj in scstuff.dbutil.iteratePicksForTimespan(
+            q, startTime, endTime, **kwargs))
+    db.disconnect()
+    assert expected
+
+    for shards in [1, 3, 7]:
+        objects = scstuff.dbutil.loadPicksForTimespanSharded(
+            databaseURI, startTime, endTime, shards=shards, **kwargs)
+        publicIDs = [ obj.publicID() for obj in objects ]
+        assert len(publicIDs) == len(set(publicIDs))
+        assert set(publicIDs) == expected
+
+        picks = [ seiscomp.datamodel.Pick.Cast(obj) for obj in objects ]
+        times = [ p.time().value() for p in picks if p ]
+        assert times == sorted(times)
+
+
+def test_shared_executor(databaseURI):
+    # one pool for several chunks as in playback-dump-picks
+    startTime = seiscomp.core.Time(t0)
+    chunks = [ (startTime + seiscomp.core.TimeSpan(600.*i),
+                startTime + seiscomp.core.TimeSpan(600.*(i+1))) for i in range(6) ]
+
+    db, q = query(databaseURI)
+    expected = [ set(obj.publicID() for obj in scstuff.dbutil.iteratePicksForTimespan(q, t1, t2))
+                 for t1, t2 in chunks ]
+    db.disconnect()
+
+    with scstuff.dbutil.shardExecutor(3) as executor:
+        for (t1, t2), ids in zip(chunks, expected):
+            objects = scstuff.dbutil.loadPicksForTimespanSharded(
+                databaseURI, t1, t2, shards=3, executor=executor)
+            assert set(obj.publicID() for obj in objects) == ids
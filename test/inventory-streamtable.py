@@ -0,0 +1,201 @@
+import math
+import pytest
+import seiscomp.core
+import seiscomp.datamodel
+import scstuff.inventory
+
+
+t1 = 946684800   # 2000-01-01
+t2 = 1262304000  # 2010-01-01
+t3 = 1577836800  # 2020-01-01
+
+
+def time(t):
+    return seiscomp.core.Time(t)
+
+
+def makeInventory():
+    """
+    Network GE with station ABC moved in 2010, i.e. two station epochs
+    with different coordinates, the second one open-ended, and station
+    XYZ with a closed and an open-ended stream epoch at location 00.
+    """
+    inventory = seiscomp.datamodel.Inventory()
+    network = seiscomp.datamodel.Network.Create()
+    network.setCode("GE")
+    network.setStart(time(t1))
+    inventory.add(network)
+
+    for start, end, lat in [ (t1, t2, 10.), (t2, None, 10.5) ]:
+        station = seiscomp.datamodel.Station.Create()
+        station.setCode("ABC")
+        station.setStart(time(start))
+        if end:
+            station.setEnd(time(end))
+        station.setLatitude(lat)
+        station.setLongitude(20.)
+        station.setElevation(100.)
+        network.add(station)
+        location = seiscomp.datamodel.SensorLocation.Create()
+        location.setCode("")
+        location.setStart(time(start))
+        station.add(location)
+        for cha in ["BHZ", "BHN", "BHE"]:
+            stream = seiscomp.datamodel.Stream.Create()
+            stream.setCode(cha)
+            stream.setStart(time(start))
+            stream.setGain(1.e9 if end else 2.e9)
+            stream.setSampleRateNumerator(20)
+            stream.setSampleRateDenominator(1)
+            location.add(stream)
+
+    station = seiscomp.datamodel.Station.Create()
+    station.setCode("XYZ")
+    station.setStart(time(t1))
+    station.setLatitude(-5.)
+    station.setLongitude(30.)
+    station.setElevation(0.)
+    network.add(station)
+    location = seiscomp.datamodel.SensorLocation.Create()
+    location.setCode("00")
+    location.setStart(time(t1))
+    station.add(location)
+    for start, end in [ (t1, t2), (t2, None) ]:
+        stream = seiscomp.datamodel.Stream.Create()
+        stream.setCode("HHZ")
+        stream.setStart(time(start))
+        if end:
+            stream.setEnd(time(end))
+        location.add(stream)
+
+    return inventory
+
+
+def stations(inventory):
+    items = []
+    for inet in range(inventory.networkCount()):
+        network = inventory.network(inet)
+        for ista in range(network.stationCount()):
+            items.append(network.station(ista))
+    return items
+
+
+def start(obj):
+    try:
+        return obj.start()
+    except ValueError:
+        return None
+
+
+def end(obj):
+    try:
+        return obj.end()
+    except ValueError:
+        return None
+
+
+def test_epochs():
+    table = scstuff.inventory.StreamTable.fromInventory(makeInventory())
+    assert len(table) == 8
+
+    for t, expected in [
+            (t1 - 1, []),
+            (t1 + 1, [ ("GE", "ABC", "", "BHE"), ("GE", "ABC", "", "BHN"),
+                       ("GE", "ABC", "", "BHZ"), ("GE", "XYZ", "00", "HHZ") ]),
+            (t3, [ ("GE", "ABC", "", "BHE"), ("GE", "ABC", "", "BHN"),
+                   ("GE", "ABC", "", "BHZ"), ("GE", "XYZ", "00", "HHZ") ]) ]:
+        indices = table.select(time(t))
+        assert sorted(table.codes(i) for i in indices) == expected
+        # one epoch per stream at any time
+        assert len(set(table.codes(i) for i in indices)) == len(indices)
+
+    # the open-ended epochs are the ones of the second station epoch
+    for i in table.select(time(t3), sta="ABC"):
+        assert table.end[i] == math.inf
+        assert table.latitude[i] == 10.5
+        assert table.gain[i] == 2.e9
+    for i in table.select(time(t1 + 1), sta="ABC"):
+        assert table.end[i] == t2
+        assert table.latitude[i] == 10.
+
+    # the same comparison as InventoryIterator
+    inventory = makeInventory()
+    for t in (t1, t2, t3):
+        expected = sorted(
+            (n.code(), s.code(), l.code(), c.code())
+            for n, s, l, c in scstuff.inventory.InventoryIterator(inventory, time(t)))
+        assert sorted(table.codes(i) for i in table.select(time(t))) == expected
+
+
+def test_toInventory_station_epochs():
+    table = scstuff.inventory.StreamTable.fromInventory(makeInventory())
+    inventory = table.toInventory()
+
+    abc = [ s for s in stations(inventory) if s.code() == "ABC" ]
+    assert len(abc) == 2
+    first, second = abc
+    assert first.latitude() == 10.
+    assert first.start() == time(t1)
+    assert end(first) == time(t2)
+    assert second.latitude() == 10.5
+    assert second.start() == time(t2)
+    assert end(second) is None
+    for station in abc:
+        assert station.sensorLocationCount() == 1
+        assert station.sensorLocation(0).streamCount() == 3
+
+    xyz = [ s for s in stations(inventory) if s.code() == "XYZ" ]
+    assert len(xyz) == 1
+    location = xyz[0].sensorLocation(0)
+    assert location.code() == "00"
+    assert location.streamCount() == 2
+    assert location.start() == time(t1)
+    assert end(location) is None
+
+    network = inventory.network(0)
+    assert network.start() == time(t1)
+    assert end(network) is None
+
+    # the round trip preserves the table
+    again = scstuff.inventory.StreamTable.fromInventory(inventory)
+    assert sorted(table.rows()) == sorted(again.rows())
+    for t in (t1, t2, t3):
+        assert sorted(table.codes(i) for i in table.select(time(t))) == \
+               sorted(again.codes(i) for i in again.select(time(t)))
+
+
+@pytest.mark.parametrize("first", [True, False])
+def test_unknown_start(first):
+    table = scstuff.inventory.StreamTable()
+    rows = [
+        ("GE", "ABC", "", "BHZ", float(t2), math.inf),
+        ("GE", "ABC", "", "BHN", math.nan, math.inf) ]
+    if not first:
+        rows.reverse()
+    for row in rows:
+        table.append(*row, latitude=10., longitude=20., elevation=100.)
+
+    # rows with unknown start are never operational, as with
+    # InventoryIterator
+    assert [ table.codes(i) for i in table.select(time(t3)) ] == [ ("GE", "ABC", "", "BHZ") ]
+
+    inventory = table.toInventory()
+    station = stations(inventory)[0]
+    location = station.sensorLocation(0)
+    assert location.streamCount() == 2
+    # the envelope start is unknown regardless of the row order,
+    # i.e. not that of the row with known start
+    for obj in (inventory.network(0), station, location):
+        assert start(obj) != time(t2)
+        assert end(obj) is None
+
+
+def test_unknown_coordinates():
+    table = scstuff.inventory.StreamTable()
+    for cha in ["BHZ", "BHN", "BHE"]:
+        table.append("GE", "ABC", "", cha, float(t1))
+    inventory = table.toInventory()
+    # NaN coordinates must not split the station
+    assert len(stations(inventory)) == 1
+    with pytest.raises(ValueError):
+        stations(inventory)[0].latitude()
@@ -0,0 +1,92 @@
+import pytest
+import seiscomp.core
+import seiscomp.datamodel
+import scstuff.notifierlog
+
+
+OP_ADD = seiscomp.datamodel.OP_ADD
+OP_UPDATE = seiscomp.datamodel.OP_UPDATE
+OP_REMOVE = seiscomp.datamodel.OP_REMOVE
+
+
+@pytest.fixture(autouse=True)
+def noRegistration():
+    # as in notifier-compact.py
+    enabled = seiscomp.datamodel.PublicObject.IsRegistrationEnabled()
+    seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False)
+    yield
+    seiscomp.datamodel.PublicObject.SetRegistrationEnabled(enabled)
+
+
+def event(publicID, preferredOriginID=""):
+    obj = seiscomp.datamodel.Event(publicID)
+    obj.setPreferredOriginID(preferredOriginID)
+    return obj
+
+
+def origin(publicID):
+    obj = seiscomp.datamodel.Origin(publicID)
+    obj.setTime(seiscomp.datamodel.TimeQuantity(seiscomp.core.Time(1600000000)))
+    return obj
+
+
+def items(*notifiers):
+    """
+    One NotifierMessage per (op, parentID, object) notifier, one
+    second apart
+    """
+    for i, (op, parentID, obj) in enumerate(notifiers):
+        nmsg = seiscomp.datamodel.NotifierMessage()
+        nmsg.attach(seiscomp.datamodel.Notifier(parentID, op, obj))
+        yield seiscomp.core.Time(1600000000 + i), nmsg
+
+
+def summary(entries):
+    result = []
+    for entry in entries:
+        po = seiscomp.datamodel.PublicObject.Cast(entry.notifier.object())
+        result.append( (entry.operation(), po.publicID()) )
+    return result
+
+
+def test_folded_update_after_referenced_add():
+    # Event E existed before the time window. Its final state refers
+    # to origin O, so the update must follow the addition of O.
+    entries = scstuff.notifierlog.compact(items(
+        (OP_UPDATE, "EventParameters", event("E", "X")),
+        (OP_ADD,    "EventParameters", origin("O")),
+        (OP_UPDATE, "EventParameters", event("E", "O"))))
+
+    assert summary(entries) == [ (OP_ADD, "O"), (OP_UPDATE, "E") ]
+    assert seiscomp.datamodel.Event.Cast(entries[1].notifier.object()).preferredOriginID() == "O"
+
+
+def test_folded_add_stays_before_children():
+    entries = scstuff.notifierlog.compact(items(
+        (OP_ADD,    "EventParameters", event("E")),
+        (OP_ADD,    "EventParameters", origin("O")),
+        (OP_UPDATE, "EventParameters", event("E", "O"))))
+
+    assert summary(entries) == [ (OP_ADD, "E"), (OP_ADD, "O") ]
+    assert seiscomp.datamodel.Event.Cast(entries[0].notifier.object()).preferredOriginID() == "O"
+
+
+def test_add_update_remove_cancel():
+    # An update with an object of another type cannot be folded into
+    # the add. The whole chain must still be dropped by the remove.
+    entries = scstuff.notifierlog.compact(items(
+        (OP_ADD,    "EventParameters", event("E")),
+        (OP_UPDATE, "EventParameters", origin("E")),
+        (OP_REMOVE, "EventParameters", event("E"))))
+
+    assert summary(entries) == []
+
+
+def test_updates_remove():
+    # the object existed before the time window
+    entries = scstuff.notifierlog.compact(items(
+        (OP_UPDATE, "EventParameters", event("E", "A")),
+        (OP_UPDATE, "EventParameters", event("E", "B")),
+        (OP_REMOVE, "EventParameters", event("E"))))
+
+    assert summary(entries) == [ (OP_REMOVE, "E") ]
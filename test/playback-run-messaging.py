@@ -0,0 +1,120 @@
+import os
+import random
+import importlib.util
+import seiscomp.core
+import seiscomp.datamodel
+import seiscomp.io
+
+
+def loadScript():
+    filename = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..",
+        "playback", "xml", "scstuff.playback-run-messaging.py")
+    spec = importlib.util.spec_from_file_location("playback_run_messaging", filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def makePick(i):
+    t = seiscomp.core.Time(1600000000 + i)
+    pick = seiscomp.datamodel.Pick.Create()
+    pick.setTime(seiscomp.datamodel.TimeQuantity(t))
+    pick.setWaveformID(seiscomp.datamodel.WaveformStreamID("GE", "STA", "", "BHZ", ""))
+    ci = seiscomp.datamodel.CreationInfo()
+    ci.setCreationTime(t)
+    pick.setCreationInfo(ci)
+    return pick
+
+
+def test_notifierMessage():
+    script = loadScript()
+    ep = seiscomp.datamodel.EventParameters()
+    picks = [ makePick(i) for i in range(3) ]
+    msg = script.notifierMessage(ep, picks)
+
+    assert msg.size() == 3
+    for item in msg:
+        n = seiscomp.datamodel.Notifier.Cast(item)
+        assert n.operation() == seiscomp.datamodel.OP_ADD
+        assert n.parentID() == ep.publicID()
+    # the objects are not kept and removing them was not notified
+    assert ep.pickCount() == 0
+    assert seiscomp.datamodel.Notifier.GetMessage() is None
+
+
+def test_memory_stays_flat():
+    # Play back a large number of objects as in _play(), one shared
+    # EventParameters for the whole run, and verify that the number
+    # of live public objects doesn't grow with the input.
+    script = loadScript()
+    ep = seiscomp.datamodel.EventParameters()
+    baseline = seiscomp.datamodel.PublicObject.ObjectCount()
+
+    batchCount = 10
+    counts = []
+    for i in range(0, 20000, batchCount):
+        batch = [ makePick(i + k) for k in range(batchCount) ]
+        msg = script.notifierMessage(ep, batch)
+        assert msg.size() == batchCount
+        del msg, batch
+        if i % 1000 == 0:
+            counts.append(seiscomp.datamodel.PublicObject.ObjectCount() - baseline)
+
+    assert ep.pickCount() == 0
+    # only the objects of the current batch may be alive
+    assert max(counts) <= batchCount
+    assert seiscomp.datamodel.PublicObject.ObjectCount() == baseline
+
+
+def test_indexed_memory_stays_flat(tmp_path):
+    # The same with --external-sort: the objects are read one by one
+    # via the on-disk index, in order of creation time.
+    script = loadScript()
+
+    class Player:
+        # just what _indexedObjects() needs of PickPlayer
+        _takeObjects = script.PickPlayer._takeObjects
+        _parseElement = script.PickPlayer._parseElement
+        _indexedObjects = script.PickPlayer._indexedObjects
+
+        def __init__(self, xmlFile):
+            self._xmlFile = xmlFile
+
+    count = 5000
+    xmlFile = str(tmp_path / "picks.xml")
+    ep = seiscomp.datamodel.EventParameters()
+    offsets = list(range(count))
+    random.Random(1).shuffle(offsets)
+    for i in offsets:
+        ep.add(makePick(i))
+    ar = seiscomp.io.XMLArchive()
+    assert ar.create(xmlFile)
+    ar.writeObject(ep)
+    ar.close()
+    del ep
+
+    index = script.ObjectIndex(str(tmp_path))
+    try:
+        index.build(xmlFile)
+        assert index.count == count
+
+        ep = seiscomp.datamodel.EventParameters()
+        baseline = seiscomp.datamodel.PublicObject.ObjectCount()
+        times = []
+        counts = []
+        for t, obj in Player(xmlFile)._indexedObjects(index):
+            times.append(t)
+            msg = script.notifierMessage(ep, [obj])
+            del msg, obj
+            if len(times) % 500 == 0:
+                counts.append(seiscomp.datamodel.PublicObject.ObjectCount() - baseline)
+    finally:
+        index.close()
+
+    assert len(times) == count
+    assert times == sorted(times)
+    assert ep.pickCount() == 0
+    # at most the pick being played back and the EventParameters it
+    # was parsed into
+    assert max(counts) <= 2
@@ -1,3 +1,3 @@
 #!/bin/sh
 
-scpython -m pytest mt-to-txt.py
+scpython -m pytest mt-to-txt.py dbutil-sharded.py config-streams.py inventory-streamtable.py notifier-compact.py playback-run-messaging.py